@@ -0,0 +1,195 @@
+import numpy as np
+
+# Winner codes stored in BatchPong.winner
+WINNER_NONE = 0
+WINNER_PLAYER = 1
+WINNER_CPU = 2
+
+
+# pygame.Rect stores ints and rounds half away from zero on assignment
+def _rect_round(values: np.ndarray) -> np.ndarray:
+	return np.trunc(values + np.copysign(0.5, values))
+
+
+# Steps n headless matches at once. Each match follows the same rules as
+# PongGame with ScriptedInput (see build_game), tick for tick. Gameplay
+# settings can be scalars or arrays of length n, one value per match.
+class BatchPong:
+	def __init__(self, n: int,
+				 display_w: int = 320,
+				 display_h: int = 240,
+				 fps=120,
+				 max_score=2,
+				 cpu_speed_increment=1,
+				 ball_speed_increment=0.5,
+				 max_ball_time_4_travel=3,
+				 max_gamer_time_4_travel=0.5,
+				 dead_zone=5,
+				 ball_radius: int = 5,
+				 gamer_width: int = 10,
+				 gamer_high: int = 40) -> None:
+		self.n = n
+		self.disp_w = display_w
+		self.disp_h = display_h
+		self.radius = ball_radius
+		self.gamer_high = gamer_high
+
+		def per_match(value):
+			return np.broadcast_to(np.asarray(value, dtype=np.float64), (n,)).copy()
+
+		self.fps = per_match(fps)
+		self.max_score = per_match(max_score).astype(np.int64)
+		self.cpu_speed_increment = per_match(cpu_speed_increment)
+		self.ball_speed_increment = per_match(ball_speed_increment)
+		self.dead_zone = per_match(dead_zone)
+		ball_time = per_match(max_ball_time_4_travel)
+		gamer_time = per_match(max_gamer_time_4_travel)
+		self.ball_speed_x_dflt = display_w / (ball_time * self.fps)
+		self.ball_speed_y_dflt = display_h / (ball_time * self.fps)
+		self.cpu_speed = display_h / (gamer_time * self.fps)
+		self.player_speed = display_h / (gamer_time * self.fps)
+
+		# Same layout as build_game
+		self.player_x = display_w - 30
+		self.cpu_x = 20
+		self.gamer_w = gamer_width
+		self.gamer_init_y = float(_rect_round(np.float64(display_h / 2 - 40)))
+
+		self.ball_x = np.full(n, display_w / 2)
+		self.ball_y = np.full(n, display_h / 2)
+		self.ball_speed_x = np.zeros(n)
+		self.ball_speed_y = np.zeros(n)
+		self.player_y = np.full(n, self.gamer_init_y)
+		self.player_speed_y = np.zeros(n)
+		self.cpu_y = np.full(n, self.gamer_init_y)
+		self.cpu_speed_y = np.zeros(n)
+		# Key held by the scripted player: -1 up, 0 none, 1 down
+		self.held_key = np.zeros(n, dtype=np.int8)
+
+		self.player_score = np.zeros(n, dtype=np.int64)
+		self.cpu_score = np.zeros(n, dtype=np.int64)
+		self.last_diff = np.zeros(n, dtype=np.int64)
+		self.level = np.ones(n, dtype=np.int64)
+		self.winner = np.full(n, WINNER_NONE, dtype=np.int8)
+		self.done = np.zeros(n, dtype=bool)
+		self.ticks = np.zeros(n, dtype=np.int64)
+
+	def _reset_game(self, mask: np.ndarray) -> None:
+		if not mask.any():
+			return
+		self._update_game_speed(mask)
+		self.ball_speed_x[mask] = 0
+		self.ball_speed_y[mask] = 0
+		self.ball_x[mask] = self.disp_w / 2
+		self.ball_y[mask] = self.disp_h / 2
+		self.player_y[mask] = self.gamer_init_y
+		self.cpu_y[mask] = self.gamer_init_y
+
+	def _update_game_speed(self, mask: np.ndarray) -> None:
+		score_diff = self.player_score - self.cpu_score
+		level_up = mask & (score_diff > 0) & (score_diff > self.last_diff)
+		inc = self.cpu_speed_increment
+		new_x = np.abs(self.ball_speed_x) + inc
+		new_y = np.abs(self.ball_speed_y) + inc
+		self.ball_speed_x = np.where(level_up, np.where(self.ball_speed_x < 0, -new_x, new_x), self.ball_speed_x)
+		self.ball_speed_y = np.where(level_up, np.where(self.ball_speed_y < 0, -new_y, new_y), self.ball_speed_y)
+		# Gamer.set_speed adds to the current speed, zero stops the paddle
+		cpu_delta = self.cpu_speed + inc
+		self.cpu_speed_y = np.where(level_up, np.where(cpu_delta != 0, self.cpu_speed_y + cpu_delta, 0.0), self.cpu_speed_y)
+		self.last_diff = np.where(level_up, score_diff, self.last_diff)
+		self.level += level_up
+
+	def _check_collision(self, active: np.ndarray) -> None:
+		r = self.radius
+		left = self.ball_x - r
+		right = self.ball_x + r
+		top = self.ball_y - r
+		bott = self.ball_y + r
+
+		player_goal = active & (left <= self.cpu_x)
+		self.player_score += player_goal
+		self._reset_game(player_goal)
+
+		cpu_goal = active & (right >= self.player_x + self.gamer_w)
+		self.cpu_score += cpu_goal
+		self._reset_game(cpu_goal)
+
+		# The scalar game keeps using the borders read before a reset
+		half_w = self.disp_w / 2
+		player_hit = (active & (right > half_w) & (right >= self.player_x)
+					  & (top <= self.player_y + self.gamer_high) & (bott >= self.player_y))
+		self.ball_speed_x = np.where(player_hit, self.ball_speed_x * -1, self.ball_speed_x)
+		cpu_hit = (active & (left < half_w) & (left <= self.cpu_x + self.gamer_w)
+				   & (top <= self.cpu_y + self.gamer_high) & (bott >= self.cpu_y))
+		self.ball_speed_x = np.where(cpu_hit, self.ball_speed_x * -1, self.ball_speed_x)
+
+	def _move_computer(self, active: np.ndarray) -> None:
+		follow = (self.ball_x + self.radius) < self.disp_w / 2
+		below = (self.cpu_y + self.gamer_high // 2) < self.ball_y
+		chase = np.where(below, self.cpu_speed_y + self.cpu_speed, self.cpu_speed_y - self.cpu_speed)
+		self.cpu_speed_y = np.where(active, np.where(follow, chase, 0.0), self.cpu_speed_y)
+
+	def _check_end_game(self, active: np.ndarray) -> np.ndarray:
+		cpu_won = active & (self.cpu_score == self.max_score)
+		player_won = active & ~cpu_won & (self.player_score == self.max_score)
+		self.winner[cpu_won] = WINNER_CPU
+		self.winner[player_won] = WINNER_PLAYER
+		self.done |= cpu_won | player_won
+		return active & ~self.done
+
+	def _update_events(self, active: np.ndarray) -> None:
+		stopped = (self.ball_speed_x == 0) & (self.ball_speed_y == 0)
+		serve = active & stopped
+		start_speed_x = self.ball_speed_x_dflt + self.cpu_speed_increment * self.level
+		start_speed_y = self.ball_speed_y_dflt + self.cpu_speed_increment * self.level
+		self.ball_speed_x = np.where(serve, np.where(self.ball_speed_x < 0, -start_speed_x, start_speed_x), self.ball_speed_x)
+		self.ball_speed_y = np.where(serve, np.where(self.ball_speed_y < 0, -start_speed_y, start_speed_y), self.ball_speed_y)
+
+		diff = self.ball_y - (self.player_y + self.gamer_high // 2)
+		wanted = np.where(diff < -self.dead_zone, -1, np.where(diff > self.dead_zone, 1, 0)).astype(np.int8)
+		change = active & (wanted != self.held_key)
+		# KEYUP of the held key first, then KEYDOWN of the new one
+		release = change & (self.held_key != 0)
+		self.player_speed_y = np.where(release, self.player_speed_y - self.held_key * self.player_speed, self.player_speed_y)
+		press = change & (wanted != 0)
+		self.player_speed_y = np.where(press, self.player_speed_y + wanted * self.player_speed, self.player_speed_y)
+		self.held_key = np.where(change, wanted, self.held_key)
+
+	def _update_positions(self, active: np.ndarray) -> None:
+		r = self.radius
+		bounce = active & ((self.ball_y - r <= 0) | (self.ball_y + r >= self.disp_h))
+		self.ball_speed_y = np.where(bounce, self.ball_speed_y * -1, self.ball_speed_y)
+		self.ball_x = np.where(active, self.ball_x + self.ball_speed_x, self.ball_x)
+		self.ball_y = np.where(active, self.ball_y + self.ball_speed_y, self.ball_y)
+		self.player_y = np.where(active, self._gamer_pos(self.player_y, self.player_speed_y), self.player_y)
+		self.cpu_y = np.where(active, self._gamer_pos(self.cpu_y, self.cpu_speed_y), self.cpu_y)
+
+	def _gamer_pos(self, y: np.ndarray, speed_y: np.ndarray) -> np.ndarray:
+		y = np.where(speed_y != 0, _rect_round(y + speed_y), y)
+		y = np.where(y <= 0, 0.0, y)
+		return np.where(y + self.gamer_high >= self.disp_h, self.disp_h - self.gamer_high, y)
+
+	# Advance every unfinished match by one tick
+	def step(self) -> None:
+		active = ~self.done
+		self._check_collision(active)
+		self._move_computer(active)
+		active = self._check_end_game(active)
+		self._update_events(active)
+		self._update_positions(active)
+		self.ticks += active
+
+	# Step until every match has a winner or max_ticks is reached
+	def run(self, max_ticks: int) -> int:
+		ticks = 0
+		while ticks < max_ticks and not self.done.all():
+			self.step()
+			ticks += 1
+		return ticks
+
+	def results(self) -> dict:
+		return {"player_score": self.player_score.copy(),
+				"cpu_score": self.cpu_score.copy(),
+				"level": self.level.copy(),
+				"winner": self.winner.copy(),
+				"ticks": self.ticks.copy()}
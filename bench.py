@@ -0,0 +1,238 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import json
+import logging
+import sys
+from time import perf_counter_ns
+
+import pygame
+import multiball
+import pong
+
+DEFAULT_SIZES = ["320x240", "1280x720", "1920x1080"]
+# Results key of the reference benchmark
+REFERENCE = "reference"
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+def _stats(samples_ns: list) -> dict:
+	samples_ns = sorted(samples_ns)
+	total_s = sum(samples_ns) / 1e9
+	return {"ticks_per_sec": round(len(samples_ns) / total_s, 1) if total_s else None,
+			"p50_us": round(samples_ns[len(samples_ns) // 2] / 1000, 2),
+			"p99_us": round(samples_ns[min(len(samples_ns) - 1, int(len(samples_ns) * 0.99))] / 1000, 2)}
+
+
+def _make_game(width: int, height: int) -> pong.PongGame:
+	game = pong.build_game(width, height, pong.rgb_colors["lightgrey"], "player", max_score=1000000, seed=0)
+	# No frame limit: only the work done per frame is measured
+	game._fps = 0
+	# The scripted player serves after every point and misses now and then,
+	# so that the ball is in play for the whole benchmark
+	game._event_source = pong.ScriptedInput(game._ball, game._player, aim_error=20, rng=game._rng)
+	return game
+
+
+def bench_run_game_once(width: int, height: int, frames: int, dirty_rects: bool = False) -> dict:
+	game = _make_game(width, height)
+	game._dirty_rects = dirty_rects
+	samples = []
+	for _ in range(frames):
+		start = perf_counter_ns()
+		game.run_game_once()
+		samples.append(perf_counter_ns() - start)
+	return _stats(samples)
+
+
+# Same steps as run_game_once, timing every phase on its own
+def bench_phases(width: int, height: int, frames: int) -> dict:
+	game = _make_game(width, height)
+	screen = game._game_field.get_screen()
+
+	def update_pos():
+		game._ball.update_pos()
+		game._player.update_pos()
+		game._computer.update_pos()
+
+	def draw():
+		game._game_field.fill_screen()
+		game._ball.draw(screen)
+		game._player.draw(screen)
+		game._computer.draw(screen)
+		game._game_field.draw_borders()
+
+	phases = [("_check_collision", game._check_collision),
+			  ("_move_computer", game._move_computer),
+			  ("_update_events", game._update_events),
+			  ("update_pos", update_pos),
+			  ("draw", draw),
+			  ("_write_score", game._write_score),
+			  ("display.flip", pygame.display.flip)]
+	samples = {name: [] for name, _ in phases}
+	for _ in range(frames):
+		for name, phase in phases:
+			start = perf_counter_ns()
+			phase()
+			samples[name].append(perf_counter_ns() - start)
+	return {name: _stats(phase_samples) for name, phase_samples in samples.items()}
+
+
+# Pure simulation ticks, no pygame drawing: a measure of the machine speed
+# in this session, that the baseline is scaled with by compare()
+def bench_reference(frames: int) -> dict:
+	game = pong.build_game(320, 240, pong.rgb_colors["lightgrey"], "player", max_score=1000000,
+						   headless=True, seed=0, aim_error=20)
+	game._fps = 0
+	samples = []
+	for _ in range(frames):
+		start = perf_counter_ns()
+		game.run_game_once()
+		samples.append(perf_counter_ns() - start)
+	return _stats(samples)
+
+
+def run_benchmarks(sizes: list, frames: int) -> dict:
+	results = {REFERENCE: {"headless_ticks": bench_reference(frames)}}
+	for size in sizes:
+		width, height = (int(value) for value in size.split("x"))
+		results[size] = {"run_game_once": bench_run_game_once(width, height, frames),
+						 "run_game_once_dirty": bench_run_game_once(width, height, frames, dirty_rects=True)}
+		results[size].update(bench_phases(width, height, frames))
+	return results
+
+
+# Multi-ball stress test: time of a simulation step and of a frame draw as
+# the ball count grows, with the broadphase pairs against all pairs
+def bench_multiball(counts: list, ticks: int, width: int = 960, height: int = 720) -> dict:
+	results = {}
+	for count in counts:
+		game = multiball.build_multiball(width, height, count, seed=0, offscreen=True)
+		step_samples = []
+		draw_samples = []
+		pairs = 0
+		for _ in range(ticks):
+			start = perf_counter_ns()
+			game.step()
+			stepped = perf_counter_ns()
+			game.draw()
+			draw_samples.append(perf_counter_ns() - stepped)
+			step_samples.append(stepped - start)
+			pairs += game.candidate_pairs
+		results[count] = {"step": _stats(step_samples), "draw": _stats(draw_samples),
+						  "candidate_pairs": round(pairs / ticks, 1),
+						  "all_pairs": count * (count - 1) // 2}
+	return results
+
+
+# Cost per tick of keeping a rollback window: a headless tick, a snapshot
+# into the ring, and a restore of a tick of the window
+def bench_snapshot(ticks: int, capacity: int = 128) -> dict:
+	game = pong.build_game(320, 240, pong.rgb_colors["lightgrey"], "player", max_score=1000000,
+						   headless=True, seed=0, aim_error=20)
+	ring = pong.SnapshotRing(game, capacity)
+	step_samples = []
+	save_samples = []
+	restore_samples = []
+	for _ in range(ticks):
+		start = perf_counter_ns()
+		game.run_game_once()
+		stepped = perf_counter_ns()
+		ring.save()
+		saved = perf_counter_ns()
+		step_samples.append(stepped - start)
+		save_samples.append(saved - stepped)
+	last_tick = game._tick
+	for index in range(ticks):
+		start = perf_counter_ns()
+		ring.restore(last_tick - index % capacity)
+		restore_samples.append(perf_counter_ns() - start)
+	return {"tick": _stats(step_samples), "save": _stats(save_samples), "restore": _stats(restore_samples),
+			"snapshot_bytes": pong.SNAPSHOT_SIZE, "ring_bytes": pong.SNAPSHOT_SIZE * capacity}
+
+
+# List every benchmark whose p50 latency grew by more than tolerance (0.5 = +50%)
+# and by more than min_delta_us, so that timer noise on tiny phases is ignored.
+# When both runs have the reference benchmark and this machine or session is
+# slower, the baseline is first scaled up by as much. It is never scaled
+# down, a lucky fast reference run would make the check stricter
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_us: float = 20) -> list:
+	scale = 1
+	reference = results.get(REFERENCE, {}).get("headless_ticks")
+	base_reference = baseline.get(REFERENCE, {}).get("headless_ticks")
+	if reference and base_reference and base_reference["p50_us"]:
+		scale = max(1, reference["p50_us"] / base_reference["p50_us"])
+	regressions = []
+	for size, benchmarks in results.items():
+		if size == REFERENCE:
+			continue
+		for name, stats in benchmarks.items():
+			base = baseline.get(size, {}).get(name)
+			if not base or not base["p50_us"]:
+				continue
+			expected = base["p50_us"] * scale
+			ratio = stats["p50_us"] / expected
+			if ratio > 1 + tolerance and stats["p50_us"] - expected > min_delta_us:
+				regressions.append(f"{size} {name}: p50 {stats['p50_us']}us vs baseline {expected:.2f}us "
+								   f"(x{ratio:.2f}, baseline scaled x{scale:.2f})")
+	return regressions
+
+
+def _print_results(results: dict) -> None:
+	for size, benchmarks in results.items():
+		print(size)
+		for name, stats in benchmarks.items():
+			print(f"  {name:<18} {stats['ticks_per_sec']:>12.1f} ticks/s  p50 {stats['p50_us']:>9.2f}us  p99 {stats['p99_us']:>9.2f}us")
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Pong per-frame benchmarks')
+	parser.add_argument('-f', '--frames', type=int, default=2000, help='Frames per benchmark (dflt 2000)')
+	parser.add_argument('-s', '--sizes', nargs='+', default=DEFAULT_SIZES, help='Display sizes as WxH')
+	parser.add_argument('-o', '--output', type=str, default='bench_results.json', help='JSON results file (dflt bench_results.json)')
+	parser.add_argument('-b', '--baseline', type=str, default=BASELINE_FILE, help='Baseline JSON to compare against')
+	parser.add_argument('-t', '--tolerance', type=float, default=0.5, help='Allowed p50 slowdown before failing (dflt 0.5 = +50%%)')
+	parser.add_argument('--min-delta', type=float, default=20, help='Ignore p50 slowdowns smaller than this, in us (dflt 20)')
+	parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+	parser.add_argument('--multiball', type=int, nargs='+', default=None, metavar='BALLS',
+						help='Only run the multi-ball stress test with these ball counts')
+	parser.add_argument('--snapshot', action='store_true', help='Only time game snapshots and restores, with --frames ticks')
+	args = parser.parse_args()
+
+	pong.pong_log.setLevel(logging.CRITICAL + 1)
+	if args.multiball:
+		for count, stats in bench_multiball(args.multiball, args.frames).items():
+			print(f"{count:>6} balls  step p50 {stats['step']['p50_us']:>9.2f}us  draw p50 {stats['draw']['p50_us']:>9.2f}us"
+				  f"  pairs {stats['candidate_pairs']:>9.1f} of {stats['all_pairs']}")
+		return
+	if args.snapshot:
+		results = bench_snapshot(args.frames)
+		for name in ("tick", "save", "restore"):
+			print(f"{name:<8} p50 {results[name]['p50_us']:>7.2f}us  p99 {results[name]['p99_us']:>7.2f}us")
+		print(f"{results['snapshot_bytes']} bytes per snapshot, {results['ring_bytes']} bytes per ring")
+		return
+	results = run_benchmarks(args.sizes, args.frames)
+	_print_results(results)
+	with open(args.output, "w") as output_file:
+		json.dump(results, output_file, indent=2)
+
+	if args.update_baseline:
+		with open(args.baseline, "w") as baseline_file:
+			json.dump(results, baseline_file, indent=2)
+		print(f"Baseline written to {args.baseline}")
+		return
+	if not os.path.exists(args.baseline):
+		print(f"No baseline at {args.baseline}, run with --update-baseline")
+		return
+	with open(args.baseline) as baseline_file:
+		regressions = compare(results, json.load(baseline_file), args.tolerance, args.min_delta)
+	if regressions:
+		print("Performance regressions:")
+		for regression in regressions:
+			print(f"  {regression}")
+		sys.exit(1)
+	print("No regression against baseline")
+
+if __name__ == '__main__':
+	main()
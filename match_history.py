@@ -0,0 +1,162 @@
+import argparse
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+history_file = "pong_history.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS matches (
+	id INTEGER PRIMARY KEY,
+	finished_at REAL NOT NULL,
+	player TEXT NOT NULL,
+	winner TEXT NOT NULL,
+	player_score INTEGER NOT NULL,
+	cpu_score INTEGER NOT NULL,
+	level INTEGER NOT NULL,
+	ticks INTEGER NOT NULL,
+	duration_s REAL NOT NULL,
+	config TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS matches_by_time ON matches (finished_at);
+CREATE INDEX IF NOT EXISTS matches_by_player ON matches (player, finished_at);
+"""
+
+_INSERT = ("INSERT INTO matches (finished_at, player, winner, player_score, cpu_score, level, ticks, duration_s, config) "
+		   "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+# Wins, matches and best level per player, most wins first
+LEADERBOARD_QUERY = ("SELECT player, SUM(winner = 'player') AS wins, COUNT(*) AS matches, MAX(level) AS best_level, "
+					 "MAX(finished_at) AS last_played FROM matches GROUP BY player "
+					 "ORDER BY wins DESC, matches ASC LIMIT ?")
+RECENT_QUERY = "SELECT * FROM matches ORDER BY finished_at DESC LIMIT ?"
+PLAYER_RECENT_QUERY = "SELECT * FROM matches WHERE player = ? ORDER BY finished_at DESC LIMIT ?"
+
+
+def connect(path: str) -> sqlite3.Connection:
+	connection = sqlite3.connect(path)
+	connection.row_factory = sqlite3.Row
+	# WAL: readers are not blocked by the writer thread, and a commit does
+	# not wait for the disk at every batch
+	connection.execute("PRAGMA journal_mode=WAL")
+	connection.execute("PRAGMA synchronous=NORMAL")
+	connection.executescript(_SCHEMA)
+	return connection
+
+
+# Appends finished matches to the SQLite store on its own thread. record()
+# only queues a row, the thread writes up to batch_size rows per transaction,
+# a partial batch once it is flush_interval seconds old
+class MatchHistory(threading.Thread):
+	def __init__(self, path: str = history_file, batch_size: int = 64, flush_interval: float = 1.0) -> None:
+		super().__init__(name="pong-history", daemon=True)
+		self.path = path
+		self._batch_size = batch_size
+		self._flush_interval = flush_interval
+		self._queue = queue.Queue()
+		# The schema is created before the first record() returns
+		connect(path).close()
+		self.matches_written = 0
+		self.batches = 0
+		self.start()
+
+	# Queue a finished match: player name, PongGame.get_result() and the
+	# match length in game time
+	def record(self, player: str, result: dict, duration_s: float, config: dict = None) -> None:
+		self._queue.put((time.time(), player, result["winner"], result["player_score"], result["cpu_score"],
+						 result["level"], result["ticks"], duration_s, json.dumps(config if config else {})))
+
+	def record_game(self, game, config: dict = None) -> None:
+		self.record(game._player.name, game.get_result(), game._tick * game._period, config)
+
+	def _write(self, connection: sqlite3.Connection, batch: list) -> None:
+		if batch:
+			with connection:
+				connection.executemany(_INSERT, batch)
+			self.matches_written += len(batch)
+			self.batches += 1
+
+	def run(self) -> None:
+		connection = connect(self.path)
+		running = True
+		while running:
+			batch = []
+			item = self._queue.get()
+			deadline = time.monotonic() + self._flush_interval
+			# Rows queue up until the batch is full, the deadline has passed,
+			# or a flush (Event) or the end (None) is asked for
+			while isinstance(item, tuple):
+				batch.append(item)
+				if len(batch) >= self._batch_size:
+					item = False
+					break
+				try:
+					item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+				except queue.Empty:
+					item = False
+			self._write(connection, batch)
+			if isinstance(item, threading.Event):
+				item.set()
+			running = item is not None
+		connection.close()
+
+	# Wait until every match recorded so far is written
+	def flush(self) -> None:
+		done = threading.Event()
+		self._queue.put(done)
+		done.wait()
+
+	def close(self) -> None:
+		self._queue.put(None)
+		self.join()
+
+
+def leaderboard(connection: sqlite3.Connection, limit: int = 10) -> list:
+	return [dict(row) for row in connection.execute(LEADERBOARD_QUERY, (limit,))]
+
+
+def recent_matches(connection: sqlite3.Connection, limit: int = 10, player: str = None) -> list:
+	if player is None:
+		rows = connection.execute(RECENT_QUERY, (limit,))
+	else:
+		rows = connection.execute(PLAYER_RECENT_QUERY, (player, limit))
+	return [dict(row) for row in rows]
+
+
+def _print_rows(rows: list, columns: list) -> None:
+	print("  ".join(f"{column:>12}" for column in columns))
+	for row in rows:
+		values = []
+		for column in columns:
+			value = row[column]
+			if column in ("finished_at", "last_played"):
+				value = time.strftime("%Y-%m-%d %H:%M", time.localtime(value))
+			elif isinstance(value, float):
+				value = f"{value:.1f}"
+			values.append(f"{value:>12}")
+		print("  ".join(values))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Query the Pong match history')
+	parser.add_argument('--db', type=str, default=history_file, help=f'History database (dflt {history_file})')
+	subparsers = parser.add_subparsers(dest='query', required=True)
+	leaderboard_parser = subparsers.add_parser('leaderboard', help='Players with the most wins')
+	leaderboard_parser.add_argument('-l', '--limit', type=int, default=10, help='Rows to show (dflt 10)')
+	recent_parser = subparsers.add_parser('recent', help='Last finished matches')
+	recent_parser.add_argument('-l', '--limit', type=int, default=10, help='Rows to show (dflt 10)')
+	recent_parser.add_argument('-p', '--player', type=str, default=None, help='Only the matches of this player')
+	args = parser.parse_args()
+
+	connection = connect(args.db)
+	if args.query == 'leaderboard':
+		_print_rows(leaderboard(connection, args.limit), ["player", "wins", "matches", "best_level", "last_played"])
+	else:
+		_print_rows(recent_matches(connection, args.limit, args.player),
+					["finished_at", "player", "winner", "player_score", "cpu_score", "level", "duration_s"])
+	connection.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,251 @@
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import asyncio
+import json
+import logging
+import time
+import tracemalloc
+from collections import deque
+
+import netplay
+import pong
+
+
+def _jitter_stats(samples: list) -> dict:
+	if not samples:
+		return {"mean_ms": None, "p99_ms": None, "max_ms": None}
+	samples = sorted(samples)
+	return {"mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+			"p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000, 3),
+			"max_ms": round(samples[-1] * 1000, 3)}
+
+
+# Hosts any number of netplay Rooms on one event loop. Clients are paired in
+# connection order, and a single scheduler task steps every running room at
+# the tick rate, instead of one loop and clock per match
+class MatchServer:
+	# When the scheduler is this many ticks late it skips them instead of
+	# running them back to back
+	_MAX_LATE_TICKS = 5
+
+	def __init__(self, width: int = 320,
+				 height: int = 240,
+				 fps: int = 120,
+				 max_score: int = 5,
+				 tick_rate: int = None,
+				 jitter_window: int = 4096) -> None:
+		self._room_config = {"width": width, "height": height, "fps": fps,
+							 "max_score": max_score, "tick_rate": tick_rate}
+		self._period = 1 / (tick_rate if tick_rate else fps)
+		self.rooms = []
+		# Room with one player, waiting for an opponent
+		self._waiting = None
+		self.rooms_created = 0
+		self.rooms_closed = 0
+		self.ticks = 0
+		# How late each tick started, and the time spent stepping rooms
+		self.jitter = deque(maxlen=jitter_window)
+		self.busy = 0.0
+		self._server = None
+		self._scheduler = None
+
+	async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+		self._server = await asyncio.start_server(self._handle_client, host, port)
+		self._scheduler = asyncio.create_task(self._schedule())
+		return self._server.sockets[0].getsockname()[1]
+
+	async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		room = self._waiting
+		if room is None:
+			# Seeded by creation order, so that a load run is reproducible
+			room = netplay.build_room(seed=self.rooms_created, **self._room_config)
+			self.rooms_created += 1
+			self._waiting = room
+		side = room.join(writer)
+		if room.full:
+			self._waiting = None
+			self.rooms.append(room)
+		await room.read_inputs(side, reader)
+		if room is self._waiting:
+			# Left before an opponent showed up
+			self._waiting = None
+			room.close()
+			self.rooms_closed += 1
+
+	def _step_rooms(self) -> None:
+		finished = False
+		for room in self.rooms:
+			room.step()
+			finished = finished or room.finished
+		if finished:
+			for room in self.rooms:
+				if room.finished:
+					room.close()
+					self.rooms_closed += 1
+			self.rooms = [room for room in self.rooms if not room.finished]
+		self.ticks += 1
+
+	async def _schedule(self) -> None:
+		loop = asyncio.get_running_loop()
+		next_tick = loop.time()
+		while True:
+			now = loop.time()
+			late = now - next_tick
+			if late > self._MAX_LATE_TICKS * self._period:
+				next_tick = now
+			self.jitter.append(late)
+			start = time.perf_counter()
+			self._step_rooms()
+			self.busy += time.perf_counter() - start
+			next_tick += self._period
+			await asyncio.sleep(max(0, next_tick - loop.time()))
+
+	def stats(self) -> dict:
+		return {"rooms": len(self.rooms),
+				"rooms_created": self.rooms_created,
+				"rooms_closed": self.rooms_closed,
+				"ticks": self.ticks,
+				"busy_s": round(self.busy, 4),
+				"jitter": _jitter_stats(list(self.jitter))}
+
+	async def close(self) -> None:
+		if self._scheduler:
+			self._scheduler.cancel()
+			try:
+				await self._scheduler
+			except asyncio.CancelledError:
+				pass
+		for room in self.rooms:
+			room.close()
+		if self._waiting:
+			self._waiting.close()
+		self._server.close()
+		await self._server.wait_closed()
+
+
+# Bytes allocated per room, game objects and queues, without the sockets
+def measure_room_memory(rooms: int = 100, **room_config) -> float:
+	tracing = tracemalloc.is_tracing()
+	if not tracing:
+		tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	built = [netplay.build_room(seed=seed, **room_config) for seed in range(rooms)]
+	used = tracemalloc.get_traced_memory()[0] - before
+	if not tracing:
+		tracemalloc.stop()
+	del built
+	return used / rooms
+
+
+# Simulated players: every client follows the ball with its paddle and asks
+# for a serve, all driven from one task at the tick rate
+async def _drive_clients(clients: list, period: float, dead_zone: int = 5) -> None:
+	while True:
+		for client in clients:
+			state = client.state
+			direction = 0
+			if state is not None:
+				diff = state.ball_y - (client.predicted_y + client._paddle.high // 2)
+				direction = -1 if diff < -dead_zone else 1 if diff > dead_zone else 0
+			client.send_input(direction, serve=True)
+		await asyncio.sleep(period)
+
+
+# Start a MatchServer and 2 * rooms simulated clients in this process, play
+# for `seconds` and report the server load. The clients share the event loop,
+# so the jitter is an upper bound; rooms_per_core only counts room stepping
+async def run_load(rooms: int, seconds: float, tick_rate: int = 120,
+				   max_score: int = 1000, connect_batch: int = 50) -> dict:
+	server = MatchServer(max_score=max_score, tick_rate=tick_rate)
+	port = await server.start()
+	clients = [netplay.NetClient() for _ in range(2 * rooms)]
+	# Batches stay under the listen backlog
+	for first in range(0, len(clients), connect_batch):
+		await asyncio.gather(*(client.connect("127.0.0.1", port)
+							   for client in clients[first:first + connect_batch]))
+	driver = asyncio.create_task(_drive_clients(clients, 1 / tick_rate))
+	server.jitter.clear()
+	server.busy = 0.0
+	start_ticks = server.ticks
+	start_cpu = time.process_time()
+	start = time.perf_counter()
+	await asyncio.sleep(seconds)
+	wall = time.perf_counter() - start
+	cpu = time.process_time() - start_cpu
+	stats = server.stats()
+	driver.cancel()
+	for client in clients:
+		client._writer.close()
+	await server.close()
+	await asyncio.gather(*(client.wait_game_over() for client in clients))
+	busy = stats["busy_s"] / wall
+	return {"rooms": stats["rooms"],
+			"tick_rate": tick_rate,
+			"ticks_per_sec": round((stats["ticks"] - start_ticks) / wall, 1),
+			"server_busy": round(busy, 4),
+			"rooms_per_core": round(stats["rooms"] / busy) if busy else None,
+			"process_cpu": round(cpu / wall, 4),
+			"jitter": stats["jitter"],
+			"memory_per_room_bytes": round(measure_room_memory(min(rooms, 100), max_score=max_score,
+															   tick_rate=tick_rate))}
+
+
+# Simulated clients only, against a server in another process
+async def run_clients(host: str, port: int, count: int, seconds: float, tick_rate: int = 120,
+					  connect_batch: int = 50) -> None:
+	clients = [netplay.NetClient() for _ in range(count)]
+	for first in range(0, count, connect_batch):
+		await asyncio.gather(*(client.connect(host, port) for client in clients[first:first + connect_batch]))
+	driver = asyncio.create_task(_drive_clients(clients, 1 / tick_rate))
+	await asyncio.sleep(seconds)
+	driver.cancel()
+	for client in clients:
+		client._writer.close()
+
+
+async def _serve(args) -> None:
+	server = MatchServer(args.width, args.height, max_score=args.max_score, tick_rate=args.tick_rate)
+	port = await server.start(args.host, args.port)
+	print(f"Match server listening on {args.host}:{port}")
+	start = time.perf_counter()
+	while True:
+		await asyncio.sleep(10)
+		stats = server.stats()
+		busy = stats["busy_s"] / (time.perf_counter() - start)
+		stats["rooms_per_core"] = round(stats["rooms"] / busy) if busy else None
+		print(json.dumps(stats))
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Pong multi-room match server')
+	subparsers = parser.add_subparsers(dest='mode', required=True)
+	server_parser = subparsers.add_parser('server', help='Host rooms for netplay clients')
+	server_parser.add_argument('--host', type=str, default='127.0.0.1', help='Listen address (dflt 127.0.0.1)')
+	server_parser.add_argument('-p', '--port', type=int, default=5555, help='Listen port (dflt 5555)')
+	server_parser.add_argument('-dw', '--width', type=int, default=640, help='Display width (dflt 640)')
+	server_parser.add_argument('-dh', '--height', type=int, default=480, help='Display height (dflt 480)')
+	server_parser.add_argument('--max_score', type=int, default=5, help='Points to win (dflt 5)')
+	server_parser.add_argument('--tick-rate', type=int, default=None, help='Ticks per second (dflt 120)')
+	load_parser = subparsers.add_parser('load', help='Measure the server with simulated clients')
+	load_parser.add_argument('-r', '--rooms', type=int, default=200, help='Concurrent rooms (dflt 200), each uses 4 sockets')
+	load_parser.add_argument('-s', '--seconds', type=float, default=10, help='Duration (dflt 10)')
+	load_parser.add_argument('--tick-rate', type=int, default=120, help='Ticks per second (dflt 120)')
+	clients_parser = subparsers.add_parser('clients', help='Only run simulated clients against a server')
+	clients_parser.add_argument('--host', type=str, default='127.0.0.1', help='Server address (dflt 127.0.0.1)')
+	clients_parser.add_argument('-p', '--port', type=int, default=5555, help='Server port (dflt 5555)')
+	clients_parser.add_argument('-c', '--count', type=int, default=400, help='Clients, two per room (dflt 400)')
+	clients_parser.add_argument('-s', '--seconds', type=float, default=60, help='Duration (dflt 60)')
+	clients_parser.add_argument('--tick-rate', type=int, default=120, help='Inputs per second (dflt 120)')
+	args = parser.parse_args()
+
+	pong.pong_log.setLevel(logging.CRITICAL + 1)
+	if args.mode == 'server':
+		asyncio.run(_serve(args))
+	elif args.mode == 'clients':
+		asyncio.run(run_clients(args.host, args.port, args.count, args.seconds, args.tick_rate))
+	else:
+		print(json.dumps(asyncio.run(run_load(args.rooms, args.seconds, args.tick_rate)), indent=2))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,266 @@
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import math
+import random
+
+import pygame
+import pong
+
+# Forward neighbours of a cell: with the cell itself, every pair of
+# adjacent cells is visited once
+_NEIGHBOURS = ((1, 0), (-1, 1), (0, 1), (1, 1))
+
+
+# Uniform grid of square cells holding items by point. With a cell at least
+# as large as the biggest object, objects can only touch objects of the same
+# or an adjacent cell
+class SpatialHash:
+	def __init__(self, cell_size: float) -> None:
+		self.cell_size = cell_size
+		self.cells = {}
+
+	def clear(self) -> None:
+		self.cells.clear()
+
+	def insert(self, item, x: float, y: float) -> None:
+		key = (int(x // self.cell_size), int(y // self.cell_size))
+		cell = self.cells.get(key)
+		if cell is None:
+			self.cells[key] = [item]
+		else:
+			cell.append(item)
+
+	# Items in the cells overlapped by rect
+	def query(self, rect: pygame.Rect) -> list:
+		size = self.cell_size
+		items = []
+		for cell_x in range(int(rect.left // size), int(rect.right // size) + 1):
+			for cell_y in range(int(rect.top // size), int(rect.bottom // size) + 1):
+				cell = self.cells.get((cell_x, cell_y))
+				if cell:
+					items.extend(cell)
+		return items
+
+	# Candidate pairs: items of the same cell, or of adjacent cells
+	def pairs(self) -> list:
+		cells = self.cells
+		pairs = []
+		for (cell_x, cell_y), cell in cells.items():
+			count = len(cell)
+			for first in range(count - 1):
+				for second in range(first + 1, count):
+					pairs.append((cell[first], cell[second]))
+			for offset_x, offset_y in _NEIGHBOURS:
+				other = cells.get((cell_x + offset_x, cell_y + offset_y))
+				if other:
+					for item in cell:
+						for other_item in other:
+							pairs.append((item, other_item))
+		return pairs
+
+
+# Draws a ball with a prerendered image, so that a sprite Group blits every
+# ball in a single call
+class BallSprite(pygame.sprite.Sprite):
+	def __init__(self, ball: pong.Ball, image: pygame.Surface) -> None:
+		super().__init__()
+		self.ball = ball
+		self.image = image
+		self.rect = image.get_rect()
+
+
+# Pong with any number of balls and of paddles per side. Balls bounce off
+# each other (elastic, same mass), candidates coming from a SpatialHash
+# rebuilt every tick. A ball out on one side scores for the other one and
+# is served again from the middle line. Paddles follow the nearest ball
+# heading their way
+class MultiBallGame:
+	def __init__(self, game_field: pong.GameField,
+				 balls: int,
+				 paddles_per_side: int = 1,
+				 fps: int = 120,
+				 radius: int = 5,
+				 color: tuple = pong.rgb_colors["lightgrey"],
+				 seed: int = None,
+				 headless: bool = False) -> None:
+		self._game_field = game_field
+		self._headless = headless
+		self._rng = random.Random(seed)
+		self._radius = radius
+		width = game_field.disp_w
+		height = game_field.disp_h
+		self._speed_x = width / (3 * fps)
+		self._speed_y = height / (3 * fps)
+		self._paddle_speed = height / (0.5 * fps)
+		self.balls = []
+		for _ in range(balls):
+			ball = pong.Ball(self._rng.uniform(radius, width - radius), self._rng.uniform(radius, height - radius),
+							 radius, color, width, height)
+			self._serve(ball, center=False)
+			self.balls.append(ball)
+		# Paddles of each side stand 30 pixels apart, the first ones where
+		# build_game puts them
+		self.left_paddles = [pong.Gamer(20 + 30 * index, height / 2 - 40, 10, 40, color, "CPU", width, height)
+							 for index in range(paddles_per_side)]
+		self.right_paddles = [pong.Gamer(width - 30 - 30 * index, height / 2 - 40, 10, 40, color, "CPU", width, height)
+							  for index in range(paddles_per_side)]
+		self._grid = SpatialHash(2 * radius)
+		self.stat = {"left_score": 0, "right_score": 0}
+		self.tick = 0
+		# Candidate pairs of the last tick, and the pairs that collided
+		self.candidate_pairs = 0
+		self.ball_hits = 0
+		self._group = None
+		self._text_cache = None
+		if not headless:
+			image = pygame.Surface((2 * radius, 2 * radius), pygame.SRCALPHA)
+			pygame.draw.circle(image, color, (radius, radius), radius)
+			self._group = pygame.sprite.Group([BallSprite(ball, image) for ball in self.balls])
+			pygame.font.init()
+			self._text_cache = pong.TextCache(pong.load_font("freemono", 50))
+
+	def _serve(self, ball: pong.Ball, center: bool = True) -> None:
+		# Anywhere on the middle line: balls served at one point would pile up
+		if center:
+			ball.set_pos(self._game_field.disp_w / 2,
+						 self._rng.uniform(self._radius, self._game_field.disp_h - self._radius))
+		ball.speed_x = self._speed_x * self._rng.choice((-1, 1))
+		ball.speed_y = self._speed_y * self._rng.uniform(-1, 1)
+
+	def _move_balls(self) -> None:
+		width = self._game_field.disp_w
+		height = self._game_field.disp_h
+		radius = self._radius
+		grid = self._grid
+		grid.clear()
+		for ball in self.balls:
+			ball.center_x += ball.speed_x
+			ball.center_y += ball.speed_y
+			y = ball.center_y
+			if (y - radius <= 0 and ball.speed_y < 0) or (y + radius >= height and ball.speed_y > 0):
+				ball.speed_y = -ball.speed_y
+			x = ball.center_x
+			if x + radius < 0:
+				self.stat["right_score"] += 1
+				self._serve(ball)
+			elif x - radius > width:
+				self.stat["left_score"] += 1
+				self._serve(ball)
+			grid.insert(ball, ball.center_x, ball.center_y)
+
+	def _collide_paddles(self) -> None:
+		radius = self._radius
+		for paddles, direction in ((self.left_paddles, -1), (self.right_paddles, 1)):
+			for paddle in paddles:
+				rect = paddle.rect
+				for ball in self._grid.query(rect.inflate(2 * radius, 2 * radius)):
+					# Only balls heading into the paddle bounce, a ball that
+					# got behind it goes on
+					if ball.speed_x * direction <= 0:
+						continue
+					closest_x = min(max(ball.center_x, rect.left), rect.right)
+					closest_y = min(max(ball.center_y, rect.top), rect.bottom)
+					if (ball.center_x - closest_x) ** 2 + (ball.center_y - closest_y) ** 2 <= radius * radius:
+						ball.speed_x = -ball.speed_x
+
+	def _collide_balls(self) -> None:
+		pairs = self._grid.pairs()
+		self.candidate_pairs = len(pairs)
+		min_dist_sq = (2 * self._radius) ** 2
+		for first, second in pairs:
+			dx = second.center_x - first.center_x
+			dy = second.center_y - first.center_y
+			dist_sq = dx * dx + dy * dy
+			if dist_sq > min_dist_sq or dist_sq == 0:
+				continue
+			# Relative speed along the line of centers, < 0 when approaching
+			rel_x = second.speed_x - first.speed_x
+			rel_y = second.speed_y - first.speed_y
+			closing = (rel_x * dx + rel_y * dy) / dist_sq
+			if closing >= 0:
+				continue
+			# Equal masses: exchange the speed components along that line
+			first.speed_x += closing * dx
+			first.speed_y += closing * dy
+			second.speed_x -= closing * dx
+			second.speed_y -= closing * dy
+			self.ball_hits += 1
+
+	def _move_paddles(self) -> None:
+		for paddles, direction in ((self.left_paddles, -1), (self.right_paddles, 1)):
+			for paddle in paddles:
+				paddle_x = paddle.rect.centerx
+				target = None
+				best = math.inf
+				for ball in self.balls:
+					if ball.speed_x * direction > 0:
+						distance = (paddle_x - ball.center_x) * direction
+						if 0 <= distance < best:
+							best = distance
+							target = ball
+				paddle.speed_y = 0
+				if target is not None:
+					diff = target.center_y - paddle.rect.centery
+					paddle.speed_y = max(-self._paddle_speed, min(self._paddle_speed, diff))
+				paddle.update_pos()
+
+	def step(self) -> None:
+		self._move_paddles()
+		self._move_balls()
+		self._collide_paddles()
+		self._collide_balls()
+		self.tick += 1
+
+	def draw(self) -> None:
+		screen = self._game_field.get_screen()
+		self._game_field.fill_screen()
+		self._game_field.draw_borders()
+		for sprite in self._group:
+			sprite.rect.center = (sprite.ball.center_x, sprite.ball.center_y)
+		self._group.draw(screen)
+		for paddle in self.left_paddles + self.right_paddles:
+			paddle.draw(screen)
+		score = self._text_cache.render(f'{self.stat["left_score"]}    {self.stat["right_score"]}',
+										self._game_field.line_color)
+		screen.blit(score, ((self._game_field.disp_w - score.get_width()) / 2, 10))
+
+
+def build_multiball(screen_width: int,
+					screen_height: int,
+					balls: int,
+					paddles_per_side: int = 1,
+					fps: int = 120,
+					color: tuple = pong.rgb_colors["lightgrey"],
+					seed: int = None,
+					headless: bool = False,
+					offscreen: bool = False) -> MultiBallGame:
+	game_field = pong.GameField(screen_width, screen_height, "black", color, "Pong multi-ball",
+								headless=headless, offscreen=offscreen)
+	return MultiBallGame(game_field, balls, paddles_per_side, fps=fps, color=color, seed=seed,
+						 headless=headless)
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Pong with many balls')
+	parser.add_argument('-b', '--balls', type=int, default=100, help='Number of balls (dflt 100)')
+	parser.add_argument('-p', '--paddles', type=int, default=1, help='Paddles per side (dflt 1)')
+	parser.add_argument('-dw', '--width', type=int, default=960, help='Width of the display (dflt 960)')
+	parser.add_argument('-dh', '--height', type=int, default=720, help='Height of the display (dflt 720)')
+	parser.add_argument('--fps', type=int, default=120, help='Framerate (dflt 120)')
+	parser.add_argument('--seed', type=int, default=None, help='Random seed')
+	args = parser.parse_args()
+
+	pygame.display.init()
+	game = build_multiball(args.width, args.height, args.balls, args.paddles, fps=args.fps, seed=args.seed)
+	clock = pygame.time.Clock()
+	while not pygame.event.peek(pygame.QUIT):
+		pygame.event.pump()
+		game.step()
+		game.draw()
+		pygame.display.flip()
+		clock.tick(args.fps)
+	pygame.quit()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,398 @@
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import asyncio
+import logging
+import struct
+from collections import deque, namedtuple
+
+import pygame
+import pong
+import spectator
+
+# Sides, as sent in HELLO: the left paddle is PongGame's computer, the
+# right one its player
+LEFT = 0
+RIGHT = 1
+
+# Fixed size little endian messages, the first byte is the message type.
+# HELLO (server): side, display width and height, paddle high, tick rate, paddle speed
+# INPUT (client): input sequence number, direction (-1 up, 0 stop, 1 down), serve
+# STATE (server): tick, last INPUT seq applied for this client, ball center,
+#                 left and right paddle tops, left and right scores, flags
+_HELLO = struct.Struct("<BBHHHHf")
+_INPUT = struct.Struct("<BIbB")
+_STATE = struct.Struct("<BIIffhhHHB")
+_MSG_HELLO = 1
+_MSG_INPUT = 2
+_MSG_STATE = 3
+_FLAG_GAME_OVER = 1
+
+NetState = namedtuple("NetState", ["tick", "ack_seq", "ball_x", "ball_y", "left_y", "right_y",
+								   "left_score", "right_score", "game_over"])
+
+
+# PongGame driven by two remote clients instead of the CPU and the keyboard
+class NetPongGame(pong.PongGame):
+	def __init__(self, *args, **kwargs) -> None:
+		super().__init__(*args, **kwargs)
+		# Last direction received from each side, and a pending serve request
+		self.directions = [0, 0]
+		self.serve_requested = False
+
+	def _move_computer(self):
+		self._computer.speed_y = self.directions[LEFT] * self._player_speed
+
+	def _update_events(self):
+		self._check_end_game()
+		if self._game_over:
+			return
+		if self.serve_requested:
+			self.serve_requested = False
+			self._serve()
+		self._player.speed_y = self.directions[RIGHT] * self._player_speed
+
+
+# Server side of one match: the authoritative game and its two clients.
+# Every step applies at most one queued input per client, steps the game and
+# sends each client the new state with the seq of its last applied input
+class Room:
+	# Inputs queued beyond this are dropped, oldest first, so that a client
+	# sending faster than the tick rate can not build up lag
+	_MAX_BACKLOG = 8
+
+	def __init__(self, game: NetPongGame, tick_rate: int) -> None:
+		self.game = game
+		self._tick_rate = tick_rate
+		self._writers = [None, None]
+		self._inputs = [deque(), deque()]
+		self._acks = [0, 0]
+		self.abandoned = False
+		# Optional spectator.SpectatorFeed, published after every step
+		self.feed = None
+
+	@property
+	def full(self) -> bool:
+		return None not in self._writers
+
+	# A finished room is never stepped again
+	@property
+	def finished(self) -> bool:
+		return self.game._game_over or self.abandoned
+
+	def join(self, writer: asyncio.StreamWriter) -> int:
+		side = self._writers.index(None)
+		self._writers[side] = writer
+		game = self.game
+		writer.write(_HELLO.pack(_MSG_HELLO, side, game._game_field.disp_w, game._game_field.disp_h,
+								 game._player.high, self._tick_rate, game._player_speed))
+		return side
+
+	# Queue the INPUT messages of one client until it disconnects. A player
+	# leaving ends the match
+	async def read_inputs(self, side: int, reader: asyncio.StreamReader) -> None:
+		inputs = self._inputs[side]
+		try:
+			while True:
+				_, seq, direction, serve = _INPUT.unpack(await reader.readexactly(_INPUT.size))
+				inputs.append((seq, max(-1, min(1, direction)), serve))
+				if len(inputs) > self._MAX_BACKLOG:
+					_, _, dropped_serve = inputs.popleft()
+					self.game.serve_requested |= bool(dropped_serve)
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		self.abandoned = True
+
+	def _apply_inputs(self) -> None:
+		for side in (LEFT, RIGHT):
+			if self._inputs[side]:
+				seq, direction, serve = self._inputs[side].popleft()
+				self._acks[side] = seq
+				self.game.directions[side] = direction
+				self.game.serve_requested |= bool(serve)
+
+	def _send_state(self) -> None:
+		game = self.game
+		flags = _FLAG_GAME_OVER if game._game_over else 0
+		for side, writer in enumerate(self._writers):
+			if writer is None or writer.is_closing():
+				continue
+			writer.write(_STATE.pack(_MSG_STATE, game._tick, self._acks[side],
+									 game._ball.center_x, game._ball.center_y,
+									 game._computer.rect.y, game._player.rect.y,
+									 game._stat["cpu_score"], game._stat["player_score"], flags))
+
+	def step(self) -> None:
+		self._apply_inputs()
+		self.game.run_game_once()
+		self._send_state()
+		if self.feed:
+			self.feed.publish()
+
+	def close(self) -> None:
+		for writer in self._writers:
+			if writer is not None:
+				writer.close()
+
+
+def build_room(width: int = 320,
+			   height: int = 240,
+			   fps: int = 120,
+			   max_score: int = 5,
+			   seed: int = None,
+			   tick_rate: int = None) -> Room:
+	game = pong.build_game(width, height, pong.rgb_colors["lightgrey"], "player",
+						   fps=fps, max_score=max_score, headless=True, seed=seed,
+						   game_class=NetPongGame)
+	# The game speeds are per tick of fps, tick_rate only sets the pace
+	return Room(game, tick_rate if tick_rate else fps)
+
+
+# Hosts a single Room, stepped at a fixed tick rate once both players joined
+class NetServer:
+	def __init__(self, width: int = 320,
+				 height: int = 240,
+				 fps: int = 120,
+				 max_score: int = 5,
+				 seed: int = None,
+				 tick_rate: int = None) -> None:
+		self.room = build_room(width, height, fps, max_score, seed, tick_rate)
+		self.game = self.room.game
+		self._period = 1 / (tick_rate if tick_rate else fps)
+		self._server = None
+		self._loop_task = None
+		self.finished = asyncio.Event()
+
+	async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+		self._server = await asyncio.start_server(self._handle_client, host, port)
+		return self._server.sockets[0].getsockname()[1]
+
+	async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		if self.room.full:
+			writer.close()
+			return
+		side = self.room.join(writer)
+		if self.room.full:
+			self._loop_task = asyncio.create_task(self._run())
+		await self.room.read_inputs(side, reader)
+		self.finished.set()
+
+	async def _run(self) -> None:
+		loop = asyncio.get_running_loop()
+		next_tick = loop.time()
+		while not self.room.finished and not self.finished.is_set():
+			self.room.step()
+			# Sleep to the next slot, not for a whole period, so that the
+			# time spent in a tick does not slow the tick rate down
+			next_tick += self._period
+			await asyncio.sleep(max(0, next_tick - loop.time()))
+		self.finished.set()
+
+	async def close(self) -> None:
+		if self._loop_task:
+			self.finished.set()
+			await self._loop_task
+		self.room.close()
+		if self._server:
+			self._server.close()
+			await self._server.wait_closed()
+
+
+# Client side of a match. Inputs move the local paddle at once (prediction);
+# every state from the server resets it to the authoritative position and
+# replays the inputs the server has not applied yet (reconciliation)
+class NetClient:
+	def __init__(self) -> None:
+		self.side = None
+		self.state = None
+		self.game_over = False
+		self.tick_rate = None
+		# Predicted positions that did not match the server once acked
+		self.mispredictions = 0
+		self._seq = 0
+		# (seq, direction, predicted top) of the inputs not acked yet
+		self._pending = deque()
+		self._paddle = None
+		self._reader = None
+		self._writer = None
+		self._read_task = None
+
+	async def connect(self, host: str, port: int) -> None:
+		self._reader, self._writer = await asyncio.open_connection(host, port)
+		_, self.side, width, height, high, self.tick_rate, self._speed = _HELLO.unpack(
+			await self._reader.readexactly(_HELLO.size))
+		self.width = width
+		self.height = height
+		# Same paddle as the server one, so that update_pos clamps and rounds alike
+		top_x = 20 if self.side == LEFT else width - 30
+		self._paddle = pong.Gamer(top_x, height / 2 - 40, 10, high, pong.rgb_colors["lightgrey"],
+								  "net", width, height)
+		self._read_task = asyncio.create_task(self._read_states())
+
+	@property
+	def predicted_y(self) -> int:
+		return self._paddle.rect.y
+
+	@property
+	def pending(self) -> int:
+		return len(self._pending)
+
+	def _step(self, direction: int) -> None:
+		self._paddle.speed_y = direction * self._speed
+		self._paddle.update_pos()
+
+	def send_input(self, direction: int, serve: bool = False) -> int:
+		self._seq += 1
+		self._writer.write(_INPUT.pack(_MSG_INPUT, self._seq, direction, serve))
+		self._step(direction)
+		self._pending.append((self._seq, direction, self._paddle.rect.y))
+		return self._seq
+
+	async def _read_states(self) -> None:
+		try:
+			while not self.game_over:
+				values = _STATE.unpack(await self._reader.readexactly(_STATE.size))
+				self._on_state(NetState(*values[1:-1], values[-1] & _FLAG_GAME_OVER != 0))
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+
+	def _on_state(self, state: NetState) -> None:
+		self.state = state
+		self.game_over = state.game_over
+		server_y = state.left_y if self.side == LEFT else state.right_y
+		while self._pending and self._pending[0][0] <= state.ack_seq:
+			seq, _, predicted_y = self._pending.popleft()
+			if seq == state.ack_seq and predicted_y != server_y:
+				self.mispredictions += 1
+		self._paddle.rect.y = server_y
+		for _, direction, _ in self._pending:
+			self._step(direction)
+
+	async def wait_game_over(self) -> None:
+		await self._read_task
+
+	async def close(self) -> None:
+		self._writer.close()
+		if self._read_task:
+			await self._read_task
+
+
+# TCP proxy that delays every chunk by `delay` seconds in both directions,
+# a stand-in for a real network when testing over loopback
+class LatencyProxy:
+	def __init__(self, target_host: str, target_port: int, delay: float) -> None:
+		self._target = (target_host, target_port)
+		self._delay = delay
+		self._server = None
+
+	async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+		self._server = await asyncio.start_server(self._handle, host, port)
+		return self._server.sockets[0].getsockname()[1]
+
+	async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		up_reader, up_writer = await asyncio.open_connection(*self._target)
+		await asyncio.gather(self._pipe(reader, up_writer), self._pipe(up_reader, writer))
+
+	async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		loop = asyncio.get_running_loop()
+		chunks = asyncio.Queue()
+
+		async def deliver():
+			while True:
+				deliver_at, data = await chunks.get()
+				await asyncio.sleep(max(0, deliver_at - loop.time()))
+				if not data:
+					writer.close()
+					return
+				writer.write(data)
+
+		delivery = asyncio.create_task(deliver())
+		while True:
+			try:
+				data = await reader.read(4096)
+			except ConnectionError:
+				data = b""
+			chunks.put_nowait((loop.time() + self._delay, data))
+			if not data:
+				break
+		await delivery
+
+	async def close(self) -> None:
+		self._server.close()
+		await self._server.wait_closed()
+
+
+async def _serve(args) -> None:
+	server = NetServer(args.width, args.height, max_score=args.max_score, seed=args.seed,
+					   tick_rate=args.tick_rate)
+	port = await server.start(args.host, args.port)
+	print(f"Server listening on {args.host}:{port}")
+	if args.latency:
+		proxy = LatencyProxy(args.host, port, args.latency / 1000)
+		print(f"Proxy with {args.latency}ms latency on {args.host}:{await proxy.start(args.host)}")
+	if args.spectate_port is not None:
+		server.room.feed = spectator.SpectatorFeed(server.game)
+		spectators = spectator.SpectatorServer(server.room.feed)
+		print(f"Spectator feed on {args.host}:{await spectators.start(args.host, args.spectate_port)}")
+	await server.finished.wait()
+	print(f"Match over: {server.game.get_result()}")
+	if server.room.feed:
+		print(f"Spectator feed: {server.room.feed.stats()}")
+	await server.close()
+
+
+async def _play(args) -> None:
+	client = NetClient()
+	await client.connect(args.host, args.port)
+	pygame.display.init()
+	pygame.font.init()
+	screen = pygame.display.set_mode((client.width, client.height))
+	pygame.display.set_caption(f"Pong - {'left' if client.side == LEFT else 'right'} side")
+	font = pong.load_font("freemono", 50)
+	color = pong.rgb_colors["lightgrey"]
+	period = 1 / client.tick_rate
+	while not client.game_over:
+		if pygame.event.peek(pygame.QUIT):
+			break
+		pygame.event.pump()
+		keys = pygame.key.get_pressed()
+		client.send_input(keys[pygame.K_DOWN] - keys[pygame.K_UP], keys[pygame.K_SPACE])
+		screen.fill(pong.rgb_colors["black"])
+		state = client.state
+		if state:
+			left_y = client.predicted_y if client.side == LEFT else state.left_y
+			right_y = client.predicted_y if client.side == RIGHT else state.right_y
+			pygame.draw.rect(screen, color, (20, left_y, 10, client._paddle.high))
+			pygame.draw.rect(screen, color, (client.width - 30, right_y, 10, client._paddle.high))
+			pygame.draw.circle(screen, color, (state.ball_x, state.ball_y), 5)
+			score = font.render(f"{state.left_score} : {state.right_score}", True, color)
+			screen.blit(score, (client.width / 2 - score.get_width() / 2, 0))
+		pygame.display.flip()
+		await asyncio.sleep(period)
+	await client.close()
+	pygame.quit()
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Networked two player Pong')
+	subparsers = parser.add_subparsers(dest='mode', required=True)
+	server_parser = subparsers.add_parser('server', help='Run the authoritative game server')
+	server_parser.add_argument('--host', type=str, default='127.0.0.1', help='Listen address (dflt 127.0.0.1)')
+	server_parser.add_argument('-p', '--port', type=int, default=5555, help='Listen port (dflt 5555)')
+	server_parser.add_argument('-dw', '--width', type=int, default=640, help='Display width (dflt 640)')
+	server_parser.add_argument('-dh', '--height', type=int, default=480, help='Display height (dflt 480)')
+	server_parser.add_argument('--max_score', type=int, default=5, help='Points to win (dflt 5)')
+	server_parser.add_argument('--seed', type=int, default=None, help='Seed of the game RNG')
+	server_parser.add_argument('--tick-rate', type=int, default=None, help='Ticks per second (dflt 120)')
+	server_parser.add_argument('--latency', type=int, default=0, help='Also open a proxy adding this many ms each way')
+	server_parser.add_argument('--spectate-port', type=int, default=None, help='Also stream the match to spectators on this port')
+	client_parser = subparsers.add_parser('client', help='Join a game server')
+	client_parser.add_argument('--host', type=str, default='127.0.0.1', help='Server address (dflt 127.0.0.1)')
+	client_parser.add_argument('-p', '--port', type=int, default=5555, help='Server port (dflt 5555)')
+	args = parser.parse_args()
+
+	pong.pong_log.setLevel(logging.CRITICAL + 1)
+	asyncio.run(_serve(args) if args.mode == 'server' else _play(args))
+
+if __name__ == '__main__':
+	main()
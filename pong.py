@@ -1,10 +1,26 @@
 from time import sleep
+import time
+_start_time = time.perf_counter()
 import os
 import pygame
+_pygame_import_time = time.perf_counter()
 import sys
 import random
 import argparse
 import logging
+import logging.handlers
+import atexit
+import csv
+from array import array
+import json
+import mmap
+import queue
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+import itertools
+import match_history
+import profiler
 
 rgb_colors = {
 		"red": (255, 0, 0),
@@ -55,30 +71,86 @@ rgb_colors = {
 
 log_file = "pong_log.log"
 
-if os.path.exists(os.path.abspath(log_file)):
-	os.remove(os.path.abspath(log_file))
-
-# Configure main logger
+# Main logger. Handlers are only added by setup_logging(), importing pong
+# has no side effect
 pong_log = logging.getLogger("Pong logger")
 pong_log.setLevel(logging.CRITICAL)
+pong_log.addHandler(logging.NullHandler())
+
+# Compact line per game event: timestamp, level, tick, event, key=value fields
+EVENT_FORMAT = "%(created).6f %(levelname).1s %(tick)s %(event)s %(message)s"
+_log_listener = None
+
+
+# Records not sent through PongGame._log_event have no tick or event
+class _EventDefaults(logging.Filter):
+	def filter(self, record: logging.LogRecord) -> bool:
+		if not hasattr(record, "event"):
+			record.event = "-"
+		if not hasattr(record, "tick"):
+			record.tick = "-"
+		return True
+
+
+# Send pong_log to the console and to path through a background thread, so
+# that the game loop never waits for the terminal or the disk
+def setup_logging(path: str = log_file, level: int = logging.CRITICAL) -> logging.handlers.QueueListener:
+	global _log_listener
+	stop_logging()
+	console_handler = logging.StreamHandler()
+	console_handler.setLevel(logging.INFO)
+	console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(event)s %(message)s'))
+	file_handler = logging.FileHandler(path, mode="w")
+	file_handler.setLevel(logging.INFO)
+	file_handler.setFormatter(logging.Formatter(EVENT_FORMAT))
 
-# Configure console handler
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-console_handler.setLevel(logging.INFO)
+	log_queue = queue.SimpleQueue()
+	queue_handler = logging.handlers.QueueHandler(log_queue)
+	queue_handler.addFilter(_EventDefaults())
+	_log_listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler,
+												   respect_handler_level=True)
+	_log_listener.queue_handler = queue_handler
+	pong_log.addHandler(queue_handler)
+	pong_log.setLevel(level)
+	_log_listener.start()
+	atexit.register(stop_logging)
+	return _log_listener
 
-# Configure file handler
-file_handler = logging.FileHandler(log_file)
-file_handler.setLevel(logging.INFO)
 
-# Set format
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-file_handler.setFormatter(formatter)
+# Write out the queued records and close the handlers
+def stop_logging() -> None:
+	global _log_listener
+	if _log_listener is None:
+		return
+	pong_log.removeHandler(_log_listener.queue_handler)
+	_log_listener.stop()
+	for handler in _log_listener.handlers:
+		handler.close()
+	_log_listener = None
+
+FONT_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "pypong", "fonts.json")
+
+
+# Same font as pygame.font.SysFont, but the path found by scanning the system
+# fonts is kept in cache_path for the next launches. "" means pygame's default
+def load_font(name: str, size: int, cache_path: str = FONT_CACHE) -> pygame.font.Font:
+	try:
+		with open(cache_path) as cache_file:
+			cache = json.load(cache_file)
+	except (OSError, ValueError):
+		cache = {}
+	path = cache.get(name)
+	if path is None or (path and not os.path.exists(path)):
+		path = pygame.font.match_font(name) or ""
+		cache[name] = path
+		try:
+			os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+			with open(cache_path, "w") as cache_file:
+				json.dump(cache, cache_file)
+		except OSError:
+			pong_log.warning("Cannot write font cache %s", cache_path)
+	return pygame.font.Font(path or None, size)
 
-# Add handler to logger
-pong_log.addHandler(console_handler)
-pong_log.addHandler(file_handler)
 
 def get_random(limit: int):
 	num_rand = random.randint(-limit, limit)
@@ -88,6 +160,10 @@ def get_random(limit: int):
 
 
 class Ball():
+	_MAX_BOUNCES = 8
+	__slots__ = ("center_x", "center_y", "radius", "speed_x", "speed_y", "color",
+				 "display_width", "display_high", "surface")
+
 	def __init__(self,
 				 center_x: int,
 				 center_y: int,
@@ -106,6 +182,7 @@ class Ball():
 		self.color = color
 		self.display_width = display_width
 		self.display_high = display_high
+		self.surface = None
 
 	def update_pos(self) -> None:
 		if self.center_y - self.radius <= 0 or self.center_y + self.radius >= self.display_high:
@@ -140,6 +217,47 @@ class Ball():
 	def get_speed(self) -> tuple:
 		return (self.speed_x, self.speed_y)
 
+	# Continuous version of update_pos: move for dt ticks, bouncing off the
+	# walls and the facing side of the paddles at the exact time of impact,
+	# so that fast balls cannot tunnel. Returns the last paddle hit, if any
+	def sweep(self, player_rect: pygame.Rect, computer_rect: pygame.Rect, dt: float = 1) -> pygame.Rect:
+		paddle_hit = None
+		remaining = dt
+		for _ in range(self._MAX_BOUNCES):
+			hit_time = remaining
+			wall = False
+			paddle = None
+			if self.speed_y < 0:
+				hit_time = min(hit_time, max(0, (self.radius - self.center_y) / self.speed_y))
+				wall = hit_time < remaining
+			elif self.speed_y > 0:
+				hit_time = min(hit_time, max(0, (self.display_high - self.radius - self.center_y) / self.speed_y))
+				wall = hit_time < remaining
+			if self.speed_x > 0:
+				paddle, face = player_rect, player_rect.left - self.radius
+			elif self.speed_x < 0:
+				paddle, face = computer_rect, computer_rect.right + self.radius
+			if paddle is not None:
+				time_to_face = (face - self.center_x) / self.speed_x
+				y_at_face = self.center_y + self.speed_y * time_to_face
+				if (0 <= time_to_face < hit_time and y_at_face + self.radius >= paddle.top
+						and y_at_face - self.radius <= paddle.bottom):
+					hit_time = time_to_face
+					wall = False
+				else:
+					paddle = None
+			self.center_x += self.speed_x * hit_time
+			self.center_y += self.speed_y * hit_time
+			remaining -= hit_time
+			if paddle is not None:
+				self.speed_x *= -1
+				paddle_hit = paddle
+			elif wall:
+				self.speed_y *= -1
+			else:
+				break
+		return paddle_hit
+
 	def draw(self, display: pygame.Surface) -> None:
 		self.surface = display
 		pygame.draw.circle(self.surface, self.color,
@@ -150,7 +268,28 @@ class Ball():
 		self.speed_y = 0
 		self.center_x = self.display_width / 2
 		self.center_y = self.display_high / 2
-		self.draw(self.surface)
+
+	# Area covered by draw(), with a pixel of margin for the float center
+	def get_rect(self) -> pygame.Rect:
+		return pygame.Rect(self.center_x - self.radius - 1, self.center_y - self.radius - 1,
+						   2 * self.radius + 3, 2 * self.radius + 3)
+
+	# Borders without building a dict, for the per-tick checks
+	@property
+	def left(self) -> float:
+		return self.center_x - self.radius
+
+	@property
+	def right(self) -> float:
+		return self.center_x + self.radius
+
+	@property
+	def top(self) -> float:
+		return self.center_y - self.radius
+
+	@property
+	def bott(self) -> float:
+		return self.center_y + self.radius
 
 	def get_borders(self) -> dict:
 		return {
@@ -164,6 +303,9 @@ class Ball():
 
 
 class Gamer:
+	__slots__ = ("init_top_x", "init_top_y", "width", "high", "color", "rect",
+				 "speed_y", "disp_w", "disp_h", "name")
+
 	def __init__(self, top_x: int,
 				 top_y: int,
 				 width: int,
@@ -223,14 +365,27 @@ class Gamer:
 
 
 class GameField:
-	def __init__(self, display_w: int, display_h: int, bg_color: str, line_color: tuple, caption: str) -> None:
+	def __init__(self, display_w: int, display_h: int, bg_color: str, line_color: tuple, caption: str,
+				 headless: bool = False, offscreen: bool = False, vsync: bool = False) -> None:
 		self.disp_w = display_w
 		self.disp_h = display_h
-		self.screen = pygame.display.set_mode((display_w, display_h))
 		self.bg_color = pygame.Color(bg_color)
 		self.caption = caption
 		self.line_color = line_color
-		pygame.display.set_caption(caption)
+		self.headless = headless
+		self.background = None
+		# A headless field only provides the geometry, no window is opened.
+		# An offscreen one draws to a plain surface
+		self.screen = None
+		if offscreen:
+			self.screen = pygame.Surface((display_w, display_h))
+		elif vsync:
+			# SDL only honours vsync on a renderer backed window
+			self.screen = pygame.display.set_mode((display_w, display_h), pygame.SCALED, vsync=1)
+			pygame.display.set_caption(caption)
+		elif not headless:
+			self.screen = pygame.display.set_mode((display_w, display_h))
+			pygame.display.set_caption(caption)
 
 	def get_screen(self) -> pygame.Surface:
 		return self.screen
@@ -238,40 +393,452 @@ class GameField:
 	def fill_screen(self):
 		self.screen.fill(self.bg_color)
 
-	def draw_borders(self):
-		pygame.draw.aaline(self.screen, self.line_color,
+	def draw_borders(self, surface: pygame.Surface = None):
+		pygame.draw.aaline(surface or self.screen, self.line_color,
 						   (self.disp_w / 2, 0), (self.disp_w / 2, self.disp_h))
 
+	# Redraw the empty field (background and borders) under rect only. The
+	# empty field is drawn once on a copy, what is on screen is left as is
+	def restore_background(self, rect: pygame.Rect) -> None:
+		if self.background is None:
+			self.background = self.screen.copy()
+			self.background.fill(self.bg_color)
+			self.draw_borders(self.background)
+		self.screen.blit(self.background, rect, rect)
+
+
+# Rendered text surfaces by (text, color), so that unchanged text is only
+# blitted. The least recently used entry is dropped once max_size is reached
+class TextCache:
+	def __init__(self, font: pygame.font.Font, max_size: int = 64) -> None:
+		self._font = font
+		self._max_size = max_size
+		self._surfaces = OrderedDict()
+
+	def render(self, text: str, color: tuple) -> pygame.Surface:
+		key = (text, color)
+		surface = self._surfaces.get(key)
+		if surface is None:
+			surface = self._font.render(text, True, color)
+			self._surfaces[key] = surface
+			if len(self._surfaces) > self._max_size:
+				self._surfaces.popitem(last=False)
+		else:
+			self._surfaces.move_to_end(key)
+		return surface
+
+	def __len__(self) -> int:
+		return len(self._surfaces)
+
+
+# Immutable copy of everything a frame shows, handed from the simulation
+# to the render thread
+FrameState = namedtuple("FrameState", ["tick", "ball_x", "ball_y", "player_rect", "computer_rect",
+									   "cpu_score", "player_score"])
+
+
+# Draws FrameStates on its own thread. The queue is bounded: when rendering
+# falls behind, the oldest waiting frame is dropped so the simulation never waits.
+# draw_state must only rasterise to offscreen surfaces: SDL display calls
+# (flip, update, event polling) are only safe on the main thread, and macOS
+# crashes when they are made from another one
+class RenderThread(threading.Thread):
+	def __init__(self, draw_state, queue_size: int = 2) -> None:
+		super().__init__(name="pong-render", daemon=True)
+		self._draw_state = draw_state
+		self._queue = queue.Queue(maxsize=queue_size)
+		self.frames_submitted = 0
+		self.frames_rendered = 0
+		self.frames_dropped = 0
+
+	def submit(self, state: FrameState) -> None:
+		self.frames_submitted += 1
+		try:
+			self._queue.put_nowait(state)
+			return
+		except queue.Full:
+			pass
+		# The render thread may have taken the old frame in the meantime, it
+		# is only dropped if it is still queued
+		try:
+			self._queue.get_nowait()
+			self._queue.task_done()
+			self.frames_dropped += 1
+		except queue.Empty:
+			pass
+		try:
+			self._queue.put_nowait(state)
+		except queue.Full:
+			self.frames_dropped += 1
+
+	def run(self) -> None:
+		while True:
+			state = self._queue.get()
+			if state is None:
+				break
+			self._draw_state(state)
+			self.frames_rendered += 1
+			self._queue.task_done()
+
+	# Block until every frame submitted so far is drawn or dropped
+	def wait_rendered(self) -> None:
+		self._queue.join()
+
+	# Drop the pending frames and wait for the frame being drawn
+	def stop(self) -> None:
+		while True:
+			try:
+				self._queue.get_nowait()
+				self._queue.task_done()
+				self.frames_dropped += 1
+			except queue.Empty:
+				break
+		self._queue.put(None)
+		self.join(timeout=1)
+
+	def get_stats(self) -> dict:
+		return {"submitted": self.frames_submitted,
+				"rendered": self.frames_rendered,
+				"dropped": self.frames_dropped}
+
+
+# Per-phase timings of the last `window` frames in preallocated ring
+# buffers, plus every frame in a flat array when a CSV dump is wanted
+class FrameTimer:
+	PHASES = ("collision", "cpu_move", "events", "updates", "fill", "draws", "score", "flip", "sleep")
+
+	def __init__(self, window: int = 512, csv_path: str = None) -> None:
+		self._window = window
+		self._samples = [array("d", bytes(8 * window)) for _ in self.PHASES]
+		self._frame_times = array("d", bytes(8 * window))
+		self._index = 0
+		self.frames = 0
+		self._csv_path = csv_path
+		self._rows = array("d") if csv_path else None
+
+	# durations in seconds, in PHASES order
+	def add(self, durations: tuple) -> None:
+		index = self._index
+		frame_time = 0
+		for samples, duration in zip(self._samples, durations):
+			samples[index] = duration
+			frame_time += duration
+		self._frame_times[index] = frame_time
+		self._index = (index + 1) % self._window
+		self.frames += 1
+		if self._rows is not None:
+			self._rows.extend(durations)
+
+	def _filled(self) -> int:
+		return min(self.frames, self._window)
+
+	def fps(self) -> float:
+		total = sum(self._frame_times[:self._filled()])
+		return self._filled() / total if total else 0
+
+	def p99_ms(self) -> float:
+		filled = self._filled()
+		if not filled:
+			return 0
+		frame_times = sorted(self._frame_times[:filled])
+		return frame_times[min(filled - 1, int(filled * 0.99))] * 1000
+
+	# Phase with the highest mean time, sleeping in clock.tick aside
+	def worst_phase(self) -> str:
+		filled = self._filled()
+		means = [sum(samples[:filled]) for samples in self._samples[:-1]]
+		return self.PHASES[means.index(max(means))]
+
+	def summary(self) -> str:
+		return f"FPS {self.fps():.0f}  p99 {self.p99_ms():.2f}ms  worst {self.worst_phase()}"
+
+	def dump_csv(self) -> None:
+		if self._rows is None:
+			return
+		phases = len(self.PHASES)
+		with open(self._csv_path, "w", newline="") as csv_file:
+			writer = csv.writer(csv_file)
+			writer.writerow(("frame",) + tuple(f"{phase}_us" for phase in self.PHASES))
+			for frame in range(len(self._rows) // phases):
+				row = self._rows[frame * phases:(frame + 1) * phases]
+				writer.writerow([frame] + [f"{duration * 1e6:.1f}" for duration in row])
+
+
+# Plays the human side without a keyboard: serves the ball and holds
+# UP/DOWN to keep the paddle in line with the ball. With aim_error, a new
+# random offset is picked from rng every time the ball heads to the player
+class ScriptedInput:
+	def __init__(self, ball: Ball, player: Gamer, dead_zone: int = 5,
+				 aim_error: float = 0, rng: random.Random = None) -> None:
+		self._ball = ball
+		self._player = player
+		self._dead_zone = dead_zone
+		self._aim_error = aim_error
+		self._rng = rng if rng else random.Random()
+		self._aim_offset = 0
+		self._incoming = False
+		self._held_key = None
+
+	def __call__(self) -> list:
+		events = []
+		if self._ball.speed_x == 0 and self._ball.speed_y == 0:
+			events.append(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE))
+		if self._aim_error:
+			incoming = self._ball.speed_x > 0
+			if incoming and not self._incoming:
+				self._aim_offset = self._rng.uniform(-self._aim_error, self._aim_error)
+			self._incoming = incoming
+		diff = self._ball.center_y + self._aim_offset - self._player.rect.centery
+		if diff < -self._dead_zone:
+			wanted_key = pygame.K_UP
+		elif diff > self._dead_zone:
+			wanted_key = pygame.K_DOWN
+		else:
+			wanted_key = None
+		if wanted_key != self._held_key:
+			if self._held_key is not None:
+				events.append(pygame.event.Event(pygame.KEYUP, key=self._held_key))
+			if wanted_key is not None:
+				events.append(pygame.event.Event(pygame.KEYDOWN, key=wanted_key))
+			self._held_key = wanted_key
+		return events
+
+
+# CPU paddle policies: move(game) is called once per tick and sets the speed
+# of game._computer. FollowPolicy is the classic CPU, it chases the ball once
+# it is in the CPU half. Gamer.set_speed adds up, so the chase speeds up
+class FollowPolicy:
+	def reset(self) -> None:
+		pass
+
+	def move(self, game) -> None:
+		ball = game._ball
+		computer = game._computer
+		if ball.right < game._half_w:
+			if computer.rect.centery < ball.center_y:
+				computer.set_speed(game._cpu_speed)
+			else:
+				computer.set_speed(-game._cpu_speed)
+		else:
+			computer.set_speed(0)
+
+
+# Moves the CPU paddle to where the ball will cross its plane. The intercept
+# is only computed when the ball velocity changes (serve, wall or paddle
+# bounce), by unfolding the wall reflections. A new plan is followed after
+# reaction_delay ticks and misses by up to `error` pixels, drawn from the
+# game rng so that seeded matches stay reproducible
+class PredictivePolicy:
+	def __init__(self, reaction_delay: int = 0, error: float = 0) -> None:
+		self.reaction_delay = reaction_delay
+		self.error = error
+		self.replans = 0
+		# Ball velocity of the last plan
+		self._speed_x = None
+		self._speed_y = None
+		self._target = None
+		self._max_speed = 0
+		self._next_target = None
+		self._next_tick = 0
+
+	def reset(self) -> None:
+		self._speed_x = None
+		self._speed_y = None
+		self._target = None
+		self._next_target = None
+
+	def intercept(self, game) -> float:
+		ball = game._ball
+		field_h = game._game_field.disp_h
+		if ball.speed_x >= 0:
+			# Going away or waiting for the serve: back to the middle
+			return field_h / 2
+		plane_x = game._computer.rect.right + ball.radius
+		ticks = max(0, (ball.center_x - plane_x) / -ball.speed_x)
+		# The center bounces between radius and field_h - radius: unfolded,
+		# it moves on a straight line and the walls repeat every 2 * span
+		span = field_h - 2 * ball.radius
+		y = (ball.center_y - ball.radius + ball.speed_y * ticks) % (2 * span)
+		if y > span:
+			y = 2 * span - y
+		if self.error:
+			y += game._rng.uniform(-self.error, self.error)
+		return y + ball.radius
+
+	def move(self, game) -> None:
+		ball = game._ball
+		if ball.speed_x != self._speed_x or ball.speed_y != self._speed_y:
+			self._speed_x = ball.speed_x
+			self._speed_y = ball.speed_y
+			self._next_target = self.intercept(game)
+			self._next_tick = game._tick + self.reaction_delay
+			self.replans += 1
+		if self._next_target is not None and game._tick >= self._next_tick:
+			# Whole pixels, within the reach of the paddle center
+			half_high = game._computer.high // 2
+			self._target = min(max(round(self._next_target), half_high), game._game_field.disp_h - half_high)
+			self._max_speed = game._cpu_speed + game._cpu_speed_increment * (game._stat['level'] - 1)
+			self._next_target = None
+		# On target, the paddle was stopped when it got there
+		if self._target is None:
+			return
+		computer = game._computer
+		diff = self._target - computer.rect.centery
+		if diff == 0:
+			computer.speed_y = 0
+			self._target = None
+		else:
+			computer.speed_y = max(-self._max_speed, min(self._max_speed, diff))
+
+
+# random.Random that takes a new version number each time its state
+# changes: seeded, set, or drawn from. Snapshots only pack the 2.5KB
+# Mersenne Twister state when the version differs from the last one packed
+class SnapshotRandom(random.Random):
+	_versions = itertools.count(1)
+
+	def seed(self, *args, **kwargs) -> None:
+		super().seed(*args, **kwargs)
+		self.version = next(self._versions)
+
+	def setstate(self, state) -> None:
+		super().setstate(state)
+		self.version = next(self._versions)
+
+	def random(self) -> float:
+		self.version = next(self._versions)
+		return super().random()
+
+	def getrandbits(self, k: int) -> int:
+		self.version = next(self._versions)
+		return super().getrandbits(k)
+
+
+# Game state record of PongGame.snapshot_into: tick, hits, game over, ball
+# center and speed, player and computer rect position and speed, CPU speed,
+# scores, last diff, level, max score, winner, then the rng version, gauss_next
+# (flag, value) and the 625 words of the Mersenne Twister state
+_SNAPSHOT_STATE = struct.Struct("<IIB4d2id2idd5iBQBd")
+_SNAPSHOT_RNG = struct.Struct("<625I")
+SNAPSHOT_SIZE = _SNAPSHOT_STATE.size + _SNAPSHOT_RNG.size
+_WINNERS = ("none", "player", "cpu")
+
 
 class PongGame:
+	_HUD_PERIOD = 30
+	# Fixed timestep: most ticks run before a frame, the rest of a longer
+	# stall is dropped and the game slows down instead of freezing
+	_MAX_CATCHUP_TICKS = 5
+	# Longest idle wait for an event, in ms
+	_IDLE_TIMEOUT_MS = 500
+
 	def __init__(self, game_field: GameField,
 				 ball: Ball,
 				 player: Gamer,
 				 computer: Gamer,
 				 max_score: int = 100,
-				 fps: int = 120) -> None:
-		self._period = 1 / fps
-		self._max_ball_time_4_travel = 3
-		self._max_gamer_time_4_travel = 0.5
+				 fps: int = 120,
+				 headless: bool = False,
+				 event_source=None,
+				 seed: int = None,
+				 dirty_rects: bool = False,
+				 pipelined: bool = False,
+				 render_queue_size: int = 2,
+				 swept_collision: bool = False,
+				 timer: FrameTimer = None,
+				 hud: bool = False,
+				 cpu_policy=None,
+				 tick_rate: int = None,
+				 idle: bool = False) -> None:
+		# With a tick_rate the simulation runs at that fixed rate and fps only
+		# limits the rendering (0 for no limit); otherwise a tick per frame
+		self._tick_rate = tick_rate
+		self._physics_rate = tick_rate if tick_rate else fps
+		self._period = 1 / self._physics_rate
+		self._accumulator = 0.0
+		self._last_frame_time = None
+		self._previous_state = None
+		# Idle mode: once a static scene (ball and paddles stopped) has been
+		# drawn, wait for an event instead of drawing it again
+		self._idle = idle
+		self._static_drawn = False
+		self._idle_stats = {"frames": 0, "frame_cpu_s": 0.0, "waits": 0, "idle_s": 0.0, "idle_cpu_s": 0.0}
 		self._pong_pygame = pygame
 		self._game_field = game_field
+		self._half_w = game_field.disp_w / 2
 		self._ball = ball
 		self._player = player
 		self._computer = computer
-		self._pong_pygame.init()
+		self._headless = headless
+		self._event_source = event_source if event_source else self._pong_pygame.event.get
+		self._rng = SnapshotRandom(seed)
+		# Version, words and gauss_next of the last rng state packed
+		self._rng_packed = (None, None, None)
+		self._swept_collision = swept_collision
+		self._cpu_policy = cpu_policy if cpu_policy else FollowPolicy()
+		# Frame phase timings, with the HUD text refreshed every _HUD_PERIOD frames
+		self._timer = timer
+		self._hud = hud and timer is not None
+		self._hud_img = None
+		self._hud_font = None
+		# Dirty rect rendering: areas drawn in the last frame and the score text
+		self._dirty_rects = dirty_rects
+		self._last_rects = None
+		self._score_rect = None
+		self._score_str = None
+		# Pipelined rendering: a RenderThread draws frames into the back of two
+		# offscreen surfaces and publishes it as the ready frame, the main
+		# thread blits the ready frame to the display and flips
+		self._renderer = None
+		self._render_lock = threading.Lock()
+		self._back_frame = None
+		self._ready_frame = None
+		self._frame_ready = False
+		self._render_text_cache = None
+		if pipelined and not headless:
+			size = (game_field.disp_w, game_field.disp_h)
+			self._back_frame = pygame.Surface(size)
+			self._ready_frame = pygame.Surface(size)
+			self._renderer = RenderThread(self._render_offscreen, render_queue_size)
+			self._renderer.start()
+		self._tick = 0
+		self._game_over = False
+		# When False, the end of a match stops the loop instead of the process
+		self._exit_on_end = True
+		# Called with the game when a match has a winner
+		self._on_match_end = None
+		if not headless:
+			# Only what the game uses: no audio, joystick or camera
+			self._pong_pygame.display.init()
+			self._pong_pygame.font.init()
 		self._clock = self._pong_pygame.time.Clock()
 		self._stat = {"player_score": 0, "cpu_score": 0,
 					   "last_diff": 0, "level": 1, "max_score": max_score,
 					   "winner": "none"}
 		self._fps = fps
-		self._BALL_SPEED_X_DFLT = (self._game_field.disp_w) / (self._max_ball_time_4_travel * self._fps)
-		self._BALL_SPEED_Y_DFLT = (self._game_field.disp_h) / (self._max_ball_time_4_travel * self._fps)
-		self._CPU_SPEED_DFLT = (self._game_field.disp_h) / (self._max_gamer_time_4_travel * self._fps)
+		# Paddle hits of the match, for the rally length
+		self._hits = 0
+		self._set_travel_times(3, 0.5)
 		self._cpu_speed_increment = 1
 		self._ball_speed_increment = 0.5
-		self._player_speed = (self._game_field.disp_h) / (self._max_gamer_time_4_travel * self._fps)
+		self.font = None
+		self._text_cache = None
+		if not headless:
+			self.font = load_font("freemono", 50)
+			self._text_cache = TextCache(self.font)
+			# The render thread has its own, the caches are not thread safe
+			self._render_text_cache = TextCache(self.font)
+
+	# Speeds from the time (seconds) the ball takes to cross the field and a
+	# paddle to cross its height
+	def _set_travel_times(self, ball_time: float, gamer_time: float):
+		self._max_ball_time_4_travel = ball_time
+		self._max_gamer_time_4_travel = gamer_time
+		self._BALL_SPEED_X_DFLT = (self._game_field.disp_w) / (self._max_ball_time_4_travel * self._physics_rate)
+		self._BALL_SPEED_Y_DFLT = (self._game_field.disp_h) / (self._max_ball_time_4_travel * self._physics_rate)
+		self._CPU_SPEED_DFLT = (self._game_field.disp_h) / (self._max_gamer_time_4_travel * self._physics_rate)
+		self._player_speed = (self._game_field.disp_h) / (self._max_gamer_time_4_travel * self._physics_rate)
 		self._cpu_speed = self._CPU_SPEED_DFLT
-		self.font = self._pong_pygame.font.SysFont("freemono", 50)
 
 	def _reset_game(self):
 		self._update_game_speed()
@@ -280,50 +847,66 @@ class PongGame:
 		self._computer.reset()
 
 	def _check_collision(self):
-		ball_coord = self._ball.get_borders()
-		if ball_coord['left'] <= self._computer.get_borders()['left']:
-			pong_log.critical("Player score +1")
+		ball = self._ball
+		ball_left = ball.left
+		ball_right = ball.right
+		ball_top = ball.top
+		ball_bott = ball.bott
+		player_rect = self._player.rect
+		computer_rect = self._computer.rect
+		if ball_left <= computer_rect.left:
 			self._stat['player_score'] += 1
+			self._log_score("player")
 			self._reset_game()
 
-		if ball_coord['right'] >= self._player.get_borders()['right']:
-			pong_log.critical("CPU score +1")
+		if ball_right >= player_rect.right:
 			self._stat['cpu_score'] += 1
+			self._log_score("cpu")
 			self._reset_game()
 
+		# Paddle hits are found by Ball.sweep when moving the ball
+		if self._swept_collision:
+			return
+
         # инвертируем движение мяча, если игрок отбил мяч
-		if ball_coord['right'] > self._game_field.disp_w / 2 and ball_coord['right'] >= self._player.get_borders()['left']:
-			if ball_coord['top'] <= self._player.get_borders()['bott'] and ball_coord['bott'] >= self._player.get_borders()['top']:
-				self._ball.invert_move(invert_x=True)
-				pong_log.info(f"ball invert move by player")
+		if ball_right > self._half_w and ball_right >= player_rect.left:
+			if ball_top <= player_rect.bottom and ball_bott >= player_rect.top:
+				ball.invert_move(invert_x=True)
+				self._hits += 1
+				self._log_event(logging.INFO, "hit", "side=player")
 
 
         # инвертируем движение мяча, если противник отбил мяч
-		if ball_coord['left'] < self._game_field.disp_w / 2 and ball_coord['left'] <= self._computer.get_borders()['right']:
-			if ball_coord['top'] <= self._computer.get_borders()['bott'] and ball_coord['bott'] >= self._computer.get_borders()['top']:
-				self._ball.invert_move(invert_x=True)
-				pong_log.info(f"ball invert move by cpu")
+		if ball_left < self._half_w and ball_left <= computer_rect.right:
+			if ball_top <= computer_rect.bottom and ball_bott >= computer_rect.top:
+				ball.invert_move(invert_x=True)
+				self._hits += 1
+				self._log_event(logging.INFO, "hit", "side=cpu")
+
+	# Structured record for a game event, only built if the level is enabled
+	def _log_event(self, level: int, event: str, msg: str, *args):
+		if pong_log.isEnabledFor(level):
+			pong_log.log(level, msg, *args, extra={"event": event, "tick": self._tick})
+
+	def _log_score(self, side: str):
+		self._log_event(logging.CRITICAL, "score", "side=%s player_score=%d cpu_score=%d", side,
+						self._stat['player_score'], self._stat['cpu_score'])
 
 	# Update game speed after a reset due to cpu error
 	def _update_game_speed(self):
 		score_diff = self._stat['player_score'] - self._stat['cpu_score']
 		if score_diff > 0 and score_diff > self._stat['last_diff']:
-			self._ball.set_speed(abs(self._ball.get_speed()[
-								 0]) + self._cpu_speed_increment, abs(self._ball.get_speed()[1]) + self._cpu_speed_increment)
+			self._ball.set_speed(abs(self._ball.speed_x) + self._cpu_speed_increment,
+								 abs(self._ball.speed_y) + self._cpu_speed_increment)
 			self._computer.set_speed(
 				self._cpu_speed + self._cpu_speed_increment)
 			self._stat['last_diff'] = score_diff
 			self._stat['level'] += 1
+			self._log_event(logging.INFO, "level_up", "level=%d", self._stat['level'])
 
-	# Move computer  to follow the ball after half of the game field
+	# Move computer as its policy says
 	def _move_computer(self):
-		if self._ball.get_borders()['right'] < self._game_field.disp_w / 2:
-			if self._computer.get_borders()['center_y'] < self._ball.get_borders()['center_y']:
-				self._computer.set_speed(self._cpu_speed)
-			else:
-				self._computer.set_speed(-self._cpu_speed)
-		else:
-			self._computer.set_speed(0)
+		self._cpu_policy.move(self)
 
 	# Based on incoming keyboard event, move the player
 	def _move_player(self, event: pygame.event):
@@ -343,30 +926,43 @@ class PongGame:
 	
 
 	def _write_score(self):
+		self._blit_score(self._stat["cpu_score"], self._stat["player_score"])
+
+	def _blit_score(self, cpu_score: int, player_score: int):
+		self._score_str, self._score_rect = self._blit_score_to(self._game_field.screen, self._text_cache,
+																cpu_score, player_score)
+
+	# Score text on any surface, returns the text and the area drawn
+	def _blit_score_to(self, surface: pygame.Surface, text_cache: TextCache, cpu_score: int,
+					   player_score: int) -> tuple:
 		font_size = 30
-		img = self.font.render(
-			f'{self._stat["cpu_score"]}    {self._stat["player_score"]}', True, self._game_field.line_color)
-		scor_str_len = len(
-			str(f'{self._stat["cpu_score"]}    {self._stat["player_score"]}')) * font_size
-		self._game_field.screen.blit(
-			img, (((self._game_field.disp_w - scor_str_len) / 2) + 35, 10))
+		score_str = f'{cpu_score}    {player_score}'
+		img = text_cache.render(score_str, self._game_field.line_color)
+		scor_str_len = len(score_str) * font_size
+		return score_str, surface.blit(img, (((self._game_field.disp_w - scor_str_len) / 2) + 35, 10))
 		
 	def _write_win(self, winner_name: str):
 		font_size = 30
-		img = self.font.render(
-			f'{winner_name} wins!', True, self._game_field.line_color)
-		win_name_str = len(
-			str(f'{winner_name} wins!')) * font_size
+		win_str = f'{winner_name} wins!'
+		img = self._text_cache.render(win_str, self._game_field.line_color)
+		win_name_str = len(win_str) * font_size
 		self._game_field.screen.blit(
 			img, (((self._game_field.disp_w - win_name_str) / 2) + 35, 10))
 		self._pong_pygame.display.flip()
 
 	# Check if cpu or player wins
 	def _check_end_game(self):
+		if self._headless or not self._exit_on_end:
+			self._check_end_game_headless()
+			return
+		if self._stat['max_score'] in (self._stat['cpu_score'], self._stat['player_score']):
+			self._stop_renderer()
 		if self._stat['cpu_score'] == self._stat['max_score']:
 			self._game_field.fill_screen()
 			self._stat['winner'] = 'cpu'
-			pong_log.critical("End game, CPU wins!")
+			self._game_over = True
+			self._log_event(logging.CRITICAL, "end", "winner=%s", "CPU")
+			self._notify_match_end()
 			self._write_win("CPU")
 			sleep(0.25)
 			self._pong_pygame.quit()
@@ -374,82 +970,766 @@ class PongGame:
 		if self._stat['player_score'] == self._stat['max_score']:
 			self._game_field.fill_screen()
 			self._stat['winner'] = 'player'
-			pong_log.critical(f"End game, {self._player.name} wins!")
+			self._game_over = True
+			self._log_event(logging.CRITICAL, "end", "winner=%s", self._player.name)
+			self._notify_match_end()
 			self._write_win(self._player.name)
 			sleep(2)
 			self._pong_pygame.quit()
 			sys.exit()
 
+	# Same as _check_end_game, but only stops the loop: nothing to show, nothing to quit.
+	# Used by headless games and when _exit_on_end is off
+	def _check_end_game_headless(self):
+		# Already over: the end is only logged and notified once
+		if self._game_over:
+			return
+		if self._stat['cpu_score'] == self._stat['max_score']:
+			self._stat['winner'] = 'cpu'
+		elif self._stat['player_score'] == self._stat['max_score']:
+			self._stat['winner'] = 'player'
+		else:
+			return
+		self._log_event(logging.CRITICAL, "end", "winner=%s", self._stat['winner'])
+		self._game_over = True
+		self._notify_match_end()
+
+	def _notify_match_end(self):
+		if self._on_match_end is not None:
+			self._on_match_end(self)
+
 	# Check for events like quit game, key press or game reset
 	def _update_events(self):
 		self._check_end_game()
-		for event in self._pong_pygame.event.get():
+		if self._game_over:
+			return
+		for event in self._event_source():
 			if event.type == self._pong_pygame.QUIT:
+				self._stop_renderer()
 				self._pong_pygame.quit()
 				sys.exit()
 			# After a ball reset, waits for a player keypress to restart the ball
 			if event.type == self._pong_pygame.KEYDOWN or event.type == self._pong_pygame.KEYUP:
-				start_speed_x = self._BALL_SPEED_X_DFLT + (self._cpu_speed_increment * self._stat['level'])
-				start_speed_y = self._BALL_SPEED_Y_DFLT + (self._cpu_speed_increment * self._stat['level'])
-				if self._ball.get_speed()[0] == 0 and self._ball.get_speed()[1] == 0:
-					self._ball.set_speed(start_speed_x, start_speed_y)
+				self._serve()
 				self._move_player(event)
 
+	# Restart a stopped ball, faster at each level
+	def _serve(self):
+		if self._ball.speed_x == 0 and self._ball.speed_y == 0:
+			start_speed_x = self._BALL_SPEED_X_DFLT + (self._cpu_speed_increment * self._stat['level'])
+			start_speed_y = self._BALL_SPEED_Y_DFLT + (self._cpu_speed_increment * self._stat['level'])
+			self._ball.set_speed(start_speed_x, start_speed_y)
+
 	def run_game(self):
-		pong_log.info("Game start!")
+		self._log_event(logging.INFO, "start", "mode=window")
 		while True:
 			self.run_game_once()
 
+	# Run ticks as fast as possible, without rendering or clock throttling
+	def run_headless(self, ticks: int) -> int:
+		self._log_event(logging.INFO, "start", "mode=headless")
+		start_tick = self._tick
+		while self._tick - start_tick < ticks and not self._game_over:
+			self.run_game_once()
+		return self._tick - start_tick
+
+	# Final stats of the match, once _check_end_game has found a winner
+	def get_result(self) -> dict:
+		points = self._stat['player_score'] + self._stat['cpu_score']
+		return {"winner": self._stat['winner'],
+				"player_score": self._stat['player_score'],
+				"cpu_score": self._stat['cpu_score'],
+				"level": self._stat['level'],
+				"ticks": self._tick,
+				"ticks_per_point": self._tick / points if points else None,
+				"hits": self._hits,
+				"hits_per_point": self._hits / points if points else None}
+
+	# Start over with 0-0 at level 1, reseeding the game rng when seed is given.
+	# The event source keeps its own state
+	def new_match(self, seed: int = None):
+		if seed is not None:
+			self._rng.seed(seed)
+		self._stat.update(player_score=0, cpu_score=0, last_diff=0, level=1, winner="none")
+		self._ball.reset()
+		for gamer in (self._player, self._computer):
+			gamer.reset()
+			gamer.speed_y = 0
+		self._cpu_policy.reset()
+		self._tick = 0
+		self._hits = 0
+		self._game_over = False
+		self._static_drawn = False
+
+	# Write the simulation state to buffer[offset:offset + SNAPSHOT_SIZE]. The
+	# CPU policy and the event source keep their own state
+	def snapshot_into(self, buffer, offset: int = 0):
+		ball = self._ball
+		player = self._player
+		computer = self._computer
+		stat = self._stat
+		rng = self._rng
+		version, words, gauss_next = self._rng_packed
+		if version != rng.version:
+			_, state, gauss_next = rng.getstate()
+			version = rng.version
+			words = _SNAPSHOT_RNG.pack(*state)
+			self._rng_packed = (version, words, gauss_next)
+		_SNAPSHOT_STATE.pack_into(buffer, offset, self._tick, self._hits, self._game_over,
+								  ball.center_x, ball.center_y, ball.speed_x, ball.speed_y,
+								  player.rect.x, player.rect.y, player.speed_y,
+								  computer.rect.x, computer.rect.y, computer.speed_y, self._cpu_speed,
+								  stat['player_score'], stat['cpu_score'], stat['last_diff'], stat['level'],
+								  stat['max_score'], _WINNERS.index(stat['winner']),
+								  version, gauss_next is not None, gauss_next or 0.0)
+		start = offset + _SNAPSHOT_STATE.size
+		buffer[start:start + _SNAPSHOT_RNG.size] = words
+
+	def snapshot(self) -> bytes:
+		buffer = bytearray(SNAPSHOT_SIZE)
+		self.snapshot_into(buffer)
+		return bytes(buffer)
+
+	# Set the simulation state back to a snapshot_into record
+	def restore(self, buffer, offset: int = 0):
+		ball = self._ball
+		player = self._player
+		computer = self._computer
+		(self._tick, self._hits, game_over, ball.center_x, ball.center_y, ball.speed_x, ball.speed_y,
+		 player.rect.x, player.rect.y, player.speed_y, computer.rect.x, computer.rect.y, computer.speed_y,
+		 self._cpu_speed, player_score, cpu_score, last_diff, level, max_score, winner,
+		 version, has_gauss, gauss_next) = _SNAPSHOT_STATE.unpack_from(buffer, offset)
+		self._game_over = bool(game_over)
+		self._stat.update(player_score=player_score, cpu_score=cpu_score, last_diff=last_diff, level=level,
+						  max_score=max_score, winner=_WINNERS[winner])
+		# Same version, same state: the rng has not moved since
+		if version != self._rng.version:
+			gauss_next = gauss_next if has_gauss else None
+			start = offset + _SNAPSHOT_STATE.size
+			self._rng.setstate((3, _SNAPSHOT_RNG.unpack_from(buffer, start), gauss_next))
+			self._rng.version = version
+			self._rng_packed = (version, bytes(buffer[start:start + _SNAPSHOT_RNG.size]), gauss_next)
+		# Nothing to interpolate from across a jump in time, and the restored
+		# scene has not been drawn yet
+		self._previous_state = None
+		self._static_drawn = False
+
 	def run_game_once(self):
+		if self._tick_rate and not self._headless:
+			self._run_frame_fixed()
+			return
+		if self._timer is not None:
+			self._run_game_once_timed()
+			return
+		if self._idle and not self._headless:
+			self._run_game_once_idle()
+			return
+		self._update_state()
+		if self._headless or self._game_over:
+			return
+		self._render_frame()
+		self._clock.tick(self._fps)
+
+	def _render_frame(self):
+		if self._renderer:
+			self._renderer.submit(self.get_frame_state())
+			self._present_frame()
+		elif self._dirty_rects:
+			self._draw_frame_dirty()
+		else:
+			self._draw_frame()
+			self._pong_pygame.display.flip()
+
+	# run_game_once that waits for an event instead of drawing the same
+	# static scene again, and counts the CPU time of the frames it draws
+	def _run_game_once_idle(self):
+		start_cpu = time.process_time()
+		self._update_state()
+		if self._game_over:
+			return
+		static = self._is_static()
+		if static and self._static_drawn:
+			self._wait_idle()
+			return
+		self._static_drawn = static
+		self._render_frame()
+		self._clock.tick(self._fps)
+		self._idle_stats["frames"] += 1
+		self._idle_stats["frame_cpu_s"] += time.process_time() - start_cpu
+
+	def _is_static(self) -> bool:
+		return (self._ball.speed_x == 0 and self._ball.speed_y == 0
+				and self._player.speed_y == 0 and self._computer.speed_y == 0)
+
+	# Block until an event comes or _IDLE_TIMEOUT_MS. The event is put back
+	# in the queue, the next tick handles it without waiting for the clock
+	def _wait_idle(self):
+		# The static frame may still be on the render thread, show it first
+		if self._renderer:
+			self._renderer.wait_rendered()
+			self._present_frame()
+		start = time.perf_counter()
+		start_cpu = time.process_time()
+		event = self._pong_pygame.event.wait(self._IDLE_TIMEOUT_MS)
+		if event.type != self._pong_pygame.NOEVENT:
+			self._pong_pygame.event.post(event)
+		# The window content was lost, draw the frame again
+		if event.type in (self._pong_pygame.VIDEOEXPOSE, self._pong_pygame.WINDOWEXPOSED):
+			self._static_drawn = False
+		self._idle_stats["waits"] += 1
+		self._idle_stats["idle_s"] += time.perf_counter() - start
+		self._idle_stats["idle_cpu_s"] += time.process_time() - start_cpu
+
+	# Time spent idle, and the CPU time it saved: the frames that would have
+	# been drawn meanwhile, at the mean CPU time of a drawn frame, less what
+	# the waits used
+	def get_idle_stats(self) -> dict:
+		stats = dict(self._idle_stats, cpu_saved_s=0.0)
+		if stats["frames"]:
+			frame_cpu_s = stats["frame_cpu_s"] / stats["frames"]
+			stats["cpu_saved_s"] = max(0.0, stats["idle_s"] * self._fps * frame_cpu_s - stats["idle_cpu_s"])
+		return stats
+
+	# Collision, AI, input and movement for a single tick
+	def _update_state(self):
 		self._check_collision()
 		self._move_computer()
 		self._update_events()
-		self._game_field.fill_screen()
-		self._ball.update_pos()
+		if self._game_over:
+			return
+		self._move_objects()
+
+	def _move_objects(self):
+		if self._swept_collision:
+			self._sweep_ball()
+		else:
+			self._ball.update_pos()
 		self._player.update_pos()
 		self._computer.update_pos()
+		self._tick += 1
+
+	# One frame of the fixed timestep loop: the ticks that fit in the time
+	# elapsed since the last frame, then the state drawn between the last two
+	# ticks, in proportion of the time left over
+	def _run_frame_fixed(self):
+		now = time.perf_counter()
+		if self._last_frame_time is None:
+			self._last_frame_time = now
+		self._accumulator += now - self._last_frame_time
+		self._last_frame_time = now
+		ticks = 0
+		while self._accumulator >= self._period:
+			if ticks == self._MAX_CATCHUP_TICKS:
+				self._accumulator %= self._period
+				break
+			self._previous_state = self.get_frame_state()
+			self._update_state()
+			if self._game_over:
+				return
+			self._accumulator -= self._period
+			ticks += 1
+		state = self.get_interpolated_state(self._accumulator / self._period)
+		if self._renderer:
+			self._renderer.submit(state)
+			self._present_frame()
+		else:
+			self._draw_state(state)
+			self._pong_pygame.display.flip()
+		if self._fps:
+			self._clock.tick(self._fps)
+
+	# Frame state alpha of the way from the previous tick to the current one.
+	# A point scored in between is not interpolated, the ball jumped
+	def get_interpolated_state(self, alpha: float) -> FrameState:
+		current = self.get_frame_state()
+		previous = self._previous_state
+		if (previous is None or previous.cpu_score != current.cpu_score
+				or previous.player_score != current.player_score):
+			return current
+
+		def lerp(start, end):
+			return start + (end - start) * alpha
+
+		def lerp_rect(start, end):
+			return (end[0], lerp(start[1], end[1]), end[2], end[3])
+
+		return current._replace(ball_x=lerp(previous.ball_x, current.ball_x),
+								ball_y=lerp(previous.ball_y, current.ball_y),
+								player_rect=lerp_rect(previous.player_rect, current.player_rect),
+								computer_rect=lerp_rect(previous.computer_rect, current.computer_rect))
+
+	# run_game_once, timing every phase for the FrameTimer
+	def _run_game_once_timed(self):
+		now = time.perf_counter
+		start = now()
+		self._check_collision()
+		collided = now()
+		self._move_computer()
+		cpu_moved = now()
+		self._update_events()
+		events_done = now()
+		if self._game_over:
+			return
+		self._move_objects()
+		moved = now()
+		if self._headless:
+			self._timer.add((collided - start, cpu_moved - collided, events_done - cpu_moved,
+							 moved - events_done, 0, 0, 0, 0, 0))
+			return
+		filled = drawn = scored = moved
+		if self._renderer:
+			self._renderer.submit(self.get_frame_state())
+			self._present_frame()
+			filled = drawn = scored = now()
+		elif self._dirty_rects:
+			self._draw_frame_dirty()
+			filled = drawn = scored = now()
+		else:
+			screen = self._game_field.get_screen()
+			self._game_field.fill_screen()
+			filled = now()
+			self._ball.draw(screen)
+			self._player.draw(screen)
+			self._computer.draw(screen)
+			self._game_field.draw_borders()
+			drawn = now()
+			self._write_score()
+			if self._hud:
+				self._draw_hud()
+			scored = now()
+			self._pong_pygame.display.flip()
+		flipped = now()
+		self._clock.tick(self._fps)
+		self._timer.add((collided - start, cpu_moved - collided, events_done - cpu_moved,
+						 moved - events_done, filled - moved, drawn - filled, scored - drawn,
+						 flipped - scored, now() - flipped))
+
+	def _draw_hud(self):
+		if self._hud_img is None or self._timer.frames % self._HUD_PERIOD == 0:
+			if self._hud_font is None:
+				self._hud_font = load_font("freemono", 14)
+			self._hud_img = self._hud_font.render(self._timer.summary(), True, self._game_field.line_color)
+		self._game_field.screen.blit(self._hud_img, (5, self._game_field.disp_h - self._hud_img.get_height() - 5))
+
+	# Write the timings CSV, if any, once the game is over
+	def stop_timing(self):
+		if self._timer is not None:
+			self._timer.dump_csv()
+			self._log_event(logging.INFO, "timing", "%s", self._timer.summary())
+
+	def _sweep_ball(self):
+		paddle = self._ball.sweep(self._player.rect, self._computer.rect)
+		if paddle is self._player.rect:
+			self._hits += 1
+			self._log_event(logging.INFO, "hit", "side=player")
+		elif paddle is self._computer.rect:
+			self._hits += 1
+			self._log_event(logging.INFO, "hit", "side=cpu")
+
+	def _draw_frame(self):
+		self._game_field.fill_screen()
 		self._ball.draw(self._game_field.get_screen())
 		self._player.draw(self._game_field.get_screen())
 		self._computer.draw(self._game_field.get_screen())
 		self._game_field.draw_borders()
 		self._write_score()
+
+	def get_frame_state(self) -> FrameState:
+		return FrameState(self._tick, self._ball.center_x, self._ball.center_y,
+						  tuple(self._player.rect), tuple(self._computer.rect),
+						  self._stat["cpu_score"], self._stat["player_score"])
+
+	# Full frame from a snapshot, to the screen or to an offscreen surface
+	def _draw_state(self, state: FrameState, surface: pygame.Surface = None, text_cache: TextCache = None):
+		field = self._game_field
+		screen = surface if surface is not None else field.get_screen()
+		screen.fill(field.bg_color)
+		pygame.draw.circle(screen, self._ball.color, (state.ball_x, state.ball_y), self._ball.radius)
+		pygame.draw.rect(screen, self._player.color, state.player_rect)
+		pygame.draw.rect(screen, self._computer.color, state.computer_rect)
+		pygame.draw.aaline(screen, field.line_color, (field.disp_w / 2, 0), (field.disp_w / 2, field.disp_h))
+		if surface is None:
+			self._blit_score(state.cpu_score, state.player_score)
+		else:
+			self._blit_score_to(screen, text_cache, state.cpu_score, state.player_score)
+
+	# Runs on the render thread: draw into the back frame, then swap it with
+	# the ready one
+	def _render_offscreen(self, state: FrameState):
+		self._draw_state(state, self._back_frame, self._render_text_cache)
+		with self._render_lock:
+			self._back_frame, self._ready_frame = self._ready_frame, self._back_frame
+			self._frame_ready = True
+
+	# Main thread side of pipelined rendering: show the last frame drawn, if new
+	def _present_frame(self):
+		with self._render_lock:
+			if not self._frame_ready:
+				return
+			self._game_field.get_screen().blit(self._ready_frame, (0, 0))
+			self._frame_ready = False
 		self._pong_pygame.display.flip()
-		self._clock.tick(self._fps)
+
+	def _stop_renderer(self):
+		if self._renderer:
+			self._renderer.stop()
+			self._log_event(logging.INFO, "render", "%s", self._renderer.get_stats())
+			self._renderer = None
+
+	def get_render_stats(self) -> dict:
+		return self._renderer.get_stats() if self._renderer else None
+
+	# Only redraw and push to the display what moved since the last frame:
+	# the old and new areas of the ball and paddles, and the score if needed
+	def _draw_frame_dirty(self):
+		screen = self._game_field.get_screen()
+		rects = [self._ball.get_rect(), self._player.rect.copy(), self._computer.rect.copy()]
+		if self._last_rects is None:
+			self._draw_frame()
+			self._pong_pygame.display.flip()
+			self._last_rects = rects
+			return
+		dirty = self._last_rects + rects
+		score_str = f'{self._stat["cpu_score"]}    {self._stat["player_score"]}'
+		redraw_score = score_str != self._score_str or self._score_rect.collidelist(dirty) != -1
+		if redraw_score:
+			dirty.append(self._score_rect)
+			self._game_field.restore_background(self._score_rect)
+		for rect in self._last_rects:
+			self._game_field.restore_background(rect)
+		self._ball.draw(screen)
+		self._player.draw(screen)
+		self._computer.draw(screen)
+		if redraw_score:
+			self._write_score()
+			dirty.append(self._score_rect)
+		self._pong_pygame.display.update(dirty)
+		self._last_rects = rects
+
+# Snapshots of the last `capacity` ticks of a game in one preallocated
+# buffer, a slot per tick modulo capacity. Rewind with restore(tick), or
+# roll back, change the inputs and simulate forward again
+class SnapshotRing:
+	def __init__(self, game: PongGame, capacity: int = 128) -> None:
+		self._game = game
+		self.capacity = capacity
+		self._buffer = bytearray(capacity * SNAPSHOT_SIZE)
+		self._view = memoryview(self._buffer)
+		# Tick held by each slot, -1 when empty
+		self._ticks = array("q", [-1]) * capacity
+
+	# Snapshot the current tick, overwriting the one capacity ticks older
+	def save(self) -> None:
+		tick = self._game._tick
+		slot = tick % self.capacity
+		self._game.snapshot_into(self._view, slot * SNAPSHOT_SIZE)
+		self._ticks[slot] = tick
+
+	def __contains__(self, tick: int) -> bool:
+		return tick >= 0 and self._ticks[tick % self.capacity] == tick
+
+	def oldest(self) -> int:
+		ticks = [tick for tick in self._ticks if tick >= 0]
+		return min(ticks) if ticks else None
+
+	def restore(self, tick: int) -> None:
+		if tick not in self:
+			raise KeyError(f"No snapshot of tick {tick}")
+		self._game.restore(self._view, (tick % self.capacity) * SNAPSHOT_SIZE)
+
+	# Drop the snapshots after tick, they belong to the timeline rolled back
+	def truncate(self, tick: int) -> None:
+		for slot, slot_tick in enumerate(self._ticks):
+			if slot_tick > tick:
+				self._ticks[slot] = -1
+
+
+# Create the field, ball and paddles for a standard game. In headless mode the
+# player is driven by ScriptedInput
+def build_game(screen_width: int,
+			   screen_height: int,
+			   color: tuple,
+			   player_name: str,
+			   fps: int = 120,
+			   max_score: int = 2,
+			   headless: bool = False,
+			   seed: int = None,
+			   aim_error: float = 0,
+			   dirty_rects: bool = False,
+			   pipelined: bool = False,
+			   swept_collision: bool = False,
+			   timer: FrameTimer = None,
+			   hud: bool = False,
+			   game_class: type = None,
+			   cpu: str = "follow",
+			   cpu_delay: int = 0,
+			   cpu_error: float = 0,
+			   offscreen: bool = False,
+			   tick_rate: int = None,
+			   vsync: bool = False,
+			   idle: bool = False) -> PongGame:
+	game_field = GameField(screen_width, screen_height,
+						   "black", color, "Pong", headless=headless, offscreen=offscreen,
+						   vsync=vsync and not headless)
+	ball = Ball(screen_width / 2, screen_height / 2, 5,
+				color, screen_width, screen_height)
+	player = Gamer(screen_width - 30, (screen_height / 2) - 40,
+				   10, 40, color, player_name, screen_width, screen_height)
+	computer = Gamer(20, (screen_height / 2) - 40, 10, 40,
+					 color, "CPU", screen_width, screen_height)
+	game_class = game_class if game_class else PongGame
+	pong = game_class(game_field, ball, player, computer, fps=fps, max_score=max_score,
+					headless=headless, seed=seed, dirty_rects=dirty_rects, pipelined=pipelined,
+					swept_collision=swept_collision, timer=timer, hud=hud,
+					cpu_policy=PredictivePolicy(cpu_delay, cpu_error) if cpu == "predictive" else FollowPolicy(),
+					tick_rate=tick_rate, idle=idle)
+	# The scripted player draws from its own rng: a replay swaps it for the
+	# recorded events, and the game rng must then give the same draws
+	if headless:
+		input_rng = random.Random(None if seed is None else seed + 1)
+		pong._event_source = ScriptedInput(ball, player, aim_error=aim_error, rng=input_rng)
+	return pong
+
+# Replay file: header with the build_game config as JSON, then one fixed
+# size record per KEYDOWN/KEYUP event (tick, type, key). A final END record
+# holds the last tick of the match, and 1 as key if the match had a winner
+REPLAY_MAGIC = b"PONGRPL1"
+_REPLAY_HEADER = struct.Struct("<8sI")
+_REPLAY_EVENT = struct.Struct("<IBI")
+_REPLAY_TYPES = (pygame.KEYDOWN, pygame.KEYUP)
+_REPLAY_END = 255
+
+
+# Wraps the event source of a game and writes its key events to a replay file
+class ReplayRecorder:
+	_FLUSH_SIZE = 64 * 1024
+
+	def __init__(self, path: str, config: dict, game: PongGame) -> None:
+		self._game = game
+		self._source = game._event_source
+		game._event_source = self
+		self._buffer = bytearray()
+		config_json = json.dumps(config).encode()
+		self._file = open(path, "wb")
+		self._file.write(_REPLAY_HEADER.pack(REPLAY_MAGIC, len(config_json)))
+		self._file.write(config_json)
+
+	def __call__(self) -> list:
+		events = self._source()
+		for event in events:
+			if event.type in _REPLAY_TYPES:
+				self._buffer += _REPLAY_EVENT.pack(self._game._tick, _REPLAY_TYPES.index(event.type),
+												   getattr(event, "key", 0))
+		if len(self._buffer) >= self._FLUSH_SIZE:
+			self._flush()
+		return events
+
+	def _flush(self) -> None:
+		self._file.write(self._buffer)
+		self._buffer.clear()
+
+	def close(self) -> None:
+		if self._file.closed:
+			return
+		self._buffer += _REPLAY_EVENT.pack(self._game._tick, _REPLAY_END, int(self._game._game_over))
+		self._flush()
+		self._file.close()
+
+
+# Re-simulates a replay file headless and unthrottled. Records are read
+# straight from the mmapped file, seek() moves to any tick of the match
+class ReplayPlayer:
+	def __init__(self, path: str) -> None:
+		self._file = open(path, "rb")
+		self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, config_len = _REPLAY_HEADER.unpack_from(self._map, 0)
+		if magic != REPLAY_MAGIC:
+			raise ValueError(f"{path} is not a pong replay")
+		self._data_offset = _REPLAY_HEADER.size + config_len
+		self.config = json.loads(self._map[_REPLAY_HEADER.size:self._data_offset])
+		self._count = (len(self._map) - self._data_offset) // _REPLAY_EVENT.size
+		self.end_tick = None
+		self.finished = False
+		if self._count:
+			tick, event_type, game_over = self._read(self._count - 1)
+			if event_type == _REPLAY_END:
+				self.end_tick = tick
+				self.finished = bool(game_over)
+				self._count -= 1
+		self._new_game()
+
+	def _read(self, index: int) -> tuple:
+		return _REPLAY_EVENT.unpack_from(self._map, self._data_offset + index * _REPLAY_EVENT.size)
+
+	def _new_game(self) -> None:
+		config = dict(self.config, color=tuple(self.config["color"]))
+		self.game = build_game(**config, headless=True)
+		self.game._event_source = self._next_events
+		self._index = 0
+
+	def _next_events(self) -> list:
+		events = []
+		tick = self.game._tick
+		while self._index < self._count:
+			event_tick, event_type, key = self._read(self._index)
+			if event_tick > tick:
+				break
+			if event_tick == tick:
+				events.append(pygame.event.Event(_REPLAY_TYPES[event_type], key=key))
+			self._index += 1
+		return events
+
+	# Going back restarts the match, the simulation is deterministic
+	def seek(self, tick: int) -> None:
+		if tick < self.game._tick:
+			self._new_game()
+		if self.end_tick is not None:
+			tick = min(tick, self.end_tick)
+		self.game.run_headless(tick - self.game._tick)
+
+	def run(self) -> dict:
+		if self.end_tick is not None:
+			self.seek(self.end_tick)
+			# The winning point is scored in a tick that never completes
+			if self.finished:
+				self.game.run_game_once()
+		else:
+			self.game.run_headless(sys.maxsize)
+		return self.game.get_result()
+
+	def close(self) -> None:
+		self._map.close()
+		self._file.close()
+
 
 def main():
-	#os.remove(os.path.abspath(log_file))
 	parser = argparse.ArgumentParser(description='Pong Game')
 	parser.add_argument('-dw','--width', type=int, default=320, help='Width of the display (dflt 320)')
 	parser.add_argument('-dh','--height', type=int, default=240, help='Height of the display (dflt 240)')
 	parser.add_argument('-n','--name', type=str, default="player 1", help='Player name')
 	parser.add_argument('-c', '--color', type=str, default="lightgrey", help='Game color (dflt light grey)')
-	parser.add_argument('--fps', type=int, default=120, help='Framerate (dflt 120)')
+	parser.add_argument('--fps', type=int, default=120, help='Framerate (dflt 120), 0 for no limit with --tick-rate')
+	parser.add_argument('--tick-rate', type=int, default=None, help='Simulate at this fixed rate whatever the framerate, drawing interpolated frames')
+	parser.add_argument('--vsync', action='store_true', help='Wait for the display refresh on every frame')
+	parser.add_argument('--idle', action='store_true', help='Stop redrawing while waiting for the serve, and print the CPU time saved on exit')
 	parser.add_argument('--max_score', type=int, default=2, help='Max score to win (dflt 2)')
+	parser.add_argument('--headless', action='store_true', help='Simulate without rendering or frame limit, player is scripted')
+	parser.add_argument('--aim-error', type=float, default=20, help='Max aim error of the scripted player in headless mode, in pixels (dflt 20)')
+	parser.add_argument('--ticks', type=int, default=100000, help='Max ticks to simulate in headless mode (dflt 100000)')
+	parser.add_argument('--seed', type=int, default=None, help='Random seed')
+	parser.add_argument('--dirty-rects', action='store_true', help='Only redraw and update the moving parts of the screen')
+	parser.add_argument('--pipelined', action='store_true', help='Render on a separate thread, dropping frames when it falls behind')
+	parser.add_argument('--swept', action='store_true', help='Continuous ball collision, safe at low fps and high levels')
+	parser.add_argument('--cpu', type=str, default='follow', choices=['follow', 'predictive'], help='CPU opponent (dflt follow)')
+	parser.add_argument('--cpu-delay', type=int, default=0, help='Ticks before the predictive CPU reacts (dflt 0)')
+	parser.add_argument('--cpu-error', type=float, default=0, help='Max aim error of the predictive CPU in pixels (dflt 0)')
+	parser.add_argument('--record', type=str, default=None, help='Record the match to this replay file')
+	parser.add_argument('--replay', type=str, nargs='+', default=None, help='Re-simulate replay files at full speed and print their results')
+	parser.add_argument('--seek', type=int, default=None, help='With --replay, stop at this tick')
+	parser.add_argument('--log-level', type=str, default='CRITICAL', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+						help='Log level for the console and pong_log.log (dflt CRITICAL)')
+	parser.add_argument('--timings', type=str, default=None, help='Time every frame phase and write them to this CSV file on exit')
+	parser.add_argument('--hud', action='store_true', help='Show FPS, p99 frame time and the slowest phase on screen')
+	parser.add_argument('--profile', type=int, default=None, metavar='FRAMES', help='Profile this many frames, then exit')
+	parser.add_argument('--profile-output', type=str, default='pong_profile', help='Prefix of the .pstats and .folded profile files (dflt pong_profile)')
+	parser.add_argument('--startup-benchmark', action='store_true', help='Print the time to the first frame and exit')
+	parser.add_argument('--history', type=str, default=match_history.history_file, help=f'Record finished matches in this SQLite file, empty for none (dflt {match_history.history_file})')
 	args = parser.parse_args()
+	setup_logging(log_file, getattr(logging, args.log_level))
+
+	if args.replay:
+		for path in args.replay:
+			player = ReplayPlayer(path)
+			if args.seek is not None:
+				player.seek(args.seek)
+				print(f"{path}: tick {player.game._tick} {player.game._stat}")
+			else:
+				print(f"{path}: {player.run()}")
+			player.close()
+		return
 
 	screen_width = args.width
 	screen_height = args.height
 	fps = args.fps
+	if fps <= 0 and not args.tick_rate:
+		parser.error("--fps 0 needs --tick-rate")
+	# The fixed timestep loop draws interpolated full frames, untimed
+	if args.tick_rate and not args.headless:
+		for flag, value in (("--timings", args.timings), ("--hud", args.hud),
+							("--dirty-rects", args.dirty_rects), ("--idle", args.idle)):
+			if value:
+				parser.error(f"{flag} is not supported with --tick-rate")
+	# Timed frames always draw, idle waits would never happen
+	if args.idle and (args.timings or args.hud):
+		parser.error("--idle is not supported with --timings or --hud")
+	# The overlay is only drawn over full frames from the main thread
+	if args.hud and (args.dirty_rects or args.pipelined):
+		parser.error("--hud is not supported with --dirty-rects or --pipelined")
 	max_score = args.max_score
 	color = args.color
 	player_name = args.name
 
 	if color not in rgb_colors.keys():
-		pong_log.error(f"Color {color} not found, setting light grey")
+		pong_log.error("Color %s not found, setting light grey", color)
 		color = "lightgrey"
 
-	game_field = GameField(screen_width, screen_height,
-						   "black", rgb_colors[color], "Pong")
-	ball = Ball(screen_width / 2, screen_height / 2, 5,
-				rgb_colors[color], screen_width, screen_height)
-	player = Gamer(screen_width - 30, (screen_height / 2) - 40,
-				   10, 40, rgb_colors[color], player_name, screen_width, screen_height)
-	computer = Gamer(20, (screen_height / 2) - 40, 10, 40,
-					 rgb_colors[color], "CPU",screen_width, screen_height)
+	# A recorded match needs a known seed to be replayed
+	seed = args.seed
+	if args.record and seed is None:
+		seed = random.randrange(2 ** 32)
+	config = {"screen_width": screen_width, "screen_height": screen_height,
+			  "color": rgb_colors[color], "player_name": player_name, "fps": fps,
+			  "max_score": max_score, "seed": seed, "swept_collision": args.swept,
+			  "cpu": args.cpu, "cpu_delay": args.cpu_delay, "cpu_error": args.cpu_error,
+			  "tick_rate": args.tick_rate}
+	timer = FrameTimer(csv_path=args.timings) if args.timings or args.hud else None
+	pong = build_game(**config, headless=args.headless, aim_error=args.aim_error, dirty_rects=args.dirty_rects,
+					  pipelined=args.pipelined, timer=timer, hud=args.hud, vsync=args.vsync, idle=args.idle)
+	recorder = ReplayRecorder(args.record, config, pong) if args.record else None
+	history = None
+	if args.history and not args.startup_benchmark:
+		history = match_history.MatchHistory(args.history)
+		pong._on_match_end = lambda game: history.record_game(game, config)
+
+	if args.startup_benchmark:
+		built = time.perf_counter()
+		pong.run_game_once()
+		first_frame = time.perf_counter()
+		print(f"import pygame: {(_pygame_import_time - _start_time) * 1000:.1f}ms")
+		print(f"build game:    {(built - _pygame_import_time) * 1000:.1f}ms")
+		print(f"first frame:   {(first_frame - built) * 1000:.1f}ms")
+		print(f"total:         {(first_frame - _start_time) * 1000:.1f}ms")
+		return
+
+	try:
+		if args.profile:
+			pong._exit_on_end = False
+
+			def run_frame():
+				pong.run_game_once()
+				return not pong._game_over
+
+			frames = profiler.profile_frames(run_frame, args.profile, args.profile_output)
+			print(f"{frames} frames profiled to {args.profile_output}.pstats and {args.profile_output}.folded")
+			return
 
-	pong = PongGame(game_field, ball, player, computer, fps=fps, max_score=max_score)
+		if args.headless:
+			start = time.perf_counter()
+			ticks = pong.run_headless(args.ticks)
+			elapsed = time.perf_counter() - start
+			print(f"{ticks} ticks in {elapsed:.3f}s ({ticks / elapsed:.0f} ticks/sec)")
+			print(pong._stat)
+			return
 
-	pong.run_game()
+		pong.run_game()
+	finally:
+		if recorder:
+			recorder.close()
+		if history:
+			history.close()
+		pong.stop_timing()
+		if args.idle:
+			print(f"idle: {pong.get_idle_stats()}")
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
@@ -0,0 +1,143 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import numpy as np
+import pygame
+import pong
+
+# Actions of PongEnv.step, for the player (right) paddle
+NOOP = 0
+UP = 1
+DOWN = 2
+_ACTION_KEYS = (None, pygame.K_UP, pygame.K_DOWN)
+
+# Integer grayscale weights, summing to 256
+_GRAY_WEIGHTS = (77, 150, 29)
+
+
+# Grayscale, downsampled frames of a surface, read through a pixels3d view of
+# the surface memory. Every buffer is allocated once: the last `stack` frames
+# live in a ring and observation() copies them in time order to one array
+class PixelObserver:
+	def __init__(self, surface: pygame.Surface, downsample: int = 4, stack: int = 4) -> None:
+		width, height = surface.get_size()
+		self._surface = surface
+		self._downsample = downsample
+		self._stack = stack
+		self.shape = (stack, height // downsample, width // downsample)
+		self._frames = np.zeros(self.shape, np.uint8)
+		self._obs = np.zeros(self.shape, np.uint8)
+		# Channel sums in surfarray (x, y) order
+		self._sum = np.empty((self.shape[2], self.shape[1]), np.uint16)
+		self._channel = np.empty_like(self._sum)
+		self._next = 0
+
+	def reset(self) -> None:
+		self._frames.fill(0)
+		self._next = 0
+
+	# Add the current content of the surface to the stack
+	def capture(self) -> None:
+		step = self._downsample
+		width, height = self._sum.shape
+		# The view locks the surface until it is deleted
+		pixels = pygame.surfarray.pixels3d(self._surface)
+		view = pixels[:width * step:step, :height * step:step]
+		np.multiply(view[..., 0], _GRAY_WEIGHTS[0], out=self._sum, dtype=np.uint16)
+		for channel in (1, 2):
+			np.multiply(view[..., channel], _GRAY_WEIGHTS[channel], out=self._channel, dtype=np.uint16)
+			np.add(self._sum, self._channel, out=self._sum)
+		del view, pixels
+		np.right_shift(self._sum, 8, out=self._frames[self._next].T, casting="unsafe")
+		self._next = (self._next + 1) % self._stack
+
+	# Stacked frames, oldest first, as a (stack, height, width) uint8 array.
+	# The array is reused by the next call, copy it to keep it
+	def observation(self) -> np.ndarray:
+		split = self._stack - self._next
+		self._obs[:split] = self._frames[self._next:]
+		self._obs[split:] = self._frames[:self._next]
+		return self._obs
+
+
+# Event source playing the action set by PongEnv.step, serving right away
+# like ScriptedInput
+class _ActionInput:
+	def __init__(self, ball: pong.Ball) -> None:
+		self._ball = ball
+		self.action = NOOP
+		self._held_key = None
+
+	def reset(self) -> None:
+		self.action = NOOP
+		self._held_key = None
+
+	def __call__(self) -> list:
+		events = []
+		if self._ball.speed_x == 0 and self._ball.speed_y == 0:
+			events.append(pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE))
+		wanted_key = _ACTION_KEYS[self.action]
+		if wanted_key != self._held_key:
+			if self._held_key is not None:
+				events.append(pygame.event.Event(pygame.KEYUP, key=self._held_key))
+			if wanted_key is not None:
+				events.append(pygame.event.Event(pygame.KEYDOWN, key=wanted_key))
+			self._held_key = wanted_key
+		return events
+
+
+# Gym-style environment: the agent plays the right paddle against the CPU.
+# Each step plays the action for frame_skip ticks and draws one frame to an
+# offscreen surface, no window or frame limit. The reward is the change of
+# the score difference, the episode ends when a side reaches max_score
+class PongEnv:
+	action_count = 3
+
+	def __init__(self, width: int = 320,
+				 height: int = 240,
+				 downsample: int = 4,
+				 stack: int = 4,
+				 frame_skip: int = 4,
+				 max_score: int = 5,
+				 seed: int = None,
+				 cpu: str = "follow",
+				 cpu_delay: int = 0,
+				 cpu_error: float = 0) -> None:
+		self.game = pong.build_game(width, height, pong.rgb_colors["lightgrey"], "agent",
+									max_score=max_score, seed=seed, cpu=cpu, cpu_delay=cpu_delay,
+									cpu_error=cpu_error, offscreen=True)
+		# The end of a match ends the episode, not the process
+		self.game._exit_on_end = False
+		self._input = _ActionInput(self.game._ball)
+		self.game._event_source = self._input
+		self._frame_skip = frame_skip
+		self.observer = PixelObserver(self.game._game_field.get_screen(), downsample, stack)
+		self.observation_shape = self.observer.shape
+
+	def _render(self) -> None:
+		self.game._draw_frame()
+		self.observer.capture()
+
+	def _info(self) -> dict:
+		return {"tick": self.game._tick, **self.game.get_result()}
+
+	def reset(self, seed: int = None) -> tuple:
+		self.game.new_match(seed)
+		self._input.reset()
+		self.observer.reset()
+		self._render()
+		return self.observer.observation(), self._info()
+
+	# Returns observation, reward, terminated, truncated, info
+	def step(self, action: int) -> tuple:
+		game = self.game
+		stat = game._stat
+		before = stat["player_score"] - stat["cpu_score"]
+		self._input.action = action
+		for _ in range(self._frame_skip):
+			game._update_state()
+			if game._game_over:
+				break
+		self._render()
+		reward = stat["player_score"] - stat["cpu_score"] - before
+		return self.observer.observation(), reward, game._game_over, False, self._info()
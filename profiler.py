@@ -0,0 +1,60 @@
+import cProfile
+import os
+import sys
+import threading
+import time
+
+
+# Samples the stack of one thread at a fixed interval and counts identical
+# stacks, in the collapsed format read by flamegraph.pl and speedscope
+class StackSampler(threading.Thread):
+	def __init__(self, thread_id: int, interval: float = 0.001) -> None:
+		super().__init__(name="pong-sampler", daemon=True)
+		self._thread_id = thread_id
+		self._interval = interval
+		self._stopped = threading.Event()
+		self.stacks = {}
+
+	def run(self) -> None:
+		while not self._stopped.is_set():
+			frame = sys._current_frames().get(self._thread_id)
+			names = []
+			while frame is not None:
+				code = frame.f_code
+				names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+				frame = frame.f_back
+			if names:
+				stack = ";".join(reversed(names))
+				self.stacks[stack] = self.stacks.get(stack, 0) + 1
+			time.sleep(self._interval)
+
+	def stop(self) -> None:
+		self._stopped.set()
+		self.join()
+
+	def write_collapsed(self, path: str) -> None:
+		with open(path, "w") as collapsed_file:
+			for stack, count in sorted(self.stacks.items()):
+				collapsed_file.write(f"{stack} {count}\n")
+
+
+# Call run_frame up to `frames` times (less if it returns False) under
+# cProfile and the stack sampler. Writes <prefix>.pstats and <prefix>.folded
+# and returns the number of frames run
+def profile_frames(run_frame, frames: int, prefix: str) -> int:
+	profile = cProfile.Profile()
+	sampler = StackSampler(threading.get_ident())
+	sampler.start()
+	done = 0
+	profile.enable()
+	try:
+		while done < frames:
+			done += 1
+			if run_frame() is False:
+				break
+	finally:
+		profile.disable()
+		sampler.stop()
+	profile.dump_stats(f"{prefix}.pstats")
+	sampler.write_collapsed(f"{prefix}.folded")
+	return done
@@ -0,0 +1,213 @@
+import asyncio
+import struct
+from collections import deque
+
+# Streamed fields, in message order. The ball center is sent in 1/8 pixels
+FIELDS = ("ball_x", "ball_y", "left_y", "right_y", "cpu_score", "player_score",
+		  "level", "last_diff", "winner")
+BALL_SCALE = 8
+WINNER_CODES = {"none": 0, "player": 1, "cpu": 2}
+WINNER_NAMES = {code: name for name, code in WINNER_CODES.items()}
+
+# KEYFRAME: type, tick, every field
+# DELTA: type, tick, bit mask of the changed fields, then the change of each
+#        of them from the previous tick, in field order
+_KEYFRAME = struct.Struct("<BI9i")
+_DELTA_HEADER = struct.Struct("<BIH")
+_DELTA_VALUE = struct.Struct("<h")
+_MSG_KEYFRAME = 1
+_MSG_DELTA = 2
+_DELTA_MIN = -32768
+_DELTA_MAX = 32767
+
+
+def _capture(game) -> tuple:
+	stat = game._stat
+	return (round(game._ball.center_x * BALL_SCALE), round(game._ball.center_y * BALL_SCALE),
+			game._computer.rect.y, game._player.rect.y, stat["cpu_score"], stat["player_score"],
+			stat["level"], stat["last_diff"], WINNER_CODES[stat["winner"]])
+
+
+# In process subscriber: messages are queued until poll()
+class Subscriber:
+	def __init__(self, max_backlog: int = 64) -> None:
+		self.max_backlog = max_backlog
+		self.messages = deque()
+		# Set while the subscriber only gets keyframes. New subscribers start
+		# this way, a delta is useless without the keyframe before it
+		self.keyframes_only = True
+
+	def backlog(self) -> int:
+		return len(self.messages)
+
+	def send(self, data: bytes) -> None:
+		self.messages.append(data)
+
+	def poll(self) -> bytes:
+		data = b"".join(self.messages)
+		self.messages.clear()
+		return data
+
+
+# Subscriber behind a socket, its backlog is the transport write buffer
+class StreamSubscriber(Subscriber):
+	def __init__(self, writer: asyncio.StreamWriter, max_backlog: int = 16384) -> None:
+		super().__init__(max_backlog)
+		self._writer = writer
+
+	def backlog(self) -> int:
+		return self._writer.transport.get_write_buffer_size()
+
+	def send(self, data: bytes) -> None:
+		self._writer.write(data)
+
+
+# Encodes the state of a game once per tick and fans the same bytes out to
+# every subscriber. A keyframe every keyframe_interval ticks, quantized deltas
+# in between. Subscribers whose backlog reaches their max_backlog are switched
+# to keyframes only until they have read everything, the game never waits and
+# no subscriber holds more than max_backlog messages
+class SpectatorFeed:
+	def __init__(self, game, keyframe_interval: int = 60) -> None:
+		self._game = game
+		self._keyframe_interval = keyframe_interval
+		self._last = None
+		self.subscribers = []
+		self.ticks = 0
+		self.keyframes = 0
+		self.bytes_encoded = 0
+		self.bytes_sent = 0
+		self.subscriber_ticks = 0
+
+	def subscribe(self, subscriber: Subscriber = None) -> Subscriber:
+		subscriber = subscriber if subscriber else Subscriber()
+		self.subscribers.append(subscriber)
+		return subscriber
+
+	def unsubscribe(self, subscriber: Subscriber) -> None:
+		self.subscribers.remove(subscriber)
+
+	def _encode(self, tick: int, state: tuple) -> tuple:
+		last = self._last
+		if last is not None and tick % self._keyframe_interval != 0:
+			mask = 0
+			values = []
+			for index, (value, previous) in enumerate(zip(state, last)):
+				if value != previous:
+					mask |= 1 << index
+					values.append(value - previous)
+			if all(_DELTA_MIN <= value <= _DELTA_MAX for value in values):
+				return False, _DELTA_HEADER.pack(_MSG_DELTA, tick, mask) + b"".join(
+					_DELTA_VALUE.pack(value) for value in values)
+		return True, _KEYFRAME.pack(_MSG_KEYFRAME, tick, *state)
+
+	# Call once per game tick
+	def publish(self) -> None:
+		state = _capture(self._game)
+		keyframe, data = self._encode(self._game._tick, state)
+		self._last = state
+		self.ticks += 1
+		self.keyframes += keyframe
+		self.bytes_encoded += len(data)
+		sent = 0
+		for subscriber in self.subscribers:
+			if subscriber.keyframes_only:
+				if not keyframe:
+					continue
+				backlog = subscriber.backlog()
+				if backlog >= subscriber.max_backlog:
+					continue
+				# Caught up: the full stream starts again at this keyframe
+				if backlog == 0:
+					subscriber.keyframes_only = False
+			elif subscriber.backlog() >= subscriber.max_backlog:
+				subscriber.keyframes_only = True
+				continue
+			subscriber.send(data)
+			sent += len(data)
+		self.bytes_sent += sent
+		self.subscriber_ticks += len(self.subscribers)
+
+	def stats(self) -> dict:
+		return {"subscribers": len(self.subscribers),
+				"keyframes_only": sum(subscriber.keyframes_only for subscriber in self.subscribers),
+				"ticks": self.ticks,
+				"keyframes": self.keyframes,
+				"bytes_encoded_per_tick": self.bytes_encoded / self.ticks if self.ticks else None,
+				"bytes_per_tick_per_spectator": self.bytes_sent / self.subscriber_ticks if self.subscriber_ticks else None}
+
+
+# Rebuilds the game state from the feed. Deltas received before the first
+# keyframe are skipped
+class SpectatorDecoder:
+	def __init__(self) -> None:
+		self.tick = None
+		self.values = None
+		self._buffer = b""
+
+	# Apply every complete message in data, a partial one is kept for the next call
+	def feed(self, data: bytes) -> None:
+		buffer = self._buffer + data
+		offset = 0
+		while offset < len(buffer):
+			msg_type = buffer[offset]
+			if msg_type == _MSG_KEYFRAME:
+				if len(buffer) - offset < _KEYFRAME.size:
+					break
+				_, self.tick, *values = _KEYFRAME.unpack_from(buffer, offset)
+				self.values = values
+				offset += _KEYFRAME.size
+			elif msg_type == _MSG_DELTA:
+				if len(buffer) - offset < _DELTA_HEADER.size:
+					break
+				_, tick, mask = _DELTA_HEADER.unpack_from(buffer, offset)
+				size = _DELTA_HEADER.size + _DELTA_VALUE.size * bin(mask).count("1")
+				if len(buffer) - offset < size:
+					break
+				position = offset + _DELTA_HEADER.size
+				offset += size
+				if self.values is None:
+					continue
+				for index in range(len(FIELDS)):
+					if mask & (1 << index):
+						self.values[index] += _DELTA_VALUE.unpack_from(buffer, position)[0]
+						position += _DELTA_VALUE.size
+				self.tick = tick
+			else:
+				raise ValueError(f"Unknown spectator message type {msg_type}")
+		self._buffer = buffer[offset:]
+
+	@property
+	def state(self) -> dict:
+		if self.values is None:
+			return None
+		state = dict(zip(FIELDS, self.values))
+		state["ball_x"] /= BALL_SCALE
+		state["ball_y"] /= BALL_SCALE
+		state["winner"] = WINNER_NAMES[state["winner"]]
+		return state
+
+
+# Serves a feed to spectators over TCP, the server never reads from them
+class SpectatorServer:
+	def __init__(self, feed: SpectatorFeed, max_backlog: int = 16384) -> None:
+		self._feed = feed
+		self._max_backlog = max_backlog
+		self._server = None
+
+	async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+		self._server = await asyncio.start_server(self._handle, host, port)
+		return self._server.sockets[0].getsockname()[1]
+
+	async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+		subscriber = self._feed.subscribe(StreamSubscriber(writer, self._max_backlog))
+		try:
+			await reader.read()
+		except ConnectionError:
+			pass
+		self._feed.unsubscribe(subscriber)
+		writer.close()
+
+	async def close(self) -> None:
+		self._server.close()
+		await self._server.wait_closed()
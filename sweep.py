@@ -0,0 +1,194 @@
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import time
+
+import tournament
+
+# Part of every cache key: bump it when a change to the game makes the
+# stored results stale
+CACHE_VERSION = 2
+
+# DEFAULT_CONFIG entries the game does not read: a sweep over them would
+# play the same matches at every point
+UNUSED_PARAMS = ("ball_speed_increment",)
+
+
+# Key of a match: hash of its full config, seed included
+def config_key(config: dict) -> str:
+	config = {**tournament.DEFAULT_CONFIG, **config}
+	data = json.dumps([CACHE_VERSION, config], sort_keys=True)
+	return hashlib.sha256(data.encode()).hexdigest()
+
+
+# Match results by config key, in a JSON lines file that only grows. A line
+# cut short by an interrupted run is skipped on load
+class ResultCache:
+	def __init__(self, path: str = None) -> None:
+		self.path = path
+		self._results = {}
+		if path and os.path.exists(path):
+			with open(path) as cache_file:
+				for line in cache_file:
+					try:
+						entry = json.loads(line)
+					except json.JSONDecodeError:
+						continue
+					self._results[entry["key"]] = entry["result"]
+
+	def __len__(self) -> int:
+		return len(self._results)
+
+	def get(self, config: dict) -> dict:
+		return self._results.get(config_key(config))
+
+	def put_all(self, results: list) -> None:
+		lines = []
+		for result in results:
+			key = config_key(result["config"])
+			self._results[key] = result
+			lines.append(json.dumps({"key": key, "result": result}) + "\n")
+		if self.path and lines:
+			with open(self.path, "a") as cache_file:
+				cache_file.writelines(lines)
+
+
+# Every combination of the values of a {name: [values]} grid
+def grid_points(grid: dict) -> list:
+	names = list(grid)
+	return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+# count points drawn uniformly from {name: (low, high)}. With the same rng
+# seed, a longer sweep starts with the points of a shorter one
+def random_points(ranges: dict, count: int, rng: random.Random) -> list:
+	return [{name: round(rng.uniform(low, high), 4) for name, (low, high) in ranges.items()}
+			for _ in range(count)]
+
+
+# count points around the best ones of summaries, closest win rate to
+# target first: gaussian steps of spread times each range, kept inside it
+def refine_points(ranges: dict, summaries: list, count: int, rng: random.Random,
+				  target: float = 0.5, spread: float = 0.25, best: int = 3) -> list:
+	parents = sorted(summaries, key=lambda summary: _distance(summary, target))[:best]
+	points = []
+	for index in range(count):
+		parent = parents[index % len(parents)]["params"]
+		point = {}
+		for name, (low, high) in ranges.items():
+			value = rng.gauss(parent[name], spread * (high - low))
+			point[name] = round(min(high, max(low, value)), 4)
+		points.append(point)
+	return points
+
+
+def _distance(summary: dict, target: float) -> float:
+	win_rate = summary["player_win_rate"]
+	return abs(win_rate - target) if win_rate is not None else float("inf")
+
+
+def _summarize(point: dict, results: list, computed: int) -> dict:
+	summary = tournament.aggregate(results)
+	decided = summary["winners"]["player"] + summary["winners"]["cpu"]
+	return {"params": point,
+			"matches": summary["matches"],
+			"player_win_rate": summary["winners"]["player"] / decided if decided else None,
+			"hits_per_point": summary["hits_per_point"],
+			"ticks_per_point": summary["ticks_per_point"],
+			"max_level": summary["max_level"],
+			"computed": computed}
+
+
+# Play seeds matches per point, base config under the point values, and
+# summarize each point. Only matches missing from the cache are played, on
+# the tournament process pool
+def run_sweep(points: list, seeds: int, workers: int = None, cache: ResultCache = None,
+			  base: dict = None) -> list:
+	cache = cache if cache is not None else ResultCache()
+	base = base or {}
+	configs = [[{**base, **point, "seed": seed} for seed in range(seeds)] for point in points]
+	missing = {}
+	for point_configs in configs:
+		for config in point_configs:
+			if cache.get(config) is None:
+				missing[config_key(config)] = config
+	if missing:
+		cache.put_all(tournament.run_tournament(list(missing.values()), workers)["results"])
+	summaries = []
+	for point, point_configs in zip(points, configs):
+		computed = sum(config_key(config) in missing for config in point_configs)
+		summaries.append(_summarize(point, [cache.get(config) for config in point_configs], computed))
+	return summaries
+
+
+# Random search, then rounds sampling around the best points so far with a
+# spread halved at each round
+def adaptive_sweep(ranges: dict, samples: int, rounds: int, seeds: int, rng: random.Random,
+				   target: float = 0.5, workers: int = None, cache: ResultCache = None,
+				   base: dict = None) -> list:
+	summaries = run_sweep(random_points(ranges, samples, rng), seeds, workers, cache, base)
+	spread = 0.25
+	for _ in range(rounds):
+		points = refine_points(ranges, summaries, samples, rng, target, spread)
+		summaries += run_sweep(points, seeds, workers, cache, base)
+		spread /= 2
+	return summaries
+
+
+def _format(summary: dict) -> str:
+	params = " ".join(f"{name}={value}" for name, value in summary["params"].items())
+	win_rate = summary["player_win_rate"]
+	hits = summary["hits_per_point"]
+	return (f"{params:50}  win {'-' if win_rate is None else f'{win_rate:.2f}':>5}"
+			f"  rally {'-' if hits is None else f'{hits:.2f}':>6}  max level {summary['max_level']}"
+			f"  new {summary['computed']}/{summary['matches']}")
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Sweep match parameters, see tournament.DEFAULT_CONFIG for the names')
+	parser.add_argument('--grid', nargs='+', action='append', default=[], metavar=('NAME', 'VALUE'),
+						help='Parameter and its values, all combinations of the grids are played')
+	parser.add_argument('--range', nargs=3, action='append', default=[], metavar=('NAME', 'LOW', 'HIGH'),
+						help='Parameter sampled between LOW and HIGH')
+	parser.add_argument('-n', '--samples', type=int, default=20, help='Points per round with --range (dflt 20)')
+	parser.add_argument('-r', '--rounds', type=int, default=0, help='Rounds refining the best points with --range (dflt 0, random search only)')
+	parser.add_argument('-t', '--target', type=float, default=0.5, help='Player win rate to aim for (dflt 0.5)')
+	parser.add_argument('-s', '--seeds', type=int, default=10, help='Matches per point (dflt 10)')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the random search (dflt 0)')
+	parser.add_argument('--max-ticks', type=int, default=100000, help='Ticks before a match is left undecided (dflt 100000)')
+	parser.add_argument('-w', '--workers', type=int, default=None, help='Worker processes (dflt all cores)')
+	parser.add_argument('--cache', type=str, default='sweep_cache.jsonl', help='Result cache file (dflt sweep_cache.jsonl)')
+	parser.add_argument('-o', '--output', type=str, default=None, help='Write the point summaries to this JSON file')
+	args = parser.parse_args()
+	if bool(args.grid) == bool(args.range):
+		parser.error('give either --grid or --range')
+	for name in [values[0] for values in args.grid] + [name for name, _, _ in args.range]:
+		if name in UNUSED_PARAMS:
+			parser.error(f'{name} is not used by the game, sweeping it changes nothing')
+
+	cache = ResultCache(args.cache)
+	base = {"max_ticks": args.max_ticks}
+	start = time.perf_counter()
+	if args.grid:
+		grid = {values[0]: [json.loads(value) for value in values[1:]] for values in args.grid}
+		summaries = run_sweep(grid_points(grid), args.seeds, args.workers, cache, base)
+	else:
+		ranges = {name: (float(low), float(high)) for name, low, high in args.range}
+		summaries = adaptive_sweep(ranges, args.samples, args.rounds, args.seeds, random.Random(args.seed),
+								   args.target, args.workers, cache, base)
+	elapsed = time.perf_counter() - start
+	for summary in sorted(summaries, key=lambda summary: _distance(summary, args.target)):
+		print(_format(summary))
+	computed = sum(summary["computed"] for summary in summaries)
+	print(f"{len(summaries)} points, {computed} matches played, "
+		  f"{sum(summary['matches'] for summary in summaries) - computed} from cache, in {elapsed:.2f}s")
+	if args.output:
+		with open(args.output, "w") as output_file:
+			json.dump(summaries, output_file, indent=2)
+
+if __name__ == '__main__':
+	main()
@@ -1,8 +1,39 @@
 import unittest
 from unittest.mock import MagicMock, patch
 from io import StringIO
+import json
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+# Per-user caches (fonts.json) go to a temporary directory, not the real home
+_cache_home = tempfile.TemporaryDirectory()
+os.environ['XDG_CACHE_HOME'] = _cache_home.name
+import csv
+import logging
+import asyncio
 import pygame
-from pong import Ball, Gamer, GameField, PongGame, get_random, rgb_colors
+try:
+    import numpy
+    from batch_pong import BatchPong, WINNER_CPU, WINNER_PLAYER
+    import pong_env
+except ImportError:
+    numpy = None
+import bench
+import match_history
+import match_server
+import multiball
+import netplay
+import profiler
+import spectator
+import sweep
+import pstats
+import tournament
+import pong as pong_module
+from pong import Ball, FrameState, FrameTimer, Gamer, GameField, PongGame, RenderThread, ReplayPlayer, ReplayRecorder, ScriptedInput, TextCache, build_game, get_random, rgb_colors
 
 def get_default_game_objects() -> tuple[GameField, Ball, Gamer, Gamer, PongGame] :
     screen_width = 320
@@ -238,26 +269,23 @@ class TestGame(unittest.TestCase):
         pong._check_collision = MagicMock()
         pong._move_computer = MagicMock()
         pong._update_events = MagicMock()
-        pong._ball.update_pos = MagicMock()
-        pong._player.update_pos = MagicMock()
-        pong._computer.update_pos = MagicMock()
-        pong._ball.draw = MagicMock()
-        pong._player.draw = MagicMock()
-        pong._computer.draw = MagicMock()
         gamefield.fill_screen = MagicMock()
         gamefield.get_screen = MagicMock()
         gamefield.draw_borders = MagicMock()
         pong._write_score = MagicMock()
-        pong.run_game_once()
-        self.assertTrue(pong._check_collision.called)
-        self.assertTrue(pong._move_computer.called)
-        self.assertTrue(pong._update_events.called)
-        self.assertTrue(pong._ball.update_pos.called)
-        self.assertTrue(pong._computer.update_pos.called)
-        self.assertTrue(pong._player.update_pos.called)
-        self.assertTrue(pong._ball.draw.called)
-        self.assertTrue(pong._player.draw.called)
-        self.assertTrue(pong._computer.draw.called)
+        # Ball and Gamer use __slots__, their methods are patched on the class
+        with patch.object(Ball, 'update_pos'), patch.object(Gamer, 'update_pos'), \
+                patch.object(Ball, 'draw'), patch.object(Gamer, 'draw'):
+            pong.run_game_once()
+            self.assertTrue(pong._check_collision.called)
+            self.assertTrue(pong._move_computer.called)
+            self.assertTrue(pong._update_events.called)
+            self.assertTrue(pong._ball.update_pos.called)
+            self.assertTrue(pong._computer.update_pos.called)
+            self.assertTrue(pong._player.update_pos.called)
+            self.assertTrue(pong._ball.draw.called)
+            self.assertTrue(pong._player.draw.called)
+            self.assertTrue(pong._computer.draw.called)
         self.assertTrue(gamefield.fill_screen.called)
         self.assertTrue(gamefield.get_screen.called)
         self.assertTrue(gamefield.draw_borders.called)
@@ -267,9 +295,9 @@ class TestGame(unittest.TestCase):
 class TestGamer(unittest.TestCase):
     def test_draw(self):
         gamefield, ball, player, computer, pong = get_default_game_objects()
-        pygame.draw.rect = MagicMock()
-        player.draw(gamefield.get_screen())
-        self.assertTrue(pygame.draw.rect.called)
+        with patch('pygame.draw.rect') as draw_rect:
+            player.draw(gamefield.get_screen())
+        self.assertTrue(draw_rect.called)
     
     def test_update_pos(self):
         # Create a Gamer instance with predefined values for testing
@@ -328,9 +356,9 @@ class TestGameField(unittest.TestCase):
         game_field, ball, player, computer, pong = get_default_game_objects()
         pong.run_game_once()
         game_field.screen = MagicMock()
-        pygame.draw.aaline = MagicMock()
-        game_field.draw_borders()
-        self.assertEqual(pygame.draw.aaline.call_args[0][1], pygame.Color(game_field.line_color))
+        with patch('pygame.draw.aaline') as draw_aaline:
+            game_field.draw_borders()
+        self.assertEqual(draw_aaline.call_args[0][1], pygame.Color(game_field.line_color))
 
 
 class TestBall(unittest.TestCase):
@@ -384,5 +412,1216 @@ class TestBall(unittest.TestCase):
         self.assertEqual(ball.center_x, 51)
         self.assertEqual(ball.center_y, 51)
 
+
+class TestTextCache(unittest.TestCase):
+    def test_render_once(self):
+        font = MagicMock()
+        cache = TextCache(font)
+        first = cache.render('0    1', (255, 0, 0))
+        self.assertIs(cache.render('0    1', (255, 0, 0)), first)
+        self.assertEqual(font.render.call_count, 1)
+        cache.render('0    1', (0, 255, 0))
+        self.assertEqual(font.render.call_count, 2)
+
+    def test_eviction(self):
+        font = MagicMock()
+        cache = TextCache(font, max_size=2)
+        cache.render('a', (0, 0, 0))
+        cache.render('b', (0, 0, 0))
+        cache.render('a', (0, 0, 0))
+        cache.render('c', (0, 0, 0))
+        self.assertEqual(len(cache), 2)
+        # 'b' was the least recently used
+        cache.render('a', (0, 0, 0))
+        self.assertEqual(font.render.call_count, 3)
+        cache.render('b', (0, 0, 0))
+        self.assertEqual(font.render.call_count, 4)
+
+    def test_write_score_uses_cache(self):
+        gamefield, ball, player, computer, pong = get_default_game_objects()
+        font = MagicMock()
+        font.render.return_value = pygame.Surface((10, 10))
+        pong._text_cache = TextCache(font)
+        pong._write_score()
+        pong._write_score()
+        self.assertEqual(font.render.call_count, 1)
+        pong._stat['cpu_score'] += 1
+        pong._write_score()
+        self.assertEqual(font.render.call_count, 2)
+
+
+class TestDirtyRects(unittest.TestCase):
+    def test_same_frame_as_full_redraw(self):
+        pong = build_game(320, 240, rgb_colors['red'], 'player', dirty_rects=True)
+        pong._fps = 0
+        pong._event_source = ScriptedInput(pong._ball, pong._player)
+        screen = pong._game_field.get_screen()
+        # The second frame is the first dirty one, the score is not redrawn
+        for ticks in (2, 300):
+            while pong._tick < ticks:
+                pong.run_game_once()
+            dirty_frame = pygame.image.tostring(screen, 'RGB')
+            pong._draw_frame()
+            self.assertEqual(dirty_frame, pygame.image.tostring(screen, 'RGB'))
+
+    def test_updates_only_dirty_rects(self):
+        pong = build_game(320, 240, rgb_colors['red'], 'player', dirty_rects=True)
+        pong._fps = 0
+        pong.run_game_once()
+        with patch.object(pygame.display, 'update') as update, patch.object(pygame.display, 'flip') as flip:
+            pong.run_game_once()
+            self.assertFalse(flip.called)
+            rects = update.call_args[0][0]
+            # old and new ball and paddles; the score is unchanged and not hit
+            self.assertEqual(len(rects), 6)
+            self.assertIn(pong._ball.get_rect(), rects)
+
+
+class TestPipelined(unittest.TestCase):
+    def test_frame_state(self):
+        gamefield, ball, player, computer, pong = get_default_game_objects()
+        state = pong.get_frame_state()
+        self.assertEqual((state.ball_x, state.ball_y), (ball.center_x, ball.center_y))
+        self.assertEqual(state.player_rect, tuple(player.rect))
+        ball.set_pos(1, 2)
+        player.set_pos(3, 4)
+        # the snapshot does not follow the game objects
+        self.assertEqual(state.ball_x, gamefield.disp_w / 2)
+        self.assertNotEqual(state.player_rect, tuple(player.rect))
+
+    def test_slow_renderer_drops_frames(self):
+        drawn = []
+        renderer = RenderThread(lambda state: (drawn.append(state.tick), time.sleep(0.01)), queue_size=1)
+        renderer.start()
+        for tick in range(50):
+            renderer.submit(FrameState(tick, 0, 0, (0, 0, 1, 1), (0, 0, 1, 1), 0, 0))
+        renderer.stop()
+        stats = renderer.get_stats()
+        self.assertEqual(stats['submitted'], 50)
+        self.assertGreater(stats['dropped'], 0)
+        self.assertEqual(stats['rendered'] + stats['dropped'], 50)
+        self.assertEqual(drawn, sorted(drawn))
+
+    def test_frame_taken_by_renderer_is_not_dropped(self):
+        renderer = RenderThread(lambda state: None, queue_size=1)
+        state = FrameState(0, 0, 0, (0, 0, 1, 1), (0, 0, 1, 1), 0, 0)
+        # The queue was full, but the render thread took the frame first
+        renderer._queue = MagicMock()
+        renderer._queue.put_nowait.side_effect = [queue.Full, None]
+        renderer._queue.get_nowait.side_effect = queue.Empty
+        renderer.submit(state)
+        self.assertEqual(renderer.get_stats()['dropped'], 0)
+
+    def test_simulation_does_not_wait_for_render(self):
+        pong = build_game(320, 240, rgb_colors['red'], 'player', pipelined=True)
+        pong._fps = 0
+        pong._draw_state = MagicMock(side_effect=lambda state: time.sleep(0.005))
+        pong._renderer._draw_state = pong._draw_state
+        start = time.perf_counter()
+        for _ in range(200):
+            pong.run_game_once()
+        self.assertLess(time.perf_counter() - start, 200 * 0.005)
+        self.assertEqual(pong._tick, 200)
+        stats = pong.get_render_stats()
+        self.assertEqual(stats['submitted'], 200)
+        self.assertGreater(stats['dropped'], 0)
+        pong._stop_renderer()
+        self.assertIsNone(pong.get_render_stats())
+
+    def test_display_calls_on_main_thread(self):
+        pong = build_game(320, 240, rgb_colors['red'], 'player', pipelined=True)
+        pong._fps = 0
+        threads = set()
+        flip = pygame.display.flip
+        with patch('pygame.display.flip', side_effect=lambda: (threads.add(threading.current_thread()), flip())):
+            for _ in range(50):
+                pong.run_game_once()
+                time.sleep(0.001)
+            pong._stop_renderer()
+        self.assertEqual(threads, {threading.main_thread()})
+        # The render thread keeps its score state to itself
+        self.assertIsNone(pong._score_str)
+        self.assertEqual(pong._game_field.get_screen().get_at((int(pong._ball.center_x), int(pong._ball.center_y)))[:3],
+                         rgb_colors['red'])
+
+
+class TestCompactState(unittest.TestCase):
+    def test_slots(self):
+        ball = Ball(50, 50, 5, (255, 255, 255), 100, 100)
+        gamer = Gamer(50, 50, 10, 40, (255, 255, 255), "Player 1", 100, 100)
+        self.assertFalse(hasattr(ball, '__dict__'))
+        self.assertFalse(hasattr(gamer, '__dict__'))
+
+    def test_ball_borders(self):
+        ball = Ball(50, 60, 5, (255, 255, 255), 100, 100)
+        borders = ball.get_borders()
+        self.assertEqual((ball.left, ball.right, ball.top, ball.bott),
+                         (borders['left'], borders['right'], borders['top'], borders['bott']))
+
+    def test_steady_state_tick_does_not_allocate(self):
+        pong = build_game(320, 240, rgb_colors['red'], 'player', headless=True)
+        pong.run_headless(2000)
+        tracemalloc.start()
+        try:
+            before, _ = tracemalloc.get_traced_memory()
+            pong.run_headless(2000)
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(pong._tick, 4000)
+        # nothing is kept but the new tick counter, and no tick builds
+        # border dicts or speed tuples on the way
+        self.assertLessEqual(after - before, 64)
+        self.assertLessEqual(peak - before, 256)
+
+
+class TestSweptCollision(unittest.TestCase):
+    def test_sweep_bounces_off_walls(self):
+        ball = Ball(50, 8, 5, (255, 255, 255), 100, 100, speed_x=1, speed_y=-10)
+        player_rect = pygame.Rect(90, 0, 5, 20)
+        computer_rect = pygame.Rect(5, 0, 5, 20)
+        self.assertIsNone(ball.sweep(player_rect, computer_rect))
+        # 3 px up to the wall, 7 px back down
+        self.assertAlmostEqual(ball.center_y, 5 + 7)
+        self.assertEqual(ball.speed_y, 10)
+        self.assertAlmostEqual(ball.center_x, 51)
+
+    def test_sweep_hits_paddle_face(self):
+        ball = Ball(70, 50, 5, (255, 255, 255), 200, 100, speed_x=40, speed_y=0)
+        player_rect = pygame.Rect(90, 30, 10, 40)
+        computer_rect = pygame.Rect(5, 30, 10, 40)
+        self.assertIs(ball.sweep(player_rect, computer_rect), player_rect)
+        # 15 px to the face, 25 px back
+        self.assertEqual(ball.center_x, 60)
+        self.assertEqual(ball.speed_x, -40)
+        # a ball passing above the paddle is not stopped
+        ball = Ball(70, 10, 5, (255, 255, 255), 200, 100, speed_x=40, speed_y=0)
+        self.assertIsNone(ball.sweep(player_rect, computer_rect))
+        self.assertEqual(ball.center_x, 110)
+
+    def test_no_tunnelling_at_low_fps(self):
+        for swept, expected_cpu_score in ((False, 1), (True, 0)):
+            pong = build_game(320, 240, rgb_colors['red'], 'player', fps=5, headless=True,
+                              swept_collision=swept)
+            player = pong._player
+            pong._event_source = lambda: ()
+            # fast ball a few pixels in front of the paddle, aimed at its middle
+            pong._ball.set_pos(player.rect.left - 8, player.rect.centery)
+            pong._ball.speed_x, pong._ball.speed_y = 25, 0
+            pong.run_headless(2)
+            self.assertEqual(pong._stat['cpu_score'], expected_cpu_score)
+        self.assertLess(pong._ball.speed_x, 0)
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.rpl')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def record(self, ticks: int, **extra) -> PongGame:
+        config = {'screen_width': 320, 'screen_height': 240, 'color': rgb_colors['red'],
+                  'player_name': 'player', 'fps': 120, 'max_score': 3, 'seed': 7, 'swept_collision': False,
+                  **extra}
+        pong = build_game(**config, headless=True, aim_error=30)
+        recorder = ReplayRecorder(self.path, config, pong)
+        pong.run_headless(ticks)
+        recorder.close()
+        return pong
+
+    def state(self, pong: PongGame) -> tuple:
+        return (pong._tick, pong._ball.center_x, pong._ball.center_y, pong._ball.speed_x,
+                pong._player.rect.y, pong._computer.rect.y, dict(pong._stat))
+
+    def test_replay_matches_recording(self):
+        pong = self.record(5000)
+        player = ReplayPlayer(self.path)
+        self.assertEqual(player.end_tick, pong._tick)
+        self.assertEqual(player.run(), pong.get_result())
+        self.assertEqual(self.state(player.game), self.state(pong))
+        player.close()
+
+    def test_replay_with_predictive_cpu_error(self):
+        # The CPU aim errors and the scripted player aim errors are both drawn
+        # while recording, only the CPU ones on replay
+        pong = self.record(5000, max_score=5, cpu='predictive', cpu_error=30)
+        player = ReplayPlayer(self.path)
+        self.assertEqual(player.run(), pong.get_result())
+        self.assertEqual(self.state(player.game), self.state(pong))
+        player.close()
+
+    def test_seek(self):
+        expected = self.state(self.record(1500))
+        player = ReplayPlayer(self.path)
+        player.seek(3000)
+        player.seek(1500)
+        self.assertEqual(self.state(player.game), expected)
+        player.seek(1000)
+        player.seek(1500)
+        self.assertEqual(self.state(player.game), expected)
+        player.close()
+
+    def test_windowed_match_keeps_winning_point(self):
+        config = {'screen_width': 320, 'screen_height': 240, 'color': rgb_colors['red'],
+                  'player_name': 'player', 'fps': 120, 'max_score': 1, 'seed': 7, 'swept_collision': False}
+        pong = build_game(**config)
+        pong._fps = 0
+        pong._event_source = ScriptedInput(pong._ball, pong._player, aim_error=30, rng=pong._rng)
+        recorder = ReplayRecorder(self.path, config, pong)
+        with patch('pong.sleep'), self.assertRaises(SystemExit):
+            while True:
+                pong.run_game_once()
+        recorder.close()
+        self.assertNotEqual(pong._stat['winner'], 'none')
+        player = ReplayPlayer(self.path)
+        self.assertTrue(player.finished)
+        result = player.run()
+        self.assertEqual(result['winner'], pong._stat['winner'])
+        self.assertEqual((result['player_score'], result['cpu_score']),
+                         (pong._stat['player_score'], pong._stat['cpu_score']))
+        player.close()
+
+    def test_not_a_replay(self):
+        with open(self.path, 'wb') as replay_file:
+            replay_file.write(b'x' * 64)
+        with self.assertRaises(ValueError):
+            ReplayPlayer(self.path)
+
+
+class TestLogging(unittest.TestCase):
+    def test_import_adds_no_handler(self):
+        handlers = [h for h in pong_module.pong_log.handlers if not isinstance(h, logging.NullHandler)]
+        self.assertEqual(handlers, [])
+
+    def test_structured_records(self):
+        handle, path = tempfile.mkstemp(suffix='.log')
+        os.close(handle)
+        try:
+            with patch('sys.stderr', new_callable=StringIO):
+                pong_module.setup_logging(path, logging.INFO)
+                pong = build_game(320, 240, rgb_colors['red'], 'player', headless=True, max_score=1)
+                pong._stat['player_score'] = 1
+                pong._reset_game()
+                pong.run_headless(1)
+                pong_module.stop_logging()
+            with open(path) as log:
+                lines = [line.split() for line in log]
+        finally:
+            os.remove(path)
+        self.assertEqual(pong_module.pong_log.level, logging.INFO)
+        pong_module.pong_log.setLevel(logging.CRITICAL)
+        events = [line[3] for line in lines]
+        self.assertEqual(events, ['level_up', 'start', 'end'])
+        self.assertEqual(lines[0][1:], ['I', '0', 'level_up', 'level=2'])
+        self.assertEqual(lines[2][1:], ['C', '0', 'end', 'winner=player'])
+        float(lines[0][0])
+
+    def test_disabled_events_are_not_built(self):
+        gamefield, ball, player, computer, pong = get_default_game_objects()
+        with patch.object(pong_module.pong_log, 'log') as log:
+            pong._log_event(logging.INFO, 'hit', 'side=%s', 'player')
+            self.assertFalse(log.called)
+
+
+class TestStartup(unittest.TestCase):
+    def test_font_path_is_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        cache_path = os.path.join(cache_dir, 'pypong', 'fonts.json')
+        try:
+            with patch.object(pygame.font, 'match_font', return_value=None) as match_font:
+                font = pong_module.load_font('freemono', 20, cache_path)
+                self.assertIsInstance(font, pygame.font.Font)
+                pong_module.load_font('freemono', 20, cache_path)
+                self.assertEqual(match_font.call_count, 1)
+                # a font moved away since it was cached is looked up again
+                with open(cache_path, 'w') as cache_file:
+                    cache_file.write('{"freemono": "/nonexistent/freemono.ttf"}')
+                pong_module.load_font('freemono', 20, cache_path)
+                self.assertEqual(match_font.call_count, 2)
+        finally:
+            os.remove(cache_path)
+            os.rmdir(os.path.dirname(cache_path))
+            os.rmdir(cache_dir)
+
+    def test_only_needed_subsystems(self):
+        with patch.object(pygame, 'init') as init:
+            get_default_game_objects()
+            self.assertFalse(init.called)
+        self.assertTrue(pygame.display.get_init())
+        self.assertTrue(pygame.font.get_init())
+
+
+class TestFrameTimer(unittest.TestCase):
+    def test_statistics(self):
+        timer = FrameTimer(window=100)
+        for frame in range(150):
+            flip = 0.010 if frame % 50 == 0 else 0.001
+            timer.add((0.001, 0, 0, 0, 0, 0.002, 0, flip, 0.005))
+        self.assertEqual(timer.frames, 150)
+        self.assertEqual(timer.worst_phase(), 'draws')
+        self.assertAlmostEqual(timer.p99_ms(), 18)
+        self.assertAlmostEqual(timer.fps(), 100 / (98 * 0.009 + 2 * 0.018))
+
+    def test_timed_game_and_csv(self):
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.close(handle)
+        try:
+            timer = FrameTimer(csv_path=path)
+            pong = build_game(320, 240, rgb_colors['red'], 'player', timer=timer, hud=True)
+            pong._fps = 0
+            for _ in range(40):
+                pong.run_game_once()
+            self.assertIsNotNone(pong._hud_img)
+            pong.stop_timing()
+            with open(path) as csv_file:
+                rows = list(csv.reader(csv_file))
+        finally:
+            os.remove(path)
+        self.assertEqual(rows[0], ['frame'] + [f'{phase}_us' for phase in FrameTimer.PHASES])
+        self.assertEqual(len(rows), 41)
+        self.assertEqual(pong._tick, 40)
+
+    def test_cli_rejects_hud_without_full_frames(self):
+        for flag in ('--dirty-rects', '--pipelined'):
+            with patch('sys.argv', ['pong.py', '--hud', flag]), patch('pong.setup_logging'), \
+                    patch('sys.stderr', new_callable=StringIO) as stderr, self.assertRaises(SystemExit):
+                pong_module.main()
+            self.assertIn('--hud is not supported', stderr.getvalue())
+
+    def test_untimed_game_does_not_time(self):
+        gamefield, ball, player, computer, pong = get_default_game_objects()
+        with patch.object(pong, '_run_game_once_timed') as timed:
+            pong.run_game_once()
+            self.assertFalse(timed.called)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_profile_frames(self):
+        prefix = os.path.join(tempfile.mkdtemp(), 'profile')
+        pong = build_game(320, 240, rgb_colors['red'], 'player', fps=500)
+        frames = profiler.profile_frames(pong.run_game_once, 50, prefix)
+        self.assertEqual(frames, 50)
+        self.assertEqual(pong._tick, 50)
+        stats = pstats.Stats(prefix + '.pstats')
+        self.assertTrue(any(func[2] == 'run_game_once' for func in stats.stats))
+        with open(prefix + '.folded') as folded:
+            lines = folded.read().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any('run_game_once (pong.py' in line for line in lines))
+        for suffix in ('.pstats', '.folded'):
+            os.remove(prefix + suffix)
+        os.rmdir(os.path.dirname(prefix))
+
+    def test_stops_at_end_of_match(self):
+        gamefield, ball, player, computer, pong = get_default_game_objects()
+        pong._exit_on_end = False
+        pong._stat['player_score'] = pong._stat['max_score']
+        prefix = os.path.join(tempfile.mkdtemp(), 'profile')
+        frames = profiler.profile_frames(lambda: (pong.run_game_once(), not pong._game_over)[1], 100, prefix)
+        self.assertEqual(frames, 1)
+        self.assertEqual(pong._stat['winner'], 'player')
+        for suffix in ('.pstats', '.folded'):
+            os.remove(prefix + suffix)
+        os.rmdir(os.path.dirname(prefix))
+
+
+class TestCpuPolicy(unittest.TestCase):
+    def test_follow_is_default(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', headless=True)
+        self.assertIsInstance(game._cpu_policy, pong_module.FollowPolicy)
+
+    def test_intercept(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', headless=True, cpu='predictive')
+        policy = game._cpu_policy
+        ball = game._ball
+        # Two wall bounces before the ball reaches the CPU paddle
+        ball.set_pos(300, 100)
+        ball.speed_x = -2.5
+        ball.speed_y = 3.1
+        predicted = policy.intercept(game)
+        plane_x = game._computer.rect.right + ball.radius
+        while ball.center_x > plane_x:
+            ball.update_pos()
+        self.assertLessEqual(abs(ball.center_y - predicted), abs(ball.speed_y))
+        # Going away: back to the middle
+        ball.speed_x = 2.5
+        self.assertEqual(policy.intercept(game), 120)
+
+    def test_reaction_delay(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', headless=True, cpu='predictive', cpu_delay=10)
+        game._ball.set_pos(300, 30)
+        game._ball.speed_x = -2
+        game._ball.speed_y = -0.1
+        for _ in range(10):
+            game._move_computer()
+            self.assertEqual(game._computer.speed_y, 0)
+            game._tick += 1
+        game._move_computer()
+        self.assertLess(game._computer.speed_y, 0)
+        self.assertEqual(game._cpu_policy.replans, 1)
+
+    def test_predictive_plays_better(self):
+        scores = {}
+        for cpu in ('follow', 'predictive'):
+            game = build_game(320, 240, rgb_colors['lightgrey'], 'player', max_score=1000, headless=True,
+                              seed=1, aim_error=20, cpu=cpu)
+            game.run_headless(20000)
+            scores[cpu] = game._stat['player_score']
+        self.assertGreater(scores['follow'], 0)
+        self.assertEqual(scores['predictive'], 0)
+
+    def test_error_misses(self):
+        result = tournament.run_match({'seed': 0, 'max_score': 3, 'cpu': 'predictive', 'cpu_delay': 30,
+                                       'cpu_error': 40, 'max_ticks': 200000})
+        self.assertNotEqual(result['winner'], 'none')
+
+
+class TestFixedTimestep(unittest.TestCase):
+    def test_cli_rejects_unsupported_options(self):
+        for flag in ('--timings=t.csv', '--hud', '--dirty-rects', '--idle'):
+            with patch('sys.argv', ['pong.py', '--tick-rate', '120', flag]), patch('pong.setup_logging'), \
+                    patch('sys.stderr', new_callable=StringIO) as stderr, self.assertRaises(SystemExit):
+                pong_module.main()
+            self.assertIn('not supported with --tick-rate', stderr.getvalue())
+
+    def test_physics_independent_of_fps(self):
+        slow = build_game(320, 240, rgb_colors['lightgrey'], 'player', fps=30, tick_rate=120, headless=True)
+        fast = build_game(320, 240, rgb_colors['lightgrey'], 'player', fps=240, tick_rate=120, headless=True)
+        classic = build_game(320, 240, rgb_colors['lightgrey'], 'player', fps=120, headless=True)
+        for game in (slow, fast):
+            self.assertEqual(game._BALL_SPEED_X_DFLT, classic._BALL_SPEED_X_DFLT)
+            self.assertEqual(game._player_speed, classic._player_speed)
+
+    def test_accumulator(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', fps=0, tick_rate=100)
+        game._event_source = ScriptedInput(game._ball, game._player)
+        clock = [10.0]
+        with patch('pong.time.perf_counter', side_effect=lambda: clock[0]), \
+                patch.object(game, '_draw_state') as draw_state:
+            game.run_game_once()
+            self.assertEqual(game._tick, 0)
+            clock[0] += 0.025
+            game.run_game_once()
+            self.assertEqual(game._tick, 2)
+            self.assertAlmostEqual(game._accumulator, 0.005)
+            # A long stall only runs the catch-up ticks, the rest is dropped
+            clock[0] += 1
+            game.run_game_once()
+            self.assertEqual(game._tick, 2 + PongGame._MAX_CATCHUP_TICKS)
+            self.assertLess(game._accumulator, 0.01)
+        self.assertEqual(draw_state.call_count, 3)
+
+    def test_interpolation(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', tick_rate=120, headless=True)
+        game._ball.set_speed(2, 1)
+        game._player.speed_y = 4
+        game._previous_state = game.get_frame_state()
+        game._move_objects()
+        state = game.get_interpolated_state(0.5)
+        previous = game._previous_state
+        self.assertEqual(state.ball_x, previous.ball_x + 1)
+        self.assertEqual(state.ball_y, previous.ball_y + 0.5)
+        self.assertEqual(state.player_rect[1], previous.player_rect[1] + 2)
+        self.assertEqual(game.get_interpolated_state(1).ball_x, game._ball.center_x)
+        # No interpolation across a point
+        game._stat['cpu_score'] += 1
+        self.assertEqual(game.get_interpolated_state(0.5).ball_x, game._ball.center_x)
+
+
+class TestIdle(unittest.TestCase):
+    def test_waits_for_input_when_static(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', idle=True)
+        pygame.event.clear()
+        serve = pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE)
+        with patch.object(game, '_draw_frame') as draw_frame, \
+                patch('pygame.event.wait', return_value=serve) as wait, \
+                patch('pygame.display.flip'):
+            # The static scene is drawn once, then the game waits
+            game.run_game_once()
+            game.run_game_once()
+            self.assertEqual(draw_frame.call_count, 1)
+            wait.assert_called_once_with(PongGame._IDLE_TIMEOUT_MS)
+            # The event was put back and serves on the next tick
+            game.run_game_once()
+            self.assertNotEqual(game._ball.get_speed(), (0, 0))
+            self.assertEqual(draw_frame.call_count, 2)
+        stats = game.get_idle_stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreaterEqual(stats['cpu_saved_s'], 0)
+
+    def test_new_scene_is_drawn(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', idle=True)
+        record = game.snapshot()
+        with patch.object(game, '_draw_frame') as draw_frame, \
+                patch('pygame.event.wait', return_value=pygame.event.Event(pygame.NOEVENT)), \
+                patch('pygame.display.flip'):
+            game.run_game_once()
+            game.run_game_once()
+            self.assertEqual(draw_frame.call_count, 1)
+            for reset in (lambda: game.restore(record), game.new_match):
+                game._player.rect.y += 10
+                reset()
+                game.run_game_once()
+            self.assertEqual(draw_frame.call_count, 3)
+
+    def test_pipelined_static_frame_is_shown(self):
+        game = build_game(320, 240, rgb_colors['red'], 'player', idle=True, pipelined=True)
+        render = game._renderer._draw_state
+        game._renderer._draw_state = lambda state: (time.sleep(0.05), render(state))
+        screen = game._game_field.get_screen()
+        screen.fill((0, 0, 0))
+        with patch('pygame.event.wait', return_value=pygame.event.Event(pygame.NOEVENT)) as wait:
+            # The frame is still being drawn after the first tick
+            game.run_game_once()
+            game.run_game_once()
+        game._stop_renderer()
+        self.assertTrue(wait.called)
+        self.assertEqual(screen.get_at((int(game._ball.center_x), int(game._ball.center_y)))[:3],
+                         rgb_colors['red'])
+
+    def test_cli_rejects_timed_frames(self):
+        for flag in ('--timings=t.csv', '--hud'):
+            with patch('sys.argv', ['pong.py', '--idle', flag]), patch('pong.setup_logging'), \
+                    patch('sys.stderr', new_callable=StringIO) as stderr, self.assertRaises(SystemExit):
+                pong_module.main()
+            self.assertIn('--idle is not supported', stderr.getvalue())
+
+    def test_off_by_default(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player')
+        with patch.object(game, '_draw_frame') as draw_frame, patch('pygame.event.wait') as wait, \
+                patch('pygame.display.flip'), patch.object(game, '_event_source', return_value=[]):
+            game.run_game_once()
+            game.run_game_once()
+        self.assertEqual(draw_frame.call_count, 2)
+        self.assertFalse(wait.called)
+
+
+class TestSnapshot(unittest.TestCase):
+    def _make_game(self):
+        game = build_game(320, 240, rgb_colors['red'], 'player', max_score=50, headless=True, seed=5)
+        # Serve every time: the match only depends on the snapshot state
+        game._event_source = lambda: [pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE)]
+        return game
+
+    def _state(self, game):
+        return (game._tick, game._ball.center_x, game._ball.center_y, game._ball.speed_x, game._ball.speed_y,
+                tuple(game._player.rect), tuple(game._computer.rect), game._computer.speed_y, dict(game._stat))
+
+    def test_round_trip(self):
+        game = self._make_game()
+        game.run_headless(700)
+        record = game.snapshot()
+        self.assertEqual(len(record), pong_module.SNAPSHOT_SIZE)
+        state = self._state(game)
+        draws = [game._rng.random() for _ in range(3)]
+        game.run_headless(2000)
+        self.assertNotEqual(self._state(game), state)
+        game.restore(record)
+        self.assertEqual(self._state(game), state)
+        self.assertEqual([game._rng.random() for _ in range(3)], draws)
+        game.restore(record)
+        self.assertEqual(game.snapshot(), record)
+
+    def test_unchanged_rng_not_restored(self):
+        game = self._make_game()
+        record = game.snapshot()
+        game.run_headless(100)
+        with patch.object(game._rng, 'setstate') as setstate:
+            game.restore(record)
+        setstate.assert_not_called()
+        game._rng.random()
+        game.restore(record)
+        self.assertEqual(game._rng.version, pong_module._SNAPSHOT_STATE.unpack_from(record)[-3])
+
+    def test_ring_rollback(self):
+        game = self._make_game()
+        ring = pong_module.SnapshotRing(game, capacity=16)
+        states = {}
+        for _ in range(40):
+            ring.save()
+            states[game._tick] = self._state(game)
+            game.run_game_once()
+        self.assertEqual(ring.oldest(), 24)
+        self.assertNotIn(23, ring)
+        with self.assertRaises(KeyError):
+            ring.restore(23)
+        ring.restore(30)
+        self.assertEqual(self._state(game), states[30])
+        # Same inputs from the restored tick, same timeline
+        ring.truncate(30)
+        self.assertNotIn(31, ring)
+        for _ in range(9):
+            game.run_game_once()
+            ring.save()
+            self.assertEqual(self._state(game), states[game._tick])
+
+    def test_bench(self):
+        results = bench.bench_snapshot(50, capacity=8)
+        self.assertEqual(results['ring_bytes'], 8 * pong_module.SNAPSHOT_SIZE)
+        self.assertIn('p50_us', results['restore'])
+
+
+class TestHeadless(unittest.TestCase):
+    def test_headless_field_has_no_screen(self):
+        pong = build_game(320, 240, rgb_colors['red'], 'player', headless=True)
+        self.assertIsNone(pong._game_field.get_screen())
+        self.assertIsNone(pong.font)
+
+    def test_run_headless(self):
+        pong = build_game(320, 240, rgb_colors['red'], 'player', headless=True)
+        ticks = pong.run_headless(1000)
+        self.assertEqual(ticks, 1000)
+        self.assertEqual(pong._tick, 1000)
+        # the scripted player serves on the first tick
+        self.assertNotEqual(pong._ball.get_speed(), (0, 0))
+
+    def test_headless_end_game(self):
+        pong = build_game(320, 240, rgb_colors['red'], 'player', headless=True, max_score=1)
+        pong._stat['cpu_score'] = 1
+        ticks = pong.run_headless(1000)
+        self.assertEqual(ticks, 0)
+        self.assertTrue(pong._game_over)
+        self.assertEqual(pong._stat['winner'], 'cpu')
+
+    def test_scripted_input(self):
+        ball = Ball(50, 10, 5, (255, 255, 255), 100, 100)
+        player = Gamer(80, 50, 10, 40, (255, 255, 255), "Player", 100, 100)
+        script = ScriptedInput(ball, player)
+        events = script()
+        # ball is stopped: serve, then start moving up towards the ball
+        self.assertEqual([(e.type, e.key) for e in events],
+                         [(pygame.KEYDOWN, pygame.K_SPACE), (pygame.KEYDOWN, pygame.K_UP)])
+        ball.speed_x = 1
+        self.assertEqual(script(), [])
+        ball.set_pos(50, 90)
+        self.assertEqual([(e.type, e.key) for e in script()],
+                         [(pygame.KEYUP, pygame.K_UP), (pygame.KEYDOWN, pygame.K_DOWN)])
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestBatchPong(unittest.TestCase):
+    def test_matches_scalar_game(self):
+        configs = [{'fps': 120, 'max_score': 3, 'dead_zone': 5, 'increment': 1},
+                   {'fps': 60, 'max_score': 3, 'dead_zone': 25, 'increment': 2},
+                   {'fps': 30, 'max_score': 5, 'dead_zone': 40, 'increment': 0.5}]
+        games = []
+        for config in configs:
+            pong = build_game(320, 240, rgb_colors['red'], 'player', fps=config['fps'],
+                              max_score=config['max_score'], headless=True)
+            pong._cpu_speed_increment = config['increment']
+            pong._event_source._dead_zone = config['dead_zone']
+            games.append(pong)
+        batch = BatchPong(len(configs),
+                          fps=[c['fps'] for c in configs],
+                          max_score=[c['max_score'] for c in configs],
+                          dead_zone=[c['dead_zone'] for c in configs],
+                          cpu_speed_increment=[c['increment'] for c in configs])
+        for tick in range(2000):
+            for pong in games:
+                if not pong._game_over:
+                    pong.run_game_once()
+            batch.step()
+            for i, pong in enumerate(games):
+                self.assertEqual(
+                    (pong._ball.center_x, pong._ball.center_y, pong._ball.speed_x, pong._ball.speed_y,
+                     pong._player.rect.y, pong._player.speed_y, pong._computer.rect.y, pong._computer.speed_y,
+                     pong._stat['player_score'], pong._stat['cpu_score'], pong._stat['level'], pong._tick),
+                    (batch.ball_x[i], batch.ball_y[i], batch.ball_speed_x[i], batch.ball_speed_y[i],
+                     batch.player_y[i], batch.player_speed_y[i], batch.cpu_y[i], batch.cpu_speed_y[i],
+                     batch.player_score[i], batch.cpu_score[i], batch.level[i], batch.ticks[i]))
+        winners = {'none': 0, 'player': WINNER_PLAYER, 'cpu': WINNER_CPU}
+        self.assertEqual([winners[pong._stat['winner']] for pong in games], list(batch.winner))
+        self.assertTrue(batch.done[1:].all())
+
+    def test_run_stops_when_all_done(self):
+        batch = BatchPong(4, max_score=1, dead_zone=40)
+        ticks = batch.run(100000)
+        self.assertLess(ticks, 100000)
+        self.assertTrue(batch.done.all())
+        results = batch.results()
+        self.assertTrue((results['ticks'] <= ticks).all())
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestPongEnv(unittest.TestCase):
+    def test_observation_matches_surface(self):
+        env = pong_env.PongEnv(seed=1)
+        obs, info = env.reset()
+        self.assertEqual(obs.shape, (4, 60, 80))
+        self.assertEqual(info['tick'], 0)
+        # Only the last frame of a new episode is drawn
+        self.assertFalse(obs[:3].any())
+        screen = env.game._game_field.get_screen()
+        screen.fill((10, 200, 40), pygame.Rect(100, 40, 60, 20))
+        env.observer.capture()
+        pixels = pygame.surfarray.array3d(screen)[::4, ::4].astype(numpy.uint32)
+        expected = ((pixels[..., 0] * 77 + pixels[..., 1] * 150 + pixels[..., 2] * 29) >> 8).T
+        numpy.testing.assert_array_equal(env.observer.observation()[-1], expected)
+
+    def test_frame_stack_order(self):
+        surface = pygame.Surface((16, 8))
+        observer = pong_env.PixelObserver(surface, downsample=2, stack=3)
+        for level in range(1, 6):
+            surface.fill((level, level, level))
+            observer.capture()
+            obs = observer.observation()
+        self.assertEqual([frame[0, 0] for frame in obs], [3, 4, 5])
+
+    def test_capture_does_not_allocate(self):
+        env = pong_env.PongEnv(seed=1)
+        env.reset()
+        env.observer.capture()
+        tracemalloc.start()
+        for _ in range(100):
+            env.observer.capture()
+            env.observer.observation()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # Only small ufunc buffers, no copy of the 320x240 surface
+        self.assertLess(peak, 320 * 240)
+
+    def test_episode(self):
+        env = pong_env.PongEnv(max_score=2, seed=3)
+        env.reset()
+        total = 0
+        for _ in range(10000):
+            obs, reward, terminated, truncated, info = env.step(pong_env.UP)
+            total += reward
+            if terminated:
+                break
+        self.assertTrue(terminated)
+        self.assertFalse(truncated)
+        self.assertEqual(total, info['player_score'] - info['cpu_score'])
+        self.assertEqual(info['winner'], 'cpu')
+        # A new episode starts from 0-0
+        obs, info = env.reset(seed=3)
+        self.assertEqual((info['player_score'], info['cpu_score'], info['tick']), (0, 0, 0))
+        self.assertFalse(env.game._game_over)
+
+
+class TestTournament(unittest.TestCase):
+    def test_run_match(self):
+        result = tournament.run_match({'max_score': 1, 'seed': 3})
+        self.assertIn(result['winner'], ('player', 'cpu'))
+        self.assertEqual(max(result['player_score'], result['cpu_score']), 1)
+        self.assertEqual(result['ticks_per_point'], result['ticks'])
+        self.assertEqual(result['config']['fps'], tournament.DEFAULT_CONFIG['fps'])
+        # same seed, same match
+        self.assertEqual(tournament.run_match({'max_score': 1, 'seed': 3}), result)
+
+    def test_run_tournament(self):
+        configs = [{'max_score': 1, 'seed': seed} for seed in range(4)]
+        configs.append({'max_score': 1, 'max_ticks': 10})
+        summary = tournament.run_tournament(configs, workers=2)['summary']
+        self.assertEqual(summary['matches'], 5)
+        self.assertEqual(summary['winners']['none'], 1)
+        self.assertEqual(summary['winners']['player'] + summary['winners']['cpu'], 4)
+        self.assertEqual(sum(summary['levels'].values()), 5)
+
+
+class TestMatchHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'history.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_game_end_recorded(self):
+        history = match_history.MatchHistory(self.path)
+        game = build_game(320, 240, rgb_colors['red'], 'ann', max_score=1, headless=True, seed=3, aim_error=20)
+        game._on_match_end = lambda ended: history.record_game(ended, {'seed': 3})
+        game.run_headless(100000)
+        history.flush()
+        connection = match_history.connect(self.path)
+        rows = match_history.recent_matches(connection)
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['player'], 'ann')
+        self.assertEqual(rows[0]['winner'], game._stat['winner'])
+        self.assertEqual(rows[0]['ticks'], game._tick)
+        self.assertEqual(json.loads(rows[0]['config']), {'seed': 3})
+        connection.close()
+        history.close()
+
+    def test_match_end_notified_once(self):
+        game = build_game(320, 240, rgb_colors['red'], 'ann', max_score=1, headless=True, seed=3, aim_error=20)
+        ended = []
+        game._on_match_end = ended.append
+        game.run_headless(100000)
+        for _ in range(3):
+            game.run_game_once()
+        self.assertEqual(ended, [game])
+
+    def test_batches_and_queries(self):
+        history = match_history.MatchHistory(self.path, batch_size=64, flush_interval=10)
+        for index in range(100):
+            player = ('ann', 'bob', 'cid')[index % 3]
+            winner = 'player' if player != 'cid' or index % 2 else 'cpu'
+            if player == 'bob' and index % 5 == 0:
+                winner = 'cpu'
+            history.record(player, {'winner': winner, 'player_score': 2, 'cpu_score': 1,
+                                    'level': index % 4 + 1, 'ticks': index}, index / 120)
+        history.close()
+        self.assertEqual(history.matches_written, 100)
+        self.assertEqual(history.batches, 2)
+        connection = match_history.connect(self.path)
+        board = match_history.leaderboard(connection)
+        self.assertEqual([row['player'] for row in board], ['ann', 'bob', 'cid'])
+        self.assertEqual(board[0]['wins'], 34)
+        self.assertEqual(board[0]['best_level'], 4)
+        recent = match_history.recent_matches(connection, 3, player='bob')
+        self.assertEqual([row['ticks'] for row in recent], [97, 94, 91])
+        self.assertEqual(match_history.recent_matches(connection, 1)[0]['ticks'], 99)
+        for query, args in ((match_history.PLAYER_RECENT_QUERY, ('bob', 3)),
+                            (match_history.RECENT_QUERY, (3,)),
+                            (match_history.LEADERBOARD_QUERY, (3,))):
+            plan = ' '.join(row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + query, args))
+            self.assertIn('INDEX matches_by_', plan)
+        connection.close()
+
+
+class TestSweep(unittest.TestCase):
+    def test_config_key(self):
+        key = sweep.config_key({'seed': 1})
+        self.assertEqual(sweep.config_key({'seed': 1, 'fps': tournament.DEFAULT_CONFIG['fps']}), key)
+        self.assertNotEqual(sweep.config_key({'seed': 2}), key)
+        self.assertNotEqual(sweep.config_key({'seed': 1, 'max_ball_time_4_travel': 2}), key)
+
+    def test_cli_rejects_unused_params(self):
+        for option in (['--grid', 'ball_speed_increment', '0.5', '1'], ['--range', 'ball_speed_increment', '0', '1']):
+            with patch('sys.argv', ['sweep.py'] + option), patch('sys.stderr', new_callable=StringIO) as stderr, \
+                    self.assertRaises(SystemExit):
+                sweep.main()
+            self.assertIn('ball_speed_increment is not used', stderr.getvalue())
+
+    def test_points(self):
+        grid = sweep.grid_points({'a': [1, 2], 'b': [3, 4, 5]})
+        self.assertEqual(len(grid), 6)
+        self.assertIn({'a': 2, 'b': 5}, grid)
+        ranges = {'a': (0, 1)}
+        points = sweep.random_points(ranges, 10, random.Random(1))
+        self.assertEqual(sweep.random_points(ranges, 5, random.Random(1)), points[:5])
+        summaries = [{'params': {'a': 0.1}, 'player_win_rate': 1.0},
+                     {'params': {'a': 0.9}, 'player_win_rate': 0.5}]
+        refined = sweep.refine_points(ranges, summaries, 20, random.Random(1), spread=0.05, best=1)
+        self.assertTrue(all(0.6 < point['a'] <= 1 for point in refined))
+
+    def test_run_sweep_cache(self):
+        base = {'max_score': 1, 'max_ticks': 3000}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cache.jsonl')
+            points = [{'max_ball_time_4_travel': 2}, {'max_ball_time_4_travel': 3}]
+            summaries = sweep.run_sweep(points, 2, workers=1, cache=sweep.ResultCache(path), base=base)
+            self.assertEqual([summary['computed'] for summary in summaries], [2, 2])
+            self.assertEqual(summaries[0]['matches'], 2)
+            self.assertIsNotNone(summaries[0]['hits_per_point'])
+            # A longer sweep from the file only plays the new points
+            cache = sweep.ResultCache(path)
+            self.assertEqual(len(cache), 4)
+            with patch('tournament.run_tournament', wraps=tournament.run_tournament) as run:
+                extended = sweep.run_sweep(points + [{'max_ball_time_4_travel': 4}], 2, workers=1,
+                                           cache=cache, base=base)
+            self.assertEqual(len(run.call_args[0][0]), 2)
+            self.assertEqual(extended[:2], [{**summary, 'computed': 0} for summary in summaries])
+            self.assertEqual(extended[2]['computed'], 2)
+
+
+class TestBench(unittest.TestCase):
+    def test_compare(self):
+        baseline = {'320x240': {'run_game_once': {'ticks_per_sec': 10000, 'p50_us': 100, 'p99_us': 150},
+                                '_move_computer': {'ticks_per_sec': 500000, 'p50_us': 2, 'p99_us': 3}}}
+        results = {'320x240': {'run_game_once': {'ticks_per_sec': 5000, 'p50_us': 200, 'p99_us': 300},
+                               '_move_computer': {'ticks_per_sec': 250000, 'p50_us': 4, 'p99_us': 6},
+                               'draw': {'ticks_per_sec': 1000, 'p50_us': 1000, 'p99_us': 1000}}}
+        regressions = bench.compare(results, baseline, tolerance=0.5)
+        # _move_computer doubled, but by less than min_delta_us; draw has no baseline
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('320x240 run_game_once'))
+        self.assertEqual(bench.compare(results, baseline, tolerance=1.5), [])
+
+    def test_compare_scales_by_reference(self):
+        baseline = {'reference': {'headless_ticks': {'ticks_per_sec': 10000, 'p50_us': 100, 'p99_us': 150}},
+                    '320x240': {'run_game_once': {'ticks_per_sec': 10000, 'p50_us': 100, 'p99_us': 150}}}
+        results = {'reference': {'headless_ticks': {'ticks_per_sec': 5000, 'p50_us': 200, 'p99_us': 300}},
+                   '320x240': {'run_game_once': {'ticks_per_sec': 5000, 'p50_us': 200, 'p99_us': 300}}}
+        # Everything twice slower: a slower machine, not a regression
+        self.assertEqual(bench.compare(results, baseline, tolerance=0.5), [])
+        results['320x240']['run_game_once']['p50_us'] = 400
+        self.assertEqual(len(bench.compare(results, baseline, tolerance=0.5)), 1)
+        # A faster reference does not make the check stricter
+        results['reference']['headless_ticks']['p50_us'] = 50
+        results['320x240']['run_game_once']['p50_us'] = 140
+        self.assertEqual(bench.compare(results, baseline, tolerance=0.5), [])
+
+    def test_stats(self):
+        stats = bench._stats([1000] * 99 + [100000])
+        self.assertEqual(stats['p50_us'], 1)
+        self.assertEqual(stats['p99_us'], 100)
+
+
+class TestMultiBall(unittest.TestCase):
+    def setUp(self):
+        pygame.display.init()
+
+    def tearDown(self):
+        pygame.quit()
+
+    def test_spatial_hash_pairs(self):
+        rng = random.Random(3)
+        points = [(index, rng.uniform(0, 200), rng.uniform(0, 200)) for index in range(150)]
+        grid = multiball.SpatialHash(10)
+        for index, x, y in points:
+            grid.insert(index, x, y)
+        pairs = {frozenset(pair) for pair in grid.pairs()}
+        self.assertEqual(len(pairs), len(grid.pairs()))
+        for first in range(len(points)):
+            for second in range(first + 1, len(points)):
+                _, x1, y1 = points[first]
+                _, x2, y2 = points[second]
+                if (x1 - x2) ** 2 + (y1 - y2) ** 2 <= 100:
+                    self.assertIn(frozenset((first, second)), pairs)
+        self.assertLess(len(pairs), len(points) * (len(points) - 1) // 2)
+
+    def test_balls_exchange_speed(self):
+        game = multiball.build_multiball(320, 240, 2, seed=1, headless=True)
+        first, second = game.balls
+        first.set_pos(100, 120)
+        second.set_pos(109, 120)
+        first.speed_x, first.speed_y = 1, 0
+        second.speed_x, second.speed_y = -1, 0
+        game.step()
+        self.assertEqual(game.ball_hits, 1)
+        self.assertAlmostEqual(first.speed_x, -1)
+        self.assertAlmostEqual(second.speed_x, 1)
+
+    def test_paddle_bounce_and_score(self):
+        game = multiball.build_multiball(320, 240, 2, seed=1, headless=True)
+        first, second = game.balls
+        paddle = game.right_paddles[0]
+        first.set_pos(paddle.rect.left - 6, paddle.rect.centery)
+        first.speed_x, first.speed_y = 2, 0
+        second.set_pos(2, 10)
+        second.speed_x, second.speed_y = -10, 0
+        game.step()
+        self.assertLess(first.speed_x, 0)
+        self.assertEqual(game.stat, {'left_score': 0, 'right_score': 1})
+        self.assertEqual(second.center_x, 160)
+
+    def test_draw_offscreen(self):
+        game = multiball.build_multiball(320, 240, 30, paddles_per_side=2, seed=2, offscreen=True)
+        for _ in range(5):
+            game.step()
+        game.draw()
+        ball = game.balls[0]
+        color = game._game_field.get_screen().get_at((int(ball.center_x), int(ball.center_y)))
+        self.assertEqual(tuple(color)[:3], rgb_colors['lightgrey'])
+
+    def test_bench(self):
+        results = bench.bench_multiball([20, 40], 20, 320, 240)
+        self.assertEqual(set(results), {20, 40})
+        self.assertLess(results[40]['candidate_pairs'], results[40]['all_pairs'])
+
+
+class TestNetplay(unittest.TestCase):
+    def test_prediction_and_reconciliation(self):
+        delay = 0.03
+
+        async def scenario():
+            server = netplay.NetServer(max_score=5, seed=1, tick_rate=100)
+            port = await server.start()
+            proxy = netplay.LatencyProxy('127.0.0.1', port, delay)
+            proxy_port = await proxy.start()
+            # Sides are given in connection order
+            left = netplay.NetClient()
+            await left.connect('127.0.0.1', proxy_port)
+            right = netplay.NetClient()
+            await right.connect('127.0.0.1', proxy_port)
+            self.assertEqual((right.side, left.side), (netplay.RIGHT, netplay.LEFT))
+            start_y = right.predicted_y
+            sent_at = time.perf_counter()
+            first_seq = right.send_input(1)
+            # The paddle moves before the server has seen the input
+            self.assertGreater(right.predicted_y, start_y)
+            self.assertIsNone(right.state)
+            for _ in range(10):
+                await asyncio.sleep(0.01)
+                right.send_input(1)
+                left.send_input(0)
+            while right.state is None or right.state.ack_seq < first_seq:
+                await asyncio.sleep(0.001)
+            round_trip = time.perf_counter() - sent_at
+            last_seq = right.send_input(0)
+            while right.state.ack_seq < last_seq:
+                await asyncio.sleep(0.001)
+            await asyncio.sleep(0.05)
+            authoritative_y = server.game._player.rect.y
+            result = (round_trip, start_y, right.predicted_y, right.state.right_y,
+                      left.state.right_y, authoritative_y, right.pending)
+            await right.close()
+            await left.close()
+            await server.close()
+            await proxy.close()
+            return result
+
+        round_trip, start_y, predicted_y, client_y, other_y, server_y, pending = asyncio.run(scenario())
+        self.assertGreaterEqual(round_trip, 2 * delay)
+        self.assertGreater(server_y, start_y)
+        self.assertEqual(predicted_y, server_y)
+        self.assertEqual(client_y, server_y)
+        self.assertEqual(other_y, server_y)
+        self.assertEqual(pending, 0)
+
+    def test_match_to_the_end(self):
+        async def scenario():
+            server = netplay.NetServer(max_score=1, seed=3, tick_rate=5000)
+            port = await server.start()
+            clients = [netplay.NetClient(), netplay.NetClient()]
+            for client in clients:
+                await client.connect('127.0.0.1', port)
+            clients[0].send_input(0, serve=True)
+            await asyncio.wait_for(asyncio.gather(*(client.wait_game_over() for client in clients)), 30)
+            states = [client.state for client in clients]
+            for client in clients:
+                await client.close()
+            await server.close()
+            return states, server.game.get_result()
+
+        states, result = asyncio.run(scenario())
+        self.assertNotEqual(result['winner'], 'none')
+        for state in states:
+            self.assertTrue(state.game_over)
+            self.assertEqual((state.left_score, state.right_score), (result['cpu_score'], result['player_score']))
+
+    def test_paddles_follow_directions(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', headless=True, game_class=netplay.NetPongGame)
+        start_y = game._computer.rect.y
+        game.directions[netplay.LEFT] = -1
+        game.directions[netplay.RIGHT] = 1
+        game.run_headless(5)
+        self.assertLess(game._computer.rect.y, start_y)
+        self.assertGreater(game._player.rect.y, start_y)
+        # Nobody served
+        self.assertEqual(game._ball.get_speed(), (0, 0))
+
+
+class TestMatchServer(unittest.TestCase):
+    def test_matchmaking_and_teardown(self):
+        async def scenario():
+            server = match_server.MatchServer(max_score=1, tick_rate=5000)
+            port = await server.start()
+            clients = [netplay.NetClient() for _ in range(5)]
+            for client in clients:
+                await client.connect('127.0.0.1', port)
+            await asyncio.sleep(0.05)
+            rooms = len(server.rooms)
+            # The fifth client waits for an opponent
+            waiting = server._waiting is not None
+            for client in clients[:4]:
+                client.send_input(0, serve=True)
+            await asyncio.wait_for(asyncio.gather(*(client.wait_game_over() for client in clients[:4])), 30)
+            await clients[4].close()
+            await asyncio.sleep(0.05)
+            stats = server.stats()
+            await server.close()
+            return rooms, waiting, stats, [client.state for client in clients[:4]]
+
+        rooms, waiting, stats, states = asyncio.run(scenario())
+        self.assertEqual(rooms, 2)
+        self.assertTrue(waiting)
+        self.assertEqual(stats['rooms'], 0)
+        self.assertEqual(stats['rooms_created'], 3)
+        self.assertEqual(stats['rooms_closed'], 3)
+        self.assertGreater(stats['ticks'], 0)
+        self.assertIsNotNone(stats['jitter']['p99_ms'])
+        for state in states:
+            self.assertTrue(state.game_over)
+            self.assertEqual(state.left_score + state.right_score, 1)
+
+    def test_run_load(self):
+        report = asyncio.run(match_server.run_load(rooms=4, seconds=0.2, tick_rate=100))
+        self.assertEqual(report['rooms'], 4)
+        self.assertGreater(report['ticks_per_sec'], 0)
+        self.assertGreater(report['rooms_per_core'], 0)
+        self.assertGreater(report['memory_per_room_bytes'], 0)
+
+
+class TestSpectator(unittest.TestCase):
+    def test_fan_out(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', max_score=3, headless=True, seed=4, aim_error=20)
+        feed = spectator.SpectatorFeed(game, keyframe_interval=30)
+        fast = [feed.subscribe(spectator.Subscriber(max_backlog=8)) for _ in range(150)]
+        slow = [feed.subscribe(spectator.Subscriber(max_backlog=8)) for _ in range(150)]
+        decoders = [spectator.SpectatorDecoder() for _ in fast]
+        for _ in range(600):
+            game.run_game_once()
+            feed.publish()
+            for subscriber, decoder in zip(fast, decoders):
+                decoder.feed(subscriber.poll())
+        expected = spectator._capture(game)
+        for decoder in decoders:
+            self.assertEqual(decoder.tick, game._tick)
+            self.assertEqual(tuple(decoder.values), expected)
+        self.assertEqual(decoders[0].state['ball_x'], expected[0] / spectator.BALL_SCALE)
+        # Slow subscribers fell back to keyframes and their backlog is bounded
+        for subscriber in slow:
+            self.assertTrue(subscriber.keyframes_only)
+            self.assertLessEqual(subscriber.backlog(), 8)
+            decoder = spectator.SpectatorDecoder()
+            decoder.feed(subscriber.poll())
+            self.assertIsNotNone(decoder.state)
+        stats = feed.stats()
+        self.assertEqual(stats['keyframes'], 21)
+        self.assertEqual(stats['keyframes_only'], 150)
+        self.assertLess(stats['bytes_encoded_per_tick'], spectator._KEYFRAME.size / 2)
+        self.assertLess(stats['bytes_per_tick_per_spectator'], stats['bytes_encoded_per_tick'])
+
+    def test_slow_subscriber_catches_up(self):
+        game = build_game(320, 240, rgb_colors['lightgrey'], 'player', headless=True, seed=1)
+        feed = spectator.SpectatorFeed(game, keyframe_interval=10)
+        subscriber = feed.subscribe(spectator.Subscriber(max_backlog=4))
+        decoder = spectator.SpectatorDecoder()
+        for _ in range(50):
+            game.run_game_once()
+            feed.publish()
+        self.assertTrue(subscriber.keyframes_only)
+        decoder.feed(subscriber.poll())
+        for _ in range(20):
+            game.run_game_once()
+            feed.publish()
+            decoder.feed(subscriber.poll())
+        self.assertFalse(subscriber.keyframes_only)
+        self.assertEqual(tuple(decoder.values), spectator._capture(game))
+
+    def test_stream(self):
+        async def scenario():
+            game = build_game(320, 240, rgb_colors['lightgrey'], 'player', headless=True, seed=2)
+            feed = spectator.SpectatorFeed(game, keyframe_interval=10)
+            server = spectator.SpectatorServer(feed)
+            port = await server.start()
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            while not feed.subscribers:
+                await asyncio.sleep(0.001)
+            decoder = spectator.SpectatorDecoder()
+            for _ in range(35):
+                game.run_game_once()
+                feed.publish()
+                await asyncio.sleep(0)
+                try:
+                    decoder.feed(await asyncio.wait_for(reader.read(4096), 0.05))
+                except asyncio.TimeoutError:
+                    pass
+            writer.close()
+            await server.close()
+            return decoder.tick, game._tick
+
+        decoded_tick, tick = asyncio.run(scenario())
+        self.assertEqual(decoded_tick, tick)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
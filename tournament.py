@@ -0,0 +1,114 @@
+import os
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import argparse
+import json
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import match_history
+import pong
+
+# Every match config is a plain dict, missing keys take these values
+DEFAULT_CONFIG = {
+	"width": 320,
+	"height": 240,
+	"fps": 120,
+	"max_score": 2,
+	"max_ball_time_4_travel": 3,
+	"max_gamer_time_4_travel": 0.5,
+	"cpu_speed_increment": 1,
+	"ball_speed_increment": 0.5,
+	"aim_error": 20,
+	"cpu": "follow",
+	"cpu_delay": 0,
+	"cpu_error": 0,
+	"seed": 0,
+	"max_ticks": 1000000,
+}
+
+
+def _init_worker():
+	# Points are logged as CRITICAL, far too chatty for thousands of matches
+	pong.pong_log.setLevel(logging.CRITICAL + 1)
+
+
+# Play one headless match to the end (or max_ticks) and return its result
+def run_match(config: dict) -> dict:
+	config = {**DEFAULT_CONFIG, **config}
+	game = pong.build_game(config["width"], config["height"], pong.rgb_colors["lightgrey"], "player",
+						   fps=config["fps"], max_score=config["max_score"], headless=True,
+						   seed=config["seed"], aim_error=config["aim_error"], cpu=config["cpu"],
+						   cpu_delay=config["cpu_delay"], cpu_error=config["cpu_error"])
+	game._set_travel_times(config["max_ball_time_4_travel"], config["max_gamer_time_4_travel"])
+	game._cpu_speed_increment = config["cpu_speed_increment"]
+	game._ball_speed_increment = config["ball_speed_increment"]
+	game.run_headless(config["max_ticks"])
+	result = game.get_result()
+	result["config"] = config
+	return result
+
+
+def aggregate(results: list) -> dict:
+	winners = {"player": 0, "cpu": 0, "none": 0}
+	levels = {}
+	ticks = 0
+	points = 0
+	hits = 0
+	for result in results:
+		winners[result["winner"]] += 1
+		levels[result["level"]] = levels.get(result["level"], 0) + 1
+		ticks += result["ticks"]
+		points += result["player_score"] + result["cpu_score"]
+		hits += result["hits"]
+	return {"matches": len(results),
+			"winners": winners,
+			"levels": dict(sorted(levels.items())),
+			"max_level": max(levels) if levels else None,
+			"ticks_per_point": ticks / points if points else None,
+			"hits_per_point": hits / points if points else None}
+
+
+# Run all configs on a process pool, one worker per core by default
+def run_tournament(configs: list, workers: int = None) -> dict:
+	workers = workers or os.cpu_count() or 1
+	# Big chunks keep the pickling round trips rare, several chunks per
+	# worker keep the cores busy when match lengths differ
+	chunksize = max(1, len(configs) // (workers * 4))
+	with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+		results = list(executor.map(run_match, configs, chunksize=chunksize))
+	return {"summary": aggregate(results), "results": results}
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Pong tournament')
+	parser.add_argument('configs', nargs='?', help='JSON file with a list of match configs')
+	parser.add_argument('-m', '--matches', type=int, default=100, help='Matches to play with default configs and seeds 0..N-1, when no config file is given (dflt 100)')
+	parser.add_argument('-w', '--workers', type=int, default=None, help='Worker processes (dflt all cores)')
+	parser.add_argument('-o', '--output', type=str, default=None, help='Write every match result to this JSON file')
+	parser.add_argument('--history', type=str, default=None, help='Also record every match in this SQLite history file')
+	args = parser.parse_args()
+
+	if args.configs:
+		with open(args.configs) as configs_file:
+			configs = json.load(configs_file)
+	else:
+		configs = [{"seed": seed} for seed in range(args.matches)]
+
+	start = time.perf_counter()
+	tournament = run_tournament(configs, args.workers)
+	elapsed = time.perf_counter() - start
+	print(json.dumps(tournament["summary"], indent=2))
+	print(f"{len(configs)} matches in {elapsed:.2f}s")
+	if args.output:
+		with open(args.output, "w") as output_file:
+			json.dump(tournament["results"], output_file, indent=2)
+	if args.history:
+		history = match_history.MatchHistory(args.history)
+		for result in tournament["results"]:
+			config = result["config"]
+			history.record("player", result, result["ticks"] / config["fps"], config)
+		history.close()
+
+if __name__ == '__main__':
+	main()